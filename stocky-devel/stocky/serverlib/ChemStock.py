@@ -5,9 +5,18 @@ and sqlalchemy  https://www.sqlalchemy.org/  .
 
 import typing
 import logging
+import time
+import contextlib
+import itertools
+import pathlib
+import sqlite3
+import gevent
+import gevent.event
+import uuid
 
 import sqlalchemy as sql
 import sqlalchemy.orm as orm
+import sqlalchemy.pool as pool
 from sqlalchemy.ext.declarative import declarative_base
 
 import serverlib.chemdb as chemdb
@@ -21,8 +30,49 @@ logger = logging.Logger('ChemStock')
 
 STATE_DIR_ENV_NAME = serverconfig.STATE_DIR_ENV_NAME
 
+# the default number of records passed to a single executemany() call when
+# loading a QAI table dump into the local database.
+BULK_BATCH_SIZE = 5000
 
-Base = declarative_base()
+# the maximum number of primary keys in a single 'IN' clause. This must
+# be less than sqlite's limit on the number of host parameters (999).
+IN_CLAUSE_SIZE = 500
+
+# the sqlite settings used for a database file (see https://www.sqlite.org/pragma.html).
+# journal_mode: with WAL, the stock list can be read while location changes are written.
+# synchronous: with WAL, NORMAL syncs to disk at checkpoints instead of at every commit.
+# cache_size: the page cache size per connection; negative values are in KiB.
+# mmap_size: the maximum number of bytes of the database file to access via memory mapping.
+DEFAULT_STORAGE_PROFILE: typing.Dict[str, typing.Any] = dict(journal_mode='WAL', synchronous='NORMAL',
+                                                             cache_size=-16000, mmap_size=64*1024*1024)
+
+_JOURNAL_MODES = frozenset(['DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF'])
+_SYNC_LEVELS = frozenset(['OFF', 'NORMAL', 'FULL', 'EXTRA'])
+
+# the maximum number of connections kept open for reading a database file.
+READ_POOL_SIZE = 4
+
+# the ways in which the final states of reagent items can be calculated.
+# 'python': with chemdb.BaseDB.final_state_records() for each reagent item.
+# 'sql': with a single query using window functions, which requires sqlite 3.25 or later.
+FINAL_STATE_ENGINES = frozenset(['python', 'sql'])
+DEFAULT_FINAL_STATE_ENGINE = 'sql' if sqlite3.sqlite_version_info >= (3, 25, 0) else 'python'
+
+# a location change that could not be reported to QAI is tried again after OUTBOX_BASE_DELAY
+# seconds. The delay is doubled with every further failure, up to OUTBOX_MAX_DELAY.
+OUTBOX_BASE_DELAY = 10.0
+OUTBOX_MAX_DELAY = 30*60.0
+# the HTTP statuses with which QAI refuses a location change for good. Any other failure
+# (including 401/403 from an expired login, 408, 429 and 5xx) is tried again.
+OUTBOX_REJECT_CODES = frozenset([400, 404, 405, 409, 410, 422])
+
+# the stock list snapshot of a database file is stored next to it in a file with this suffix.
+SNAPSHOT_SUFFIX = '.stocklist.gz'
+
+
+# declarative_base() creates the base class at run time, so mypy cannot check it
+# without the sqlalchemy plugin.
+Base: typing.Any = declarative_base()
 
 
 class Reagent(Base):
@@ -69,9 +119,9 @@ class Reagent_Item(Base):
     lot_num = sql.Column(sql.String)
     notes = sql.Column(sql.String)
 
-    qcs_location_id = sql.Column(sql.Integer)
-    qcs_reag_id = sql.Column(sql.Integer)
-    rfid = sql.Column(sql.String)
+    qcs_location_id = sql.Column(sql.Integer, index=True)
+    qcs_reag_id = sql.Column(sql.Integer, index=True)
+    rfid = sql.Column(sql.String, index=True)
 
 # {id: 10155, last_seen: null, lot_num: 036P062593Anov06, notes: null, qcs_location_id: 10009,
 #  qcs_reag_id: 566, rfid: ID123}
@@ -92,7 +142,7 @@ class Reagent_Item_Status(Base):
 
     id = sql.Column(sql.Integer, primary_key=True)
     occurred = sql.Column(sql.String)
-    qcs_reag_item_id = sql.Column(sql.Integer)
+    qcs_reag_item_id = sql.Column(sql.Integer, index=True)
     qcs_user_id = sql.Column(sql.Integer)
     status = sql.Column(sql.String)
     qcs_validation_id = sql.Column(sql.Integer)
@@ -101,6 +151,23 @@ class Reagent_Item_Status(Base):
 #  status: USED_UP}
 
 
+class Reagent_Item_State(Base):
+    """A class describing the final state of a reagent item, as determined from
+    its status records by :meth:`chemdb.BaseDB.calc_final_state`.
+    This table is not provided by QAI, but is kept up to date with the
+    reagent item status table whenever that is loaded.
+    """
+    __tablename__ = chemdb.ITEM_STATE_TABLE
+
+    qcs_reag_item_id = sql.Column(sql.Integer, primary_key=True)
+    # the id of the nominal state record in the reagent item status table
+    nom_status_id = sql.Column(sql.Integer, index=True)
+    ismissing = sql.Column(sql.Boolean, nullable=False)
+    # the date of the EXPIRED status record, e.g. '2011-04-20', or None if there is none.
+    expiry_date = sql.Column(sql.String, index=True)
+    hasexpired = sql.Column(sql.Boolean, nullable=False)
+
+
 class User(Base):
     """A class describing a QAI user."""
     __tablename__ = 'users'
@@ -147,13 +214,39 @@ class LocMutation(chemdb.BaseLocMutation, Base):
     # keep track of when the location change was recorded on the laptop
     # created_at = sql.Column(sql.TIMESTAMP(timezone=True), default=timelib.utc_nowtime)
     #
-    # whether this LocMutation has been successfully reported to QAI
+    # whether this LocMutation has been successfully reported to QAI.
+    # NOTE: no longer used: committed location changes are moved to the QAIOutbox table.
     sent_to_qai = sql.Column(sql.Boolean, default=False, nullable=False)
 
 
+class QAIOutbox(Base):
+    """A location change of a reagent item that has been committed by the user and
+    is waiting to be reported to QAI.
+    The location changes of a reagent item are reported in the order of their id.
+    """
+    __tablename__ = 'qaioutbox'
+
+    id = sql.Column(sql.Integer, primary_key=True, autoincrement=True)
+    # a unique key sent with the report, so that QAI can recognise a repeated report
+    idem_key = sql.Column(sql.String, unique=True, nullable=False)
+    reag_item_id = sql.Column(sql.Integer, index=True, nullable=False)
+    locid = sql.Column(sql.Integer, nullable=False)
+    op = sql.Column(sql.String, nullable=False)
+    created_at = sql.Column(sql.TIMESTAMP(timezone=True), default=timelib.utc_nowtime)
+    # the number of failed attempts to report this change, the error of the last one,
+    # and the time (in seconds since the epoch) before which it is not tried again.
+    attempts = sql.Column(sql.Integer, default=0, nullable=False)
+    last_error = sql.Column(sql.String)
+    next_try = sql.Column(sql.Float, default=0.0, nullable=False)
+    # QAI has refused this change: it is kept for inspection, but not tried again.
+    rejected = sql.Column(sql.Boolean, default=False, nullable=False)
+
+
 class ChemStockDB(chemdb.BaseDB):
     """ Maintain a local copy of the QAI chemical stock program."""
 
+    HAS_ITEM_STATE_TABLE = True
+
     _ITM_LIST = [(qai_helper.QAISession.QAIDCT_LOCATIONS, Location),
                  (qai_helper.QAISession.QAIDCT_USERS, User),
                  (qai_helper.QAISession.QAIDCT_REAITEM_COMPOSITION, Reagent_Item_Composition),
@@ -167,7 +260,11 @@ class ChemStockDB(chemdb.BaseDB):
     def __init__(self,
                  locQAIfname: typing.Optional[str],
                  qaisession: typing.Optional[qai_helper.QAISession],
-                 tz_name: str) -> None:
+                 tz_name: str,
+                 batch_size: int = BULK_BATCH_SIZE,
+                 storage_profile: typing.Optional[dict] = None,
+                 final_state_engine: str = DEFAULT_FINAL_STATE_ENGINE,
+                 use_snapshot: bool = True) -> None:
         """
         This database is accessed by the stocky web server.
         It is passed a :class:`qai_helper.QAISession` instance which it
@@ -181,20 +278,266 @@ class ChemStockDB(chemdb.BaseDB):
             for testing).
            qaisession: the session instance used to access the QAI server.
            tz_name: the name of the local timezone.
+           batch_size: the number of records inserted per executemany() call
+              when loading QAI data.
+           storage_profile: sqlite settings for a database file that override those
+              in DEFAULT_STORAGE_PROFILE. This is ignored for a database in memory.
+           final_state_engine: how to calculate the final states of the reagent items
+              (one of FINAL_STATE_ENGINES).
+           use_snapshot: keep a snapshot of the stock list on disk. This is ignored for a
+              database in memory.
+
+        Note:
+           For a database file, queries that only read data (such as those used to generate
+           the stock list) use a separate pool of read-only connections, so that they
+           do not hold up writes.
+
+        Note:
+           The snapshot of the stock list is stored in a file next to the database file
+           (see SNAPSHOT_SUFFIX). If the QAI table stamps and the date it was written
+           with match those of the database, the stock list is restored from it without
+           any recomputation. Otherwise, the stock list is rebuilt in a background thread.
+           Until this has finished, the out of date snapshot, if there is one, is served.
         """
         super().__init__(qaisession, tz_name)
+        if not isinstance(batch_size, int) or batch_size <= 0:
+            raise ValueError("batch_size must be a positive int")
+        self._batch_size = batch_size
+        self._storage_profile = ChemStockDB._check_storage_profile(storage_profile)
+        if final_state_engine not in FINAL_STATE_ENGINES:
+            raise ValueError("unknown final_state_engine '{}'".format(final_state_engine))
+        self._final_state_engine = final_state_engine
+        self._load_stats: typing.Dict[str, dict] = {}
+        self._read_engine: typing.Optional[sql.engine.Engine] = None
+        self._snapshot_fname: typing.Optional[str] = None
+        self._snapshot_stale = True
+        self.snapshot_status = 'none'
+        self._bg_result: typing.Optional[gevent.event.AsyncResult] = None
+        self._bg_builder: typing.Optional[chemdb.StockListBuilder] = None
+        self._bg_error: typing.Optional[Exception] = None
+        # all table changes made since the background build started. These are applied
+        # to the old stock list as usual, and again to the new one when it is done.
+        self._bg_changes: typing.Optional[chemdb.TableChangeDict] = None
         if locQAIfname is None:
             db_name = 'sqlite://'
             self._locQAIfname = None
+            self._engine = sql.create_engine(db_name)
         else:
             actual_filename = yamlutil.get_filename(locQAIfname, STATE_DIR_ENV_NAME)
             db_name = 'sqlite:///%s' % actual_filename
             self._locQAIfname = actual_filename
-        self._engine = sql.create_engine(db_name)
+            self._engine = sql.create_engine(db_name)
+            sql.event.listen(self._engine, 'connect', self._set_write_pragmas)
         Base.metadata.create_all(self._engine)
+        if self._locQAIfname is not None:
+            self._read_engine = self._create_read_engine(self._locQAIfname)
+        self._create_missing_indexes()
         Session = orm.sessionmaker(bind=self._engine)
         self._sess = Session()
-        self.generate_webclient_stocklist()
+        s = self._sess
+        if s.query(Reagent_Item_State).count() == 0 and s.query(Reagent_Item_Status).count() > 0:
+            # the database was written before the reagent item state table existed.
+            self._rebuild_item_states()
+        # the expiry flags were calculated on the date the database was last used.
+        self._update_expiry_flags()
+        if self._locQAIfname is not None and use_snapshot:
+            self._snapshot_fname = self._locQAIfname + SNAPSHOT_SUFFIX
+            self._load_snapshot()
+        else:
+            self.generate_webclient_stocklist()
+
+    def _snapshot_key(self) -> dict:
+        """Return the key that determines whether a stock list snapshot is up to date."""
+        return dict(stamps=self.get_ts_data(), date=self._current_date.isoformat())
+
+    def _load_snapshot(self) -> None:
+        """Restore the stock list from the snapshot file.
+        If the snapshot is missing or out of date, start rebuilding the stock list in
+        the background. self.snapshot_status is set to 'loaded' or 'rebuilding'.
+        """
+        snap_fname = typing.cast(str, self._snapshot_fname)
+        snap_tup = chemdb.read_snapshot(snap_fname)
+        if snap_tup is not None:
+            key, state = snap_tup
+            self._builder.set_state(state)
+            if key == self._snapshot_key():
+                logger.info("restored stock list from snapshot '{}'".format(snap_fname))
+                self._pending_changes = {}
+                self._db_has_changed = False
+                self._snapshot_stale = False
+                self.snapshot_status = 'loaded'
+                return
+        logger.info("rebuilding stock list snapshot '{}' in the background".format(snap_fname))
+        self._bg_builder = bg_builder = chemdb.StockListBuilder(self)
+        # changes made from now on are applied to the new stock list when it is done.
+        self._pending_changes = {}
+        self._bg_changes = {}
+        self._db_has_changed = False
+        self._bg_error = None
+
+        def do_build() -> None:
+            try:
+                bg_builder.build(None)
+            except Exception as e:
+                self._bg_error = e
+        # NOTE: the build runs in a thread of gevent's thread pool, which is a real
+        # OS thread even when the threading module has been monkey-patched by the
+        # gevent worker, so that the build does not block the server's greenlets.
+        self._bg_result = gevent.get_hub().threadpool.spawn(do_build)
+        self.snapshot_status = 'rebuilding'
+
+    def _add_pending_changes(self, tab_changes: chemdb.TableChangeDict) -> None:
+        """Add table changes to those that the stock list has not yet been updated with,
+        and to those made since the background build started."""
+        super()._add_pending_changes(tab_changes)
+        chemdb.BaseDB._merge_changes(self._bg_changes, tab_changes)
+
+    def _finish_background_build(self) -> None:
+        """Use the stock list built in the background if it has finished.
+        We wait for it to finish if there is no other stock list to serve.
+        """
+        bg_result = self._bg_result
+        if bg_result is None or (not bg_result.ready() and self._builder.is_built()):
+            return
+        bg_result.wait()
+        self._bg_result = None
+        bg_changes, self._bg_changes = self._bg_changes, None
+        if self._bg_error is not None:
+            logger.error("background stock list build failed: {}".format(self._bg_error))
+            self._pending_changes = None
+            self._db_has_changed = True
+        else:
+            self._builder = typing.cast(chemdb.StockListBuilder, self._bg_builder)
+            # the new stock list was built from the tables as they were when it started:
+            # apply all changes made since, not only those not yet applied to the old one.
+            self._pending_changes = bg_changes
+            self._db_has_changed = self._db_has_changed or bool(bg_changes)
+        self._bg_builder = None
+        self._snapshot_stale = True
+        self.snapshot_status = 'rebuilt'
+
+    def _update_stocklist(self) -> bool:
+        """Bring the stock list up to date and write the snapshot if it has changed."""
+        self._finish_background_build()
+        old_date = self._current_date
+        rebuilt = super()._update_stocklist()
+        if self._snapshot_fname is not None and self._bg_result is None and \
+           (rebuilt or self._snapshot_stale or self._current_date != old_date):
+            self._save_snapshot()
+        return rebuilt
+
+    def _save_snapshot(self) -> None:
+        """Write the current stock list to the snapshot file."""
+        snap_fname = typing.cast(str, self._snapshot_fname)
+        try:
+            chemdb.write_snapshot(snap_fname, self._snapshot_key(), self._builder.get_state())
+        except OSError as e:
+            logger.error("failed to write stock list snapshot '{}': {}".format(snap_fname, e))
+            return
+        self._snapshot_stale = False
+
+    @staticmethod
+    def _check_storage_profile(storage_profile: typing.Optional[dict]) -> dict:
+        """Combine storage_profile with DEFAULT_STORAGE_PROFILE and check the result.
+
+        Raises:
+           ValueError: if an unknown setting or an illegal value is provided.
+        """
+        profile = dict(DEFAULT_STORAGE_PROFILE)
+        profile.update(storage_profile or {})
+        unknown_set = set(profile.keys()) - set(DEFAULT_STORAGE_PROFILE.keys())
+        if unknown_set:
+            raise ValueError("unknown storage settings {}".format(unknown_set))
+        if profile['journal_mode'] not in _JOURNAL_MODES:
+            raise ValueError("illegal journal_mode '{}'".format(profile['journal_mode']))
+        if profile['synchronous'] not in _SYNC_LEVELS:
+            raise ValueError("illegal synchronous '{}'".format(profile['synchronous']))
+        for k in ('cache_size', 'mmap_size'):
+            if not isinstance(profile[k], int):
+                raise ValueError("{} must be an int".format(k))
+        if profile['mmap_size'] < 0:
+            raise ValueError("mmap_size must be >= 0")
+        return profile
+
+    def _set_write_pragmas(self, dbapi_conn, conn_record) -> None:
+        """Apply the storage profile to a new connection to the database file."""
+        profile = self._storage_profile
+        cursor = dbapi_conn.cursor()
+        for k in ('journal_mode', 'synchronous', 'cache_size', 'mmap_size'):
+            cursor.execute("PRAGMA {}={}".format(k, profile[k]))
+        cursor.close()
+
+    def _create_read_engine(self, filename: str) -> sql.engine.Engine:
+        """Create an engine with a pool of read-only connections to the database file."""
+        profile = self._storage_profile
+        uri = pathlib.Path(filename).absolute().as_uri() + '?mode=ro'
+
+        def connect_ro() -> sqlite3.Connection:
+            dbapi_conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            dbapi_conn.execute("PRAGMA cache_size={}".format(profile['cache_size']))
+            dbapi_conn.execute("PRAGMA mmap_size={}".format(profile['mmap_size']))
+            return dbapi_conn
+        return sql.create_engine('sqlite://', creator=connect_ro,
+                                 poolclass=pool.QueuePool, pool_size=READ_POOL_SIZE)
+
+    def get_storage_info(self) -> dict:
+        """Return the sqlite settings in effect on the database.
+
+        Returns:
+           A dict with the current values of the settings in DEFAULT_STORAGE_PROFILE,
+           and 'read_pool' which states whether a separate pool of read-only connections is used.
+        """
+        rdct: typing.Dict[str, typing.Any] = {}
+        with self._engine.connect() as conn:
+            for k in DEFAULT_STORAGE_PROFILE.keys():
+                rdct[k] = conn.execute("PRAGMA {}".format(k)).scalar()
+        rdct['read_pool'] = self._read_engine is not None
+        return rdct
+
+    @contextlib.contextmanager
+    def _reader(self) -> typing.Iterator[typing.Any]:
+        """Provide a connection to run read-only queries on.
+        This is a connection from the read pool for a database file,
+        or our session for a database in memory.
+        """
+        if self._read_engine is None:
+            yield self._sess
+        else:
+            with self._read_engine.connect() as conn:
+                yield conn
+
+    def _read_rows(self, sel) -> chemdb.DBRecList:
+        """Execute a select statement on a read-only connection and return the rows as dicts."""
+        with self._reader() as conn:
+            return [dict(row) for row in conn.execute(sel)]
+
+    def _read_rows_in(self, sel, col, vallst: typing.List[typing.Any]) -> chemdb.DBRecList:
+        """Execute a select statement restricted to rows for which col has one of the
+        values in vallst on a read-only connection and return the rows as dicts."""
+        with self._reader() as conn:
+            return [dict(row) for row in ChemStockDB._select_in(conn, sel, col, vallst)]
+
+    def _create_missing_indexes(self) -> None:
+        """Create any indexes that are missing in an existing database file.
+        create_all() only creates the indexes of tables it creates itself."""
+        inspector = sql.inspect(self._engine)
+        for tab in Base.metadata.sorted_tables:
+            got_set = set([idx['name'] for idx in inspector.get_indexes(tab.name)])
+            for idx in tab.indexes:
+                if idx.name not in got_set:
+                    logger.info("creating missing index {}".format(idx.name))
+                    idx.create(self._engine)
+
+    @staticmethod
+    def _select_in(conn, sel, col, vallst: typing.List[typing.Any]) -> typing.Iterator[typing.Any]:
+        """Execute a select statement on conn restricted to rows for which col has one of
+        the values in vallst. The values are passed in chunks of IN_CLAUSE_SIZE.
+
+        Returns:
+           An iterator over the resulting rows.
+        """
+        for ndx in range(0, len(vallst), IN_CLAUSE_SIZE):
+            yield from conn.execute(sel.where(col.in_(vallst[ndx:ndx+IN_CLAUSE_SIZE])))
 
     def _set_update_time(self) -> str:
         """Set the ChemDB update time to now
@@ -244,42 +587,319 @@ class ChemStockDB(chemdb.BaseDB):
             rdct[idname] = s.query(classname).count()
         return rdct
 
+    @staticmethod
+    def _check_columns(classname, recs: typing.Iterable[dict]) -> typing.Iterator[dict]:
+        """Compare the keys of the records provided by QAI with the columns of a table
+        and log any differences.
+        Only the first record is checked, as all records of a QAI table dump have the same keys.
+
+        Returns:
+           An iterator over the records.
+        """
+        rec_iter = iter(recs)
+        first_rec = next(rec_iter, None)
+        if first_rec is None:
+            return
+        kset = set(classname.__table__.columns.keys())
+        got_keys = set(first_rec.keys())
+        unwanted_keys = got_keys - kset
+        if len(unwanted_keys) > 0:
+            logger.warning("class {}: QAI provided unwanted keys {}".format(classname, unwanted_keys))
+        missing_keys = kset - got_keys
+        if len(missing_keys) > 0:
+            logger.warning("class {}: missing keys {}".format(classname, missing_keys))
+        yield first_rec
+        yield from rec_iter
+
+    @staticmethod
+    def _rate_dct(tabname: str, nrows: int, secs: float) -> dict:
+        rows_per_sec = nrows/secs if secs > 0.0 else 0.0
+        logger.info("table {}: loaded {} rows in {:.3f} s ({:.0f} rows/s)".format(
+            tabname, nrows, secs, rows_per_sec))
+        return dict(nrows=nrows, secs=secs, rows_per_sec=rows_per_sec)
+
+    def _bulk_load_table(self, classname, recs: typing.Iterable[dict]) -> dict:
+        """Replace the contents of a database table with the records provided.
+
+        The records are inserted in batches of self._batch_size using
+        sqlalchemy core executemany() calls. The delete and all inserts
+        are performed in a single transaction.
+        As recs is consumed one batch at a time, a table streamed from QAI is
+        never held in memory as a whole.
+
+        Args:
+           classname: the class describing the database table to load.
+           recs: the records as provided by QAI. This can be a list or an iterator.
+        Returns:
+           A dict with load statistics: the number of rows loaded ('nrows'),
+           the time taken in seconds ('secs') and the number of rows loaded per
+           second ('rows_per_sec').
+        """
+        s = self._sess
+        tab = classname.__table__
+        colnames = tab.columns.keys()
+        rec_iter = ChemStockDB._check_columns(classname, recs)
+        t_start = time.perf_counter()
+        s.execute(tab.delete())
+        batch_size = self._batch_size
+        nrows = 0
+        while True:
+            batch = [{k: r_dct.get(k, None) for k in colnames} for r_dct in itertools.islice(rec_iter, batch_size)]
+            if not batch:
+                break
+            s.execute(tab.insert(), batch)
+            nrows += len(batch)
+        s.commit()
+        return ChemStockDB._rate_dct(tab.name, nrows, time.perf_counter() - t_start)
+
+    def _delta_load_table(self, classname,
+                          recs: typing.Iterable[dict],
+                          keyset: typing.Optional[typing.Set[int]] = None,
+                          old_rows: typing.Optional[typing.Dict[int, dict]] = None) \
+            -> typing.Tuple[dict, chemdb.TableDelta]:
+        """Bring the contents of a database table into agreement with the records provided
+        by only applying the required changes.
+
+        The records are compared with the current table contents by primary key.
+        Records with new keys are inserted, records whose values differ are updated, and
+        rows whose keys are absent from recs are deleted. All changes are performed in
+        a single transaction.
+        Only the inserted and updated records are kept in memory, so recs can be an
+        iterator over a table streamed from QAI.
+
+        Args:
+           classname: the class describing the database table to load.
+           recs: the records as provided by QAI. This can be a list or an iterator.
+           keyset: if provided, only the rows with these primary keys are compared and
+              changed. recs must then only contain records with keys in keyset.
+           old_rows: if provided, the previous contents of all updated and deleted rows
+              are added to this dict, keyed by primary key.
+        Returns:
+           A dict with load statistics as returned by _bulk_load_table() with
+           the change counts added, and the changes made.
+        """
+        s = self._sess
+        tab = classname.__table__
+        colnames = tab.columns.keys()
+        pkname = tab.primary_key.columns.keys()[0]
+        pkcol = tab.c[pkname]
+        rec_iter = ChemStockDB._check_columns(classname, recs)
+        t_start = time.perf_counter()
+        old_sel = sql.select([tab.c[k] for k in colnames])
+        rows = s.execute(old_sel) if keyset is None else ChemStockDB._select_in(s, old_sel, pkcol, list(keyset))
+        old_dct = {row[pkname]: tuple(row) for row in rows}
+        tdelta = chemdb.TableDelta()
+        inslst, updlst = [], []
+        nrows = 0
+        for r_dct in rec_iter:
+            nrows += 1
+            new_tup = tuple([r_dct.get(k, None) for k in colnames])
+            pk = r_dct[pkname]
+            old_tup = old_dct.pop(pk, None)
+            if old_tup is None:
+                tdelta.inserted.add(pk)
+                inslst.append(dict(zip(colnames, new_tup)))
+            elif old_tup != new_tup:
+                tdelta.updated.add(pk)
+                updlst.append(dict(zip(['b_' + k for k in colnames], new_tup)))
+                if old_rows is not None:
+                    old_rows[pk] = dict(zip(colnames, old_tup))
+        # any keys remaining in old_dct are no longer present on QAI
+        tdelta.deleted = set(old_dct.keys())
+        if old_rows is not None:
+            old_rows.update((pk, dict(zip(colnames, old_tup))) for pk, old_tup in old_dct.items())
+        dellst = list(tdelta.deleted)
+        for ndx in range(0, len(dellst), IN_CLAUSE_SIZE):
+            s.execute(tab.delete().where(pkcol.in_(dellst[ndx:ndx+IN_CLAUSE_SIZE])))
+        batch_size = self._batch_size
+        if updlst:
+            upd_stmt = tab.update().where(pkcol == sql.bindparam('b_' + pkname)).values(
+                {k: sql.bindparam('b_' + k) for k in colnames if k != pkname})
+            for ndx in range(0, len(updlst), batch_size):
+                s.execute(upd_stmt, updlst[ndx:ndx+batch_size])
+        for ndx in range(0, len(inslst), batch_size):
+            s.execute(tab.insert(), inslst[ndx:ndx+batch_size])
+        s.commit()
+        stat_dct = ChemStockDB._rate_dct(tab.name, nrows, time.perf_counter() - t_start)
+        stat_dct.update(tdelta.as_dict())
+        return stat_dct, tdelta
+
+    def _calc_item_states(self, item_ids: typing.Optional[typing.Set[int]]) -> typing.List[dict]:
+        """Calculate the records of the reagent item state table from the status records
+        of the given reagent items, or of all reagent items if item_ids is None.
+        """
+        if self._final_state_engine == 'sql':
+            return self._calc_item_states_sql(item_ids)
+        return self._calc_item_states_python(item_ids)
+
+    def _calc_item_states_python(self, item_ids: typing.Optional[typing.Set[int]]) -> typing.List[dict]:
+        """Calculate the reagent item states by calling chemdb.BaseDB.final_state_records()
+        for each reagent item."""
+        z_z: typing.Dict[int, typing.List[dict]] = {}
+        if item_ids is None:
+            statlst = self.get_reagent_item_status_list()
+        else:
+            statlst = self.get_reagent_item_status_list_for_items(item_ids)
+        for state in statlst:
+            state['occurred'] = state['occurred'].split('T')[0]
+            z_z.setdefault(state['qcs_reag_item_id'], []).append(state)
+        today_str = self._current_date.isoformat()
+        rlst = []
+        for reag_item_id, state_lst in z_z.items():
+            # see get_final_state_dct() in chemdb: the order of the records matters
+            state_lst.sort(key=lambda a: a['id'])
+            nom_state, exp_dict, ismissing = chemdb.BaseDB.final_state_records(state_lst)
+            expiry_date = chemdb.BaseDB.expiry_date_string(exp_dict)
+            rlst.append(dict(qcs_reag_item_id=reag_item_id,
+                             nom_status_id=nom_state['id'],
+                             ismissing=ismissing,
+                             expiry_date=expiry_date,
+                             hasexpired=expiry_date is not None and expiry_date < today_str))
+        return rlst
+
+    def _item_state_select(self, item_ids: typing.Optional[typing.List[int]]):
+        """Return a select statement that calculates the records of the reagent item state table
+        for the given reagent items, or for all reagent items if item_ids is None.
+
+        This performs the same calculation as chemdb.BaseDB.final_state_records():
+        the status records of each reagent item are ranked by descending score and id
+        using a window function. The first record is the expiry record, the second one
+        the nominal state. A reagent item with a single status record has this as both
+        its expiry record and its nominal state.
+        """
+        rs = Reagent_Item_Status.__table__
+        score = sql.case([(rs.c.status == status, val) for status, val in chemdb.BaseDB.STATUS_SCORE_DCT.items()],
+                         else_=sql.null())
+        scored_sel = sql.select([rs.c.id, rs.c.qcs_reag_item_id, rs.c.status, rs.c.occurred, score.label('score')])
+        if item_ids is not None:
+            scored_sel = scored_sel.where(rs.c.qcs_reag_item_id.in_(item_ids))
+        sc = scored_sel.alias('scored')
+        ranked = sql.select([sc, sql.func.row_number().over(
+            partition_by=sc.c.qcs_reag_item_id,
+            order_by=[sc.c.score.is_(None), sc.c.score.desc(), sc.c.id.desc()]).label('rn')]).alias('ranked')
+        rc = ranked.c
+        expiry_date = sql.func.max(sql.case([(sql.and_(rc.rn == 1, rc.status == 'EXPIRED'),
+                                              sql.func.substr(rc.occurred, 1, 10))]))
+        return sql.select([
+            rc.qcs_reag_item_id,
+            sql.func.coalesce(sql.func.max(sql.case([(rc.rn == 2, rc.id)])),
+                              sql.func.max(sql.case([(rc.rn == 1, rc.id)]))).label('nom_status_id'),
+            sql.and_(sql.func.count() > 1, sql.func.min(rc.score) == -1).label('ismissing'),
+            expiry_date.label('expiry_date'),
+            sql.func.coalesce(expiry_date < self._current_date.isoformat(), False).label('hasexpired')]).group_by(
+                rc.qcs_reag_item_id)
+
+    def _calc_item_states_sql(self, item_ids: typing.Optional[typing.Set[int]]) -> typing.List[dict]:
+        """Calculate the reagent item states in sqlite. See :meth:`_item_state_select`."""
+        if item_ids is None:
+            sel_lst = [self._item_state_select(None)]
+        else:
+            idlst = list(item_ids)
+            sel_lst = [self._item_state_select(idlst[ndx:ndx+IN_CLAUSE_SIZE])
+                       for ndx in range(0, len(idlst), IN_CLAUSE_SIZE)]
+        rlst: typing.List[dict] = []
+        for sel in sel_lst:
+            for r_dct in self._read_rows(sel):
+                r_dct['ismissing'] = bool(r_dct['ismissing'])
+                r_dct['hasexpired'] = bool(r_dct['hasexpired'])
+                rlst.append(r_dct)
+        return rlst
+
+    def _rebuild_item_states(self) -> dict:
+        """Rebuild the reagent item state table from scratch.
+        With the 'sql' engine, the states are calculated and inserted by a single statement,
+        without passing through python.
+
+        Returns:
+           A dict with load statistics as returned by _bulk_load_table().
+        """
+        if self._final_state_engine != 'sql':
+            return self._bulk_load_table(Reagent_Item_State, self._calc_item_states(None))
+        s = self._sess
+        tab = Reagent_Item_State.__table__
+        t_start = time.perf_counter()
+        s.execute(tab.delete())
+        state_sel = self._item_state_select(None)
+        nrows = s.execute(tab.insert().from_select([c.name for c in state_sel.c], state_sel)).rowcount
+        s.commit()
+        return ChemStockDB._rate_dct(tab.name, nrows, time.perf_counter() - t_start)
+
+    def _load_item_states(self, stat_delta: typing.Optional[chemdb.TableDelta],
+                          old_stat_rows: typing.Dict[int, dict]) -> typing.Optional[chemdb.TableDelta]:
+        """Bring the reagent item state table up to date after the status table was loaded.
+
+        Args:
+           stat_delta: the changes made to the status table, or None if it was reloaded
+              from scratch. In the latter case, the state table is also rebuilt from scratch.
+           old_stat_rows: the previous contents of the updated and deleted status records.
+        Returns:
+           The reagent items whose entry in the stock list has changed, or None if
+           the state table was rebuilt from scratch.
+        """
+        if stat_delta is None:
+            self._load_stats[chemdb.ITEM_STATE_TABLE] = self._rebuild_item_states()
+            return None
+        new_ids = stat_delta.inserted | stat_delta.updated
+        stat_tab = Reagent_Item_Status.__table__
+        sel = sql.select([stat_tab.c.qcs_reag_item_id])
+        item_ids = set([row[0] for row in ChemStockDB._select_in(self._sess, sel, stat_tab.c.id, list(new_ids))])
+        item_ids.update([r_dct['qcs_reag_item_id'] for r_dct in old_stat_rows.values()])
+        if not item_ids:
+            return chemdb.TableDelta()
+        reclst = self._calc_item_states(item_ids)
+        stat_dct, tdelta = self._delta_load_table(Reagent_Item_State, reclst, keyset=item_ids)
+        self._load_stats[chemdb.ITEM_STATE_TABLE] = stat_dct
+        # a reagent item's entry in the stock list also changes if its nominal
+        # status record was updated, even though its state table row has not.
+        tdelta.updated |= set([r_dct['qcs_reag_item_id'] for r_dct in reclst
+                               if r_dct['nom_status_id'] in stat_delta.updated]) - tdelta.inserted
+        return tdelta
+
     def load_qai_data(self,
                       qai_ds: qai_helper.QAIDataset,
-                      update_dct: typing.Optional[qai_helper.QAIUpdatedct] = None) -> bool:
+                      update_dct: typing.Optional[qai_helper.QAIUpdatedct] = None,
+                      delta_sync: bool = False) -> bool:
         """Replace the database contents with the data contained in qai_ds
         if update_dct is provided, only update those tables for which
         update_dct[idname] is True.
+        If delta_sync is True, only the rows that differ from the current table
+        contents are changed.
+        The tables of qai_ds can also be iterators over records streamed from QAI
+        (see :meth:`qai_helper.QAISession.stream_table_dump`). If streaming a table fails,
+        that table and its time stamp are left unchanged, and the error is recorded
+        (see :meth:`get_load_errors`).
         Return := 'the update was successful'
         """
         s = self._sess
         # first, add the data....
         qaidct = qai_ds.get_data()
-        upd_dct = update_dct or {}
+        upd_dct = dict(update_dct or {})
+        self._load_stats = {}
+        self._load_errors = {}
+        tab_changes: chemdb.TableChangeDict = {}
+        S = qai_helper.QAISession
+        old_stat_rows: typing.Dict[int, dict] = {}
         for idname, classname in ChemStockDB._ITM_LIST:
-            do_msg = True
             do_update = upd_dct.get(idname, True)
             if do_update:
-                # first, empty the table, then reload from scratch
-                s.query(classname).delete()
-                s.commit()
-                # get the column names defined in this table
-                kset = set(classname.__table__.columns.keys())
-                for r_dct in qaidct[idname]:
-                    got_keys = set(r_dct.keys())
-                    unwanted_keys = got_keys - kset
-                    if do_msg and len(unwanted_keys) > 0:
-                        logger.warning("class {}: QAI provided unwanted keys {}".format(classname, unwanted_keys))
-                    for k in unwanted_keys:
-                        del r_dct[k]
-                    if do_msg:
-                        missing_keys = kset - got_keys
-                        if len(missing_keys) > 0:
-                            logger.warning("class {}: missing keys {}".format(classname, missing_keys))
-                    # print("BLA {}".format(r_dct))
-                    s.add(classname(**r_dct))
-                    do_msg = False
-                s.commit()
+                try:
+                    if delta_sync:
+                        stat_dct, tdelta = self._delta_load_table(
+                            classname, qaidct[idname],
+                            old_rows=old_stat_rows if idname == S.QAIDCT_REAITEM_STATUS else None)
+                        self._load_stats[idname] = stat_dct
+                        tab_changes[idname] = tdelta
+                    else:
+                        self._load_stats[idname] = self._bulk_load_table(classname, qaidct[idname])
+                        tab_changes[idname] = None
+                except qai_helper.QAIStreamError as err:
+                    logger.error("failed to load {}: {}".format(idname, err))
+                    s.rollback()
+                    self._load_errors[idname] = str(err)
+                    upd_dct[idname] = False
+        if S.QAIDCT_REAITEM_STATUS in tab_changes:
+            tab_changes[chemdb.ITEM_STATE_TABLE] = self._load_item_states(tab_changes[S.QAIDCT_REAITEM_STATUS],
+                                                                          old_stat_rows)
         # now add the timestamps
         tsdct = qai_ds.get_timestamp()
         for k, val in tsdct.items():
@@ -289,8 +909,20 @@ class ChemStockDB(chemdb.BaseDB):
                 s.merge(tc)
         s.commit()
         self._set_update_time()
+        # the table stamps are part of the snapshot key, even if no rows have changed.
+        self._snapshot_stale = True
+        self._record_table_changes(tab_changes)
         return True
 
+    def get_load_stats(self) -> typing.Dict[str, dict]:
+        """Return the load statistics of the most recent call to load_qai_data().
+
+        Returns:
+           The keys are the names of the tables that were loaded, the values
+           are dicts as returned by _bulk_load_table() or _delta_load_table().
+        """
+        return self._load_stats
+
     def get_ts_data(self) -> qai_helper.QAIChangedct:
         """Retrieve the current timestamp data from the database."""
         rdct: qai_helper.QAIChangedct = {}
@@ -303,23 +935,76 @@ class ChemStockDB(chemdb.BaseDB):
 
     def get_location_list(self) -> chemdb.DBRecList:
         """Return a list of all defined locations."""
-        s = self._sess
-        return [dict(row) for row in s.execute(Location.__table__.select())]
+        return self._read_rows(Location.__table__.select())
 
     def get_reagent_list(self) -> chemdb.DBRecList:
         """Return a list of all reagents."""
-        s = self._sess
-        return [dict(row) for row in s.execute(Reagent.__table__.select())]
+        return self._read_rows(Reagent.__table__.select())
 
     def get_reagent_item_list(self) -> chemdb.DBRecList:
         """Return a list of all reagent items."""
-        s = self._sess
-        return [dict(row) for row in s.execute(Reagent_Item.__table__.select())]
+        return self._read_rows(Reagent_Item.__table__.select())
 
     def get_reagent_item_status_list(self) -> chemdb.DBRecList:
         """Return a list of all reagent item statuses."""
+        return self._read_rows(Reagent_Item_Status.__table__.select())
+
+    def get_reagent_items_at_location(self, locid: int) -> chemdb.DBRecList:
+        """Return a list of the reagent items at a location."""
+        tab = Reagent_Item.__table__
+        return self._read_rows(tab.select().where(tab.c.qcs_location_id == locid))
+
+    def get_reagent_items_of_reagent(self, reag_id: int) -> chemdb.DBRecList:
+        """Return a list of the reagent items of a reagent."""
+        tab = Reagent_Item.__table__
+        return self._read_rows(tab.select().where(tab.c.qcs_reag_id == reag_id))
+
+    def get_reagent_items_by_rfid(self, rfids: typing.Iterable[str]) -> chemdb.DBRecList:
+        """Return a list of the reagent items with the given RFIDs.
+        RFIDs that are not in the database are ignored."""
+        tab = Reagent_Item.__table__
+        return self._read_rows_in(tab.select(), tab.c.rfid, list(rfids))
+
+    def get_reagent_item_status_list_for_items(self, item_ids: typing.Iterable[int]) -> chemdb.DBRecList:
+        """Return a list of the statuses of the given reagent items."""
+        tab = Reagent_Item_Status.__table__
+        return self._read_rows_in(tab.select(), tab.c.qcs_reag_item_id, list(item_ids))
+
+    def get_final_state_dct(self, item_ids: typing.Optional[typing.Set[int]]) -> chemdb.FinalStateDct:
+        """Return the final state of reagent items by joining the reagent item state table
+        with the status table. See :meth:`chemdb.BaseDB.get_final_state_dct`.
+        """
+        st = Reagent_Item_State.__table__
+        rs = Reagent_Item_Status.__table__
+        colnames = rs.columns.keys()
+        sel = sql.select([st.c.ismissing, st.c.hasexpired, rs]).select_from(
+            st.join(rs, rs.c.id == st.c.nom_status_id))
+        if item_ids is None:
+            rows = self._read_rows(sel)
+        else:
+            rows = self._read_rows_in(sel, st.c.qcs_reag_item_id, list(item_ids))
+        rdct: chemdb.FinalStateDct = {}
+        for row in rows:
+            nom_state = {k: row[k] for k in colnames}
+            nom_state['occurred'] = nom_state['occurred'].split('T')[0]
+            rdct[nom_state['qcs_reag_item_id']] = (nom_state, bool(row['ismissing']), bool(row['hasexpired']))
+        return rdct
+
+    def _update_expiry_flags(self) -> typing.Optional[chemdb.TableDelta]:
+        """Recompute the hasexpired flags in the reagent item state table for the current date.
+        Only the rows whose flag changes are updated.
+        """
         s = self._sess
-        return [dict(row) for row in s.execute(Reagent_Item_Status.__table__.select())]
+        st = Reagent_Item_State.__table__
+        today_str = self._current_date.isoformat()
+        now_expired = st.c.expiry_date < today_str
+        flip_cond = sql.and_(st.c.expiry_date.isnot(None), now_expired != st.c.hasexpired)
+        tdelta = chemdb.TableDelta()
+        tdelta.updated = set([row[0] for row in s.execute(sql.select([st.c.qcs_reag_item_id]).where(flip_cond))])
+        if tdelta.updated:
+            s.execute(st.update().where(flip_cond).values(hasexpired=now_expired))
+            s.commit()
+        return tdelta
 
     # location changes ---
     def reset_loc_changes(self) -> None:
@@ -428,51 +1113,253 @@ class ChemStockDB(chemdb.BaseDB):
         else:
             return newhash, None
 
-    def perform_loc_changes(self, move_dct: dict) -> dict:
-        """
-         * Report the required changes from the list provided to QAI.
-         * Update the local LocMutation table accordingly
-         * Purge successfully recorded locmutations
-         * Replenish our DB from QAI.
-         * Return a dict in response (success/failure)
-        """
-        res = self._report_loc_changes(move_dct)
-        # now purge all records that are marked as sent_to_qai.
-        s = self._sess
-        s.query(LocMutation).filter_by(sent_to_qai=True).delete()
-        s.commit()
-        return res
+    def perform_loc_changes(self, move_dct: dict,
+                            progress_func: typing.Optional[chemdb.ProgressFunc] = None) -> dict:
+        """Commit the location changes (see :meth:`commit_loc_changes`) and report them
+        to QAI right away (see :meth:`drain_outbox`).
+        Changes that could not be reported stay in the outbox and are reported by a
+        later call of drain_outbox().
 
-    def _report_loc_changes(self, move_dct: dict) -> dict:
-        """Report all location changes in the local database to QAI.
-        If a an individual location change was successfully recorded with QAI,
-        then mark the sent_to_qai field of the record.
-        This will allows us to delete all successfully reported changes.
+        Args:
+           move_dct: the location changes to report. The keys are location ids, the values
+              lists of (reagent item id, opstring, do_ignore) tuples.
+           progress_func: if provided, this is called with the number of items reported so
+              far, the total number of items to report and the number of failures
+              after each item has been reported.
+        Returns:
+           A dict with the keys 'ok' (all items were reported), 'nsent', 'nfailed', 'npending'
+           (the number of changes left in the outbox) and 'items'.
+           The latter is a dict keyed by reagent item id whose values are dicts
+           with the key 'ok' and, for failed items, 'msg'.
+        """
+        res = self.commit_loc_changes(move_dct)
+        drain_res = self.drain_outbox(progress_func)
+        item_dct = res['items']
+        for reag_item_id, resdct in item_dct.items():
+            if resdct['ok']:
+                item_dct[reag_item_id] = drain_res['items'].get(
+                    reag_item_id, dict(ok=False, msg="waiting to be reported to QAI"))
+        nsent = sum(resdct['ok'] for resdct in item_dct.values())
+        nfailed = len(item_dct) - nsent
+        return dict(ok=nfailed == 0, nsent=nsent, nfailed=nfailed,
+                    npending=drain_res['npending'], items=item_dct)
+
+    def commit_loc_changes(self, move_dct: dict) -> dict:
+        """Commit location changes to be reported to QAI.
+
+        The changes are moved from the LocMutation table to the QAIOutbox table in
+        a single transaction, so that they survive a restart of the server. They are reported
+        to QAI by :meth:`drain_outbox`. Every change is given a unique idempotency key.
 
-        If an error occurs in any of the qai interactions, then a dict containing ok=False
-        is returned.
+        Args:
+           move_dct: the location changes to commit. The keys are location ids, the values
+              lists of (reagent item id, opstring, do_ignore) tuples.
+              Changes with do_ignore set are left in the LocMutation table.
+        Returns:
+           A dict with the keys 'ok' (all items were committed), 'nqueued', 'nfailed' and 'items'.
+           The latter is a dict keyed by reagent item id whose values are dicts
+           with the key 'ok' and, for failed items, 'msg'.
         """
-        qaisession = self.qaisession
         s = self._sess
-        print("PERFORM LOC_CHANGE")
+        movelst: typing.List[typing.Tuple[int, int, str]] = []
         for locid_string, mvlst in move_dct.items():
             locid = int(locid_string)
-            print("LOCID {}".format(locid))
             for reag_item_id, opstring, do_ignore in mvlst:
-                if isinstance(reag_item_id, str):
-                    # print('stringy {}'.format(reag_item_id))
-                    reag_item_id = int(reag_item_id)
-                print("   mm {} {} {}".format(reag_item_id, opstring, do_ignore))
                 if not do_ignore:
-                    locmut = s.query(LocMutation).filter_by(reag_item_id=reag_item_id).first()
-                    if locmut is None:
-                        return dict(ok=False,
-                                    msg="no locmutation record for reag_item_id={}".format(reag_item_id))
-                    resdct = qaisession.report_item_location(reag_item_id, locid, opstring)
-                    is_ok = resdct.get('ok', False)
-                    if is_ok:
-                        locmut.sent_to_qai = True
-                        s.commit()
-                    else:
-                        return resdct
-        return dict(res='ok')
+                    movelst.append((int(reag_item_id), locid, opstring))
+        tab = LocMutation.__table__
+        sel = sql.select([tab.c.reag_item_id])
+        id_lst = [reag_item_id for reag_item_id, locid, opstring in movelst]
+        known_set = set([row[0] for row in ChemStockDB._select_in(s, sel, tab.c.reag_item_id, id_lst)])
+        item_dct: typing.Dict[int, dict] = {}
+        queue_lst: typing.List[dict] = []
+        now = timelib.utc_nowtime()
+        for reag_item_id, locid, opstring in movelst:
+            if reag_item_id in known_set:
+                item_dct[reag_item_id] = dict(ok=True)
+                queue_lst.append(dict(idem_key=uuid.uuid4().hex, reag_item_id=reag_item_id,
+                                      locid=locid, op=opstring, created_at=now))
+            else:
+                item_dct[reag_item_id] = dict(ok=False,
+                                              msg="no locmutation record for reag_item_id={}".format(reag_item_id))
+        if queue_lst:
+            s.execute(QAIOutbox.__table__.insert(), queue_lst)
+            queued_lst = [dct['reag_item_id'] for dct in queue_lst]
+            for ndx in range(0, len(queued_lst), IN_CLAUSE_SIZE):
+                s.execute(tab.delete().where(tab.c.reag_item_id.in_(queued_lst[ndx:ndx+IN_CLAUSE_SIZE])))
+        s.commit()
+        nfailed = len(item_dct) - len(queue_lst)
+        return dict(ok=nfailed == 0, nqueued=len(queue_lst), nfailed=nfailed, items=item_dct)
+
+    @staticmethod
+    def _outbox_retry_delay(attempts: int) -> float:
+        """Return the time to wait in seconds before retrying a location change that
+        has failed attempts times."""
+        return min(OUTBOX_BASE_DELAY*2.0**(attempts-1), OUTBOX_MAX_DELAY)
+
+    def drain_outbox(self, progress_func: typing.Optional[chemdb.ProgressFunc] = None,
+                     now: typing.Optional[float] = None) -> dict:
+        """Report the location changes in the QAIOutbox table to QAI.
+
+        The oldest change of each reagent item that is due is reported, the changes of different
+        items concurrently (see :meth:`qai_helper.Session.fetch_concurrently`).
+        Changes that were reported successfully are deleted, and this is repeated until
+        no more changes are due.
+        A failed change holds back the later changes of the same reagent item, so that QAI
+        receives the changes of an item in the order they were committed. It is tried again
+        after a delay that doubles with every failure (see OUTBOX_BASE_DELAY).
+        A change that QAI refuses (with an HTTP status in OUTBOX_REJECT_CODES) is marked as
+        rejected and is not tried again. It keeps holding back the later changes of its
+        reagent item until it is resolved with :meth:`resolve_rejected`.
+
+        Args:
+           progress_func: if provided, this is called with the number of changes reported so
+              far, the number of changes due at the start and the number of failures
+              after each change has been reported.
+           now: the current time in seconds since the epoch. This defaults to time.time().
+        Returns:
+           A dict with the keys 'ok' (no report failed), 'nsent', 'nfailed', 'npending'
+           (the number of changes left to be reported) and 'items'.
+           The latter is a dict keyed by reagent item id whose values are dicts
+           with the key 'ok' and, for failed items, 'msg'.
+        """
+        qaisession = self.qaisession
+        if self._draining or qaisession is None or not qaisession.is_logged_in():
+            return dict(ok=True, nsent=0, nfailed=0, npending=self._num_outbox_pending(), items={})
+        # NOTE: we wait for a streamed update from QAI to finish: it commits on the same session.
+        with self._sess_lock:
+            self._draining = True
+            try:
+                retdct = self._drain_outbox(qaisession, progress_func, time.time() if now is None else now)
+            finally:
+                self._draining = False
+            retdct['npending'] = self._num_outbox_pending()
+        return retdct
+
+    def _num_outbox_pending(self) -> int:
+        s = self._sess
+        retval = s.query(QAIOutbox).filter_by(rejected=False).count()
+        s.commit()
+        return retval
+
+    def _drain_outbox(self, qaisession: qai_helper.QAISession,
+                      progress_func: typing.Optional[chemdb.ProgressFunc],
+                      now: float) -> dict:
+        s = self._sess
+        tab = QAIOutbox.__table__
+        item_dct: typing.Dict[int, dict] = {}
+        held_set: typing.Set[int] = set()
+        nsent = nfailed = 0
+        ntotal = s.query(QAIOutbox).filter(QAIOutbox.rejected.is_(False), QAIOutbox.next_try <= now).count()
+        progress = dict(ndone=0, nfailed=0)
+
+        def report_one(reag_item_id: int, locid: int, opstring: str, idem_key: str) -> dict:
+            try:
+                resdct = qaisession.report_item_location(reag_item_id, locid, opstring, idem_key=idem_key)
+            except Exception as err:
+                resdct = dict(ok=False, msg=str(err))
+            progress['ndone'] += 1
+            if not resdct.get('ok', False):
+                progress['nfailed'] += 1
+            if progress_func is not None:
+                progress_func(progress['ndone'], ntotal, progress['nfailed'])
+            return resdct
+
+        while True:
+            # find the oldest change of each reagent item
+            sendlst = []
+            seen_set: typing.Set[int] = set()
+            # NOTE: a rejected change holds back the later changes of its item.
+            for row in s.execute(tab.select().order_by(tab.c.id)):
+                if row.reag_item_id not in seen_set:
+                    seen_set.add(row.reag_item_id)
+                    if not row.rejected and row.reag_item_id not in held_set and row.next_try <= now:
+                        sendlst.append(row)
+            # NOTE: end the read transaction before waiting for QAI.
+            s.commit()
+            if not sendlst:
+                break
+            reslst = qaisession.fetch_concurrently(report_one, [(row.reag_item_id, row.locid, row.op, row.idem_key)
+                                                                for row in sendlst])
+            sent_lst = []
+            for row, (resdct, err) in zip(sendlst, reslst):
+                if err is None and resdct.get('ok', False):
+                    item_dct[row.reag_item_id] = dict(ok=True)
+                    sent_lst.append(row.id)
+                    continue
+                if err is not None:
+                    resdct = dict(ok=False, msg=str(err))
+                msg = resdct.get('msg', None) or "QAI returned status {}".format(resdct.get('rcode', None))
+                item_dct[row.reag_item_id] = dict(resdct, ok=False, msg=msg)
+                held_set.add(row.reag_item_id)
+                attempts = row.attempts + 1
+                s.execute(tab.update().where(tab.c.id == row.id).values(
+                    attempts=attempts, last_error=msg,
+                    next_try=now + self._outbox_retry_delay(attempts),
+                    rejected=resdct.get('rcode', None) in OUTBOX_REJECT_CODES))
+            for ndx in range(0, len(sent_lst), IN_CLAUSE_SIZE):
+                s.execute(tab.delete().where(tab.c.id.in_(sent_lst[ndx:ndx+IN_CLAUSE_SIZE])))
+            s.commit()
+            nsent += len(sent_lst)
+            nfailed += len(sendlst) - len(sent_lst)
+        return dict(ok=nfailed == 0, nsent=nsent, nfailed=nfailed, items=item_dct)
+
+    def resolve_rejected(self, reag_item_id: int, do_retry: bool) -> int:
+        """Resolve the location changes of a reagent item that QAI has refused.
+
+        Until this is done, the later changes of the item are not reported.
+
+        Args:
+           reag_item_id: the reagent item whose rejected changes to resolve.
+           do_retry: if True, the changes are reported again. Otherwise they are discarded.
+        Returns:
+           The number of changes resolved.
+        """
+        s = self._sess
+        tab = QAIOutbox.__table__
+        where = sql.and_(tab.c.reag_item_id == reag_item_id, tab.c.rejected.is_(True))
+        with self._sess_lock:
+            if do_retry:
+                res = s.execute(tab.update().where(where).values(rejected=False, attempts=0, next_try=0.0))
+            else:
+                res = s.execute(tab.delete().where(where))
+            s.commit()
+        return res.rowcount
+
+    def get_outbox_status(self, now: typing.Optional[float] = None) -> dict:
+        """Return a summary of the location changes waiting to be reported to QAI.
+
+        Args:
+           now: the current time in seconds since the epoch. This defaults to time.time().
+        Returns:
+           A dict with the keys 'npending' (the number of changes to be reported),
+           'nretrying' (the number of those that have failed before), 'oldest' (the time
+           the oldest of those was committed, or None), 'next_try' (the number of seconds
+           until the next retry is due, or None), 'last_error' (the error of the most recently
+           committed failed change, or None) and 'rejected' (a list of dicts describing
+           the changes QAI has refused).
+        """
+        now = time.time() if now is None else now
+        s = self._sess
+        tab = QAIOutbox.__table__
+        npending = nretrying = 0
+        oldest = next_try = last_error = None
+        rejected_lst = []
+        with self._sess_lock:
+            rowlst = s.execute(tab.select().order_by(tab.c.id)).fetchall()
+            s.commit()
+        for row in rowlst:
+            if row.rejected:
+                rejected_lst.append(dict(reag_item_id=row.reag_item_id, locid=row.locid,
+                                         op=row.op, msg=row.last_error))
+                continue
+            npending += 1
+            if oldest is None:
+                oldest = timelib.datetime_to_str(row.created_at, in_local_tz=True)
+            if row.attempts > 0:
+                nretrying += 1
+                last_error = row.last_error
+                wait_secs = max(row.next_try - now, 0.0)
+                next_try = wait_secs if next_try is None else min(next_try, wait_secs)
+        return dict(npending=npending, nretrying=nretrying, oldest=oldest,
+                    next_try=next_try, last_error=last_error, rejected=rejected_lst)
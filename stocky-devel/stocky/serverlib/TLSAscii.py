@@ -16,8 +16,10 @@ Some parameters need to be enclosed in double quotes.
 import typing
 from enum import Enum
 import math
+import time
 
 import gevent
+import gevent.event
 import gevent.queue
 
 import serverlib.commlink as commlink
@@ -297,15 +299,14 @@ class RunningAve:
             ret_lst = iter([])
         else:
             eplst = clresp[commlink.EP_VAL]
-            rrlst = clresp[commlink.RI_VAL]
-            if eplst is None or rrlst is None:
-                return None
-            rilst: typing.Optional[typing.List[int]] = None
+            rilst = None
             try:
-                rilst = [int(sri) for sri in rrlst]
+                rilst = clresp.get_ri_values()
             except (ValueError, TypeError) as err:
                 logger.error("radar mode: failed to retrieve RI values {}".format(err))
-            ret_lst = zip(eplst, rilst) if rilst is not None and len(eplst) == len(rilst) else None
+            if eplst is None or rilst is None:
+                return None
+            ret_lst = zip(eplst, rilst) if len(eplst) == len(rilst) else None
         return None if ret_lst is None else dict(ret_lst)
 
     @staticmethod
@@ -362,17 +363,55 @@ class TLSReader(Taskmeister.BaseTaskMeister):
         print("TLS init")
         self.cur_state: typing.Optional[int] = None
         print("TLS init got {}".format(self.cur_state))
+        # the commands sent since begin_pipeline(), and the futures of their responses,
+        # keyed by the greenlet that called begin_pipeline().
+        self._pipelines: typing.Dict[typing.Any, typing.List[typing.Tuple[str, gevent.event.AsyncResult]]] = {}
         if cl.is_alive():
             self.bt_set_stock_check_mode()
         self.runningave = RunningAve(logger, radar_ave_num)
 
-    def _sendcmd(self, cmdstr: str, comment: str = None) -> None:
+    def _sendcmd(self, cmdstr: str, comment: typing.Optional[str] = None) -> None:
         cl = self._cl
         if cl.is_alive():
-            cl.send_cmd(cmdstr, comment)
+            pipeline = self._pipelines.get(gevent.getcurrent(), None)
+            if pipeline is None:
+                cl.send_cmd(cmdstr, comment)
+            else:
+                pipeline.append((cmdstr, cl.submit_cmd(cmdstr, comment)))
         else:
             self._log_error('commlink is not alive')
 
+    def begin_pipeline(self) -> None:
+        """Send the following commands to the RFID reader without waiting for
+        their responses, until :py:meth:`end_pipeline` is called.
+
+        The responses to these commands are not converted into messages, but
+        are returned by end_pipeline() instead.
+        Only the commands sent by the calling greenlet are pipelined: commands
+        sent by other greenlets in the meantime are handled as usual.
+        """
+        self._pipelines[gevent.getcurrent()] = []
+
+    def end_pipeline(self,
+                     timeout: typing.Optional[float] = None) -> typing.List[typing.Tuple[str, commlink.CLResponse]]:
+        """Wait for the responses to all commands sent since :py:meth:`begin_pipeline`.
+
+        Args:
+           timeout: the maximum time to wait for all responses in seconds,
+              or None to wait indefinitely.
+        Returns:
+           A list of (command string, response) tuples in the order that the
+           commands were sent. Commands whose response has not arrived when the
+           timeout expires have a time out response.
+        """
+        pipeline = self._pipelines.pop(gevent.getcurrent(), [])
+        t_end = None if timeout is None else time.monotonic() + timeout
+        resplst = []
+        for cmdstr, fut in pipeline:
+            t_left = None if t_end is None else max(t_end - time.monotonic(), 0.0)
+            resplst.append((cmdstr, self._cl.wait_cmd(fut, t_left)))
+        return resplst
+
     def is_in_radarmode(self) -> bool:
         """Is the reader in radar mode ?"""
         return self.mode == TlsMode.radar
@@ -461,7 +500,7 @@ class TLSReader(Taskmeister.BaseTaskMeister):
         #   return None the taskmeister will ignore it.
         if self.cur_state == CommonMSG.RFID_ON:
             self._log_debug("TLS before read... ")
-            clresp: commlink.CLResponse = self._cl.raw_read_response()
+            clresp: commlink.CLResponse = self._cl.read_response()
             self._log_debug("TLS got {}".format(clresp))
             return self._convert_message(clresp)
         self._log_debug("TLS state is: {}, returning None".format(self.cur_state))
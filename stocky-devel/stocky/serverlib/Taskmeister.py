@@ -10,9 +10,11 @@ import pathlib
 import gevent
 import gevent.queue
 import gevent.subprocess as subprocess
+import requests
 from webclient.commonmsg import CommonMSG
 
 import serverlib.ServerWebSocket as WS
+import serverlib.chemdb as chemdb
 
 
 # NOTE: It is important that sec_interval, the time that a task sleeps, is strictly larger
@@ -333,6 +335,66 @@ class CommandListGenerator(TickGenerator):
         return CommonMSG(CommonMSG.MSG_SV_GENERIC_COMMAND, cmdstr) if cmdstr else None
 
 
+class QAIPrefetcher(BaseTaskMeister):
+    """Check QAI for changes every sec_interval seconds while a user is logged in, and
+    download the changed tables in the background (see :meth:`chemdb.BaseDB.prefetch_qai_update`).
+    A user-requested update from QAI then only has to load the downloaded data into
+    the local database.
+    A MSG_SV_QAI_CHANGE_NOTICE message with the names of the tables downloaded
+    is generated whenever new data has been downloaded.
+    Downloaded data that has not been used within sec_interval seconds is discarded.
+    """
+    def __init__(self, msg_q: gevent.queue.Queue, logger,
+                 sec_interval: float, stockdb: chemdb.BaseDB) -> None:
+        self.stockdb = stockdb
+        super().__init__(msg_q, logger, sec_interval, True)
+
+    def generate_msg(self) -> typing.Optional[CommonMSG]:
+        try:
+            changed_lst = self.stockdb.prefetch_qai_update(max_age=self._sec_sleep)
+        except (RuntimeError, requests.exceptions.RequestException) as err:
+            self._log_warning("QAI prefetch failed: {}".format(err))
+            return None
+        if not changed_lst:
+            return None
+        self._log_debug("QAI prefetch: downloaded {}".format(changed_lst))
+        return CommonMSG(CommonMSG.MSG_SV_QAI_CHANGE_NOTICE, dict(tables=changed_lst))
+
+
+class OutboxDrainer(BaseTaskMeister):
+    """Report the location changes waiting in the outbox of the stock database to QAI
+    every sec_interval seconds while a user is logged in (see :meth:`chemdb.BaseDB.drain_outbox`).
+    A MSG_SV_OUTBOX_STATUS message describing the outbox is generated whenever
+    its state has changed.
+    Whenever location changes have been reported, a MSG_WC_STOCK_INFO_REQ is put on the
+    queue, so that the server updates its stock list from QAI and sends it to the webclient.
+    """
+    def __init__(self, msg_q: gevent.queue.Queue, logger,
+                 sec_interval: float, stockdb: chemdb.BaseDB) -> None:
+        self.stockdb = stockdb
+        self._last_status: typing.Optional[dict] = None
+        super().__init__(msg_q, logger, sec_interval, True)
+
+    def _send_progress(self, ndone: int, ntotal: int, nfailed: int) -> None:
+        self.msg_q.put(CommonMSG(CommonMSG.MSG_SV_LOCMUT_PROGRESS,
+                                 dict(ndone=ndone, ntotal=ntotal, nfailed=nfailed)))
+
+    def generate_msg(self) -> typing.Optional[CommonMSG]:
+        res = self.stockdb.drain_outbox(self._send_progress)
+        if res['nsent'] > 0 or res['nfailed'] > 0:
+            self._log_debug("outbox: reported {} location changes, {} failed, {} pending".format(
+                res['nsent'], res['nfailed'], res['npending']))
+        if res['nsent'] > 0:
+            self.msg_q.put(CommonMSG(CommonMSG.MSG_WC_STOCK_INFO_REQ, dict(do_update=True)))
+        status = self.stockdb.get_outbox_status()
+        # NOTE: the time to the next retry changes all the time: ignore it when comparing.
+        cmp_status = dict(status, next_try=None)
+        if cmp_status == self._last_status:
+            return None
+        self._last_status = cmp_status
+        return CommonMSG(CommonMSG.MSG_SV_OUTBOX_STATUS, status)
+
+
 class WebSocketReader(BaseTaskMeister):
     """The stocky server uses this Taskmeister to receive messages from the webclient
     in json format. It puts CommonMSG instances onto the queue."""
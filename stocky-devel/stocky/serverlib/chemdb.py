@@ -7,6 +7,15 @@ import typing
 import hashlib
 import json
 import datetime
+import collections
+import functools
+import sys
+import os
+import gzip
+import pickle
+import time
+
+import gevent.lock
 
 import serverlib.timelib as timelib
 import serverlib.qai_helper as qai_helper
@@ -104,14 +113,387 @@ def sortloclist(orglst: typing.List[dict]) -> typing.List[dict]:
 
 DBRecList = typing.List[typing.Dict[str, typing.Any]]
 
+# the name of the table holding the final state of each reagent item.
+# This table is derived from the reagent item status table in databases that maintain it.
+ITEM_STATE_TABLE = 'reagent_item_state'
+
+FinalStateTup = typing.Tuple[dict, bool, bool]
+FinalStateDct = typing.Dict[int, FinalStateTup]
+
 LocChangeTup = typing.Tuple[int, str]
 LocChangeList = typing.List[LocChangeTup]
 
+# a function called with the number of items done, the total number of items
+# and the number of failures while a long operation progresses.
+ProgressFunc = typing.Callable[[int, int, int], None]
+
+
+class TableDelta:
+    """Record the primary keys of the rows of a database table that were
+    inserted, updated and deleted during a delta sync from QAI.
+    """
+
+    def __init__(self) -> None:
+        self.inserted: typing.Set[int] = set()
+        self.updated: typing.Set[int] = set()
+        self.deleted: typing.Set[int] = set()
+
+    def num_changes(self) -> int:
+        """Return the total number of rows changed."""
+        return len(self.inserted) + len(self.updated) + len(self.deleted)
+
+    def changed_keys(self) -> typing.Set[int]:
+        """Return the primary keys of all rows changed."""
+        return self.inserted | self.updated | self.deleted
+
+    def merge(self, other: "TableDelta") -> None:
+        """Add the changes recorded in another TableDelta to this one."""
+        self.inserted |= other.inserted
+        self.updated |= other.updated
+        self.deleted |= other.deleted
+
+    def as_dict(self) -> typing.Dict[str, int]:
+        """Return the change counts as a dict."""
+        return dict(ninserted=len(self.inserted),
+                    nupdated=len(self.updated),
+                    ndeleted=len(self.deleted))
+
+
+# For each table, the rows changed by the last update from QAI.
+# A value of None means that the table was reloaded completely, i.e. all
+# of its rows must be considered to have changed.
+TableChangeDict = typing.Dict[str, typing.Optional[TableDelta]]
+
+
+# the fields of stock list records whose string values are interned, as they only
+# take on a small number of different values.
+INTERN_FIELDS = frozenset(['status', 'occurred', 'category', 'storage', 'basetype'])
+
+# a database record stored as a namedtuple. See compact_records().
+CompactRec = typing.Any
+
+
+@functools.lru_cache(maxsize=None)
+def _record_type(name: str, fields: typing.Tuple[str, ...]) -> typing.Any:
+    """Return the namedtuple class used to store records with these fields."""
+    return collections.namedtuple(name, fields)
+
+
+def compact_records(name: str, reclst: DBRecList) -> typing.List[CompactRec]:
+    """Convert a list of database records into namedtuples.
+
+    The field names are stored once in the namedtuple class instead of in every
+    record, and the string values of the fields in INTERN_FIELDS are interned.
+    All records in reclst must have the same keys.
+
+    Args:
+       name: the name of the namedtuple class.
+       reclst: the records to convert.
+    Returns:
+       The list of records.
+    """
+    if not reclst:
+        return []
+    fields = tuple(reclst[0].keys())
+    rectype = _record_type(name, fields)
+    intern_ndx = [ndx for ndx, k in enumerate(fields) if k in INTERN_FIELDS]
+    rlst = []
+    for r_dct in reclst:
+        vals = list(r_dct.values())
+        for ndx in intern_ndx:
+            val = vals[ndx]
+            if isinstance(val, str):
+                vals[ndx] = sys.intern(val)
+        rlst.append(rectype._make(vals))
+    return rlst
+
+
+def record_dict(rec: CompactRec) -> dict:
+    """Convert a record created by compact_records() back into a dict."""
+    return dict(zip(rec._fields, rec))
+
+
+# the format version of stock list snapshot files. This must be incremented whenever
+# the state returned by StockListBuilder.get_state() changes.
+SNAPSHOT_VERSION = 1
+
+
+def write_snapshot(fname: str, key: dict, state: dict) -> None:
+    """Write a stock list snapshot to a compressed file.
+
+    The file is first written under a temporary name and then renamed,
+    so that an existing snapshot is never left half written.
+
+    Args:
+       fname: the name of the file to write.
+       key: the dict that determines whether the snapshot is up to date.
+       state: the stock list state as returned by :meth:`StockListBuilder.get_state`.
+    """
+    tmpname = fname + '.tmp'
+    with gzip.open(tmpname, 'wb', compresslevel=6) as fo:
+        pickle.dump(dict(version=SNAPSHOT_VERSION, key=key, state=state), fo,
+                    protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmpname, fname)
+
+
+def read_snapshot(fname: str) -> typing.Optional[typing.Tuple[dict, dict]]:
+    """Read a stock list snapshot written by :func:`write_snapshot`.
+
+    Returns:
+       The key and state of the snapshot, or None if the file does not exist,
+       cannot be read or has a different format version.
+    """
+    try:
+        with gzip.open(fname, 'rb') as fi:
+            snap_dct = pickle.load(fi)
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError, IndexError):
+        return None
+    if not isinstance(snap_dct, dict) or snap_dct.get('version', None) != SNAPSHOT_VERSION:
+        return None
+    return snap_dct['key'], snap_dct['state']
+
+
+class StockListBuilder:
+    """Build the stock list for the webclient from the database tables, and
+    keep it up to date by recomputing only those parts of it that depend on
+    tables that have changed.
+
+    The stock list consists of the output structures 'loclst', 'locdct', 'ritemdct'
+    and 'reagentdct' (see :meth:`BaseDB._do_generate_webclient_stocklist`).
+    The tables that each of these are computed from are defined in DEPENDS_DCT.
+
+    In order to save memory, reagents, reagent items and their states are kept as
+    records created by :func:`compact_records`. The dicts sent to the webclient are only
+    created by :meth:`get_stocklist`.
+    """
+    _S = qai_helper.QAISession
+    DEPENDS_DCT = {'loclst': frozenset([_S.QAIDCT_LOCATIONS]),
+                   'locdct': frozenset([_S.QAIDCT_LOCATIONS, _S.QAIDCT_REAGENT_ITEMS]),
+                   'ritemdct': frozenset([_S.QAIDCT_REAGENT_ITEMS, _S.QAIDCT_REAITEM_STATUS,
+                                          ITEM_STATE_TABLE]),
+                   'reagentdct': frozenset([_S.QAIDCT_REAGENTS])}
+
+    def __init__(self, db: "BaseDB") -> None:
+        """
+        Args:
+           db: the database to retrieve the table data from.
+        """
+        self._db = db
+        self._is_built = False
+        self._loclst: typing.List[dict] = []
+        self._locdct: typing.Dict[int, typing.Tuple[dict, typing.List[CompactRec]]] = {}
+        self._itmlst: typing.List[CompactRec] = []
+        self._itmdct: typing.Dict[int, CompactRec] = {}
+        self._rfiddct: typing.Dict[str, CompactRec] = {}
+        self._ritemdct: typing.Dict[int, typing.Tuple[CompactRec, typing.Tuple[CompactRec, bool, bool]]] = {}
+        self._reagentdct: typing.Dict[int, CompactRec] = {}
+        # the number of final states calculated and the output structures
+        # recomputed in the last call to build()
+        self.num_final_states = 0
+        self.last_rebuilt: typing.Set[str] = set()
+
+    def get_stocklist(self) -> dict:
+        """Return the current stock list as the dicts sent to the webclient.
+        These are created anew on every call and are not kept by the builder."""
+        itm_dct = {reag_item.id: record_dict(reag_item) for reag_item in self._itmlst}
+        locdct = {loc_id: (location, [itm_dct[reag_item.id] for reag_item in itmlst])
+                  for loc_id, (location, itmlst) in self._locdct.items()}
+        ritemdct = {reag_item_id: (itm_dct[reag_item_id], (record_dict(nom_state), ismissing, hasexpired))
+                    for reag_item_id, (reag_item, (nom_state, ismissing, hasexpired)) in self._ritemdct.items()}
+        reagentdct = {reagent_id: record_dict(reagent) for reagent_id, reagent in self._reagentdct.items()}
+        return {"loclst": self._loclst, "locdct": locdct,
+                "ritemdct": ritemdct, "reagentdct": reagentdct}
+
+    def is_built(self) -> bool:
+        """Return: the stock list has been built or restored from a snapshot."""
+        return self._is_built
+
+    def get_state(self) -> dict:
+        """Return the state of the builder in a form that can be stored in a snapshot.
+        This consists of lists and dicts of plain python values only.
+        """
+        return dict(loclst=self._loclst,
+                    items=[record_dict(reag_item) for reag_item in self._itmlst],
+                    locdct={loc_id: (location, [reag_item.id for reag_item in itmlst])
+                            for loc_id, (location, itmlst) in self._locdct.items()},
+                    ritemdct={reag_item_id: (record_dict(nom_state), ismissing, hasexpired)
+                              for reag_item_id, (reag_item, (nom_state, ismissing, hasexpired))
+                              in self._ritemdct.items()},
+                    reagents=[record_dict(reagent) for reagent in self._reagentdct.values()])
+
+    def set_state(self, state: dict) -> None:
+        """Restore the state of the builder from one returned by :meth:`get_state`.
+        The builder is then regarded as built.
+        """
+        self._loclst = state['loclst']
+        self._itmlst = itmlst = compact_records('ReagentItem', state['items'])
+        self._itmdct = itmdct = {reag_item.id: reag_item for reag_item in itmlst}
+        self._rfiddct = {reag_item.rfid: reag_item for reag_item in itmlst}
+        self._locdct = {loc_id: (location, [itmdct[reag_item_id] for reag_item_id in id_lst])
+                        for loc_id, (location, id_lst) in state['locdct'].items()}
+        self._ritemdct = {}
+        for reag_item_id, (nom_state, ismissing, hasexpired) in state['ritemdct'].items():
+            nom_rec = compact_records('ItemState', [nom_state])[0]
+            self._ritemdct[reag_item_id] = (itmdct[reag_item_id], (nom_rec, ismissing, hasexpired))
+        self._reagentdct = {reagent.id: reagent for reagent in compact_records('Reagent', state['reagents'])}
+        self._is_built = True
+        self.num_final_states = 0
+        self.last_rebuilt = set()
+
+    def build(self, tab_changes: typing.Optional[TableChangeDict]) -> typing.Set[str]:
+        """Bring the stock list up to date.
+
+        Args:
+           tab_changes: the tables that have changed since the last call.
+              If this is None, or the stock list has never been built, the stock list is
+              built from scratch.
+        Returns:
+           The names of the output structures that were recomputed.
+        """
+        if tab_changes is None or not self._is_built:
+            tab_changes = {k: None for k in qai_helper.QAISession.qai_key_lst}
+        changed_set = set(tab_changes.keys())
+        stale_set = set([k for k, dset in StockListBuilder.DEPENDS_DCT.items() if dset & changed_set])
+        S = qai_helper.QAISession
+        self.num_final_states = 0
+        if S.QAIDCT_REAGENT_ITEMS in tab_changes:
+            self._load_items()
+        if 'locdct' in stale_set:
+            self._build_locations()
+        if 'ritemdct' in stale_set:
+            self._calc_ritems(self._affected_items(tab_changes))
+        if 'reagentdct' in stale_set:
+            self._build_reagents()
+        self._is_built = True
+        self.last_rebuilt = stale_set
+        return stale_set
+
+    def _load_items(self) -> None:
+        """Retrieve all reagent items."""
+        dctlst = self._db.get_reagent_item_list()
+        for reag_item in dctlst:
+            if reag_item.get('rfid', None) is None:
+                raise RuntimeError("found None RFID {}".format(reag_item))
+        self._itmlst = itmlst = compact_records('ReagentItem', dctlst)
+        self._itmdct = {reag_item.id: reag_item for reag_item in itmlst}
+        self._rfiddct = {reag_item.rfid: reag_item for reag_item in itmlst}
+
+    def lookup_rfids(self, rfidlst: typing.List[str]) -> typing.Dict[str, typing.Optional[dict]]:
+        """Look up the reagent items with the given RFIDs in the RFID index.
+        The index is only as up to date as the most recent call to :meth:`build`.
+
+        Returns:
+           A dict with the RFIDs as keys and the reagent item records as values.
+           The value is None for an RFID that is not in the index.
+        """
+        rfiddct = self._rfiddct
+        rdct: typing.Dict[str, typing.Optional[dict]] = {}
+        for rfid in rfidlst:
+            reag_item = rfiddct.get(rfid, None)
+            rdct[rfid] = None if reag_item is None else record_dict(reag_item)
+        return rdct
+
+    def _build_locations(self) -> None:
+        """Create the sorted location list and a Dict[locationid, Tuple[locrecord, List[reagentitem]]]."""
+        loclst = self._db.get_location_list()
+        # create a Dict[locationid, List[reagentitem]]
+        d_d: typing.Dict[typing.Optional[int], typing.List[CompactRec]] = {}
+        for reag_item in self._itmlst:
+            loc_id = getattr(reag_item, 'qcs_location_id', None)
+            # we will keep a list of items with None locations... should not happen, but does
+            # then we add these to the UNKNOWN list later on
+            d_d.setdefault(loc_id, []).append(reag_item)
+        # unmangling for None...
+        # find loc_id for 'UNKNOWN'...
+        if None in d_d:
+            none_lst = d_d[None]
+            del d_d[None]
+            flst = [loc for loc in loclst if loc['name'] == 'UNKNOWN']
+            assert len(flst) == 1, "cannot determine 'UNKNOWN' location"
+            unknown_lst = d_d.setdefault(flst[0]['id'], [])
+            unknown_lst.extend(none_lst)
+        #
+        # NOW, create a Dict[locationid, Tuple[locrecord, List[reagentitem]]]
+        # which we send to the client
+        r_r: typing.Dict[int, typing.Tuple[dict, typing.List[CompactRec]]] = {}
+        for location in loclst:
+            locid: int = location['id']
+            r_r[locid] = (location, d_d.get(locid, []))
+        assert len(r_r) == len(loclst), "problem with location ids!"
+        self._locdct = r_r
+        # finally, sort the loclst according to a hierarchy
+        self._loclst = sortloclist(loclst)
+
+    def _affected_items(self, tab_changes: TableChangeDict) -> typing.Optional[typing.Set[int]]:
+        """Determine the reagent items whose final state must be reevaluated.
+
+        Returns:
+           The ids of the reagent items affected, or None if all of them are.
+        """
+        S = qai_helper.QAISession
+        if S.QAIDCT_REAITEM_STATUS in tab_changes and not self._db.HAS_ITEM_STATE_TABLE:
+            # we cannot tell which reagent items the status records belong to.
+            return None
+        affected: typing.Set[int] = set()
+        for k in (S.QAIDCT_REAGENT_ITEMS, ITEM_STATE_TABLE):
+            if k in tab_changes:
+                tdelta = tab_changes[k]
+                if tdelta is None:
+                    return None
+                affected |= tdelta.changed_keys()
+        return affected
+
+    def _calc_ritems(self, affected: typing.Optional[typing.Set[int]]) -> None:
+        """Retrieve the final state of the affected reagent items and add or
+        remove them from the ritemdct accordingly.
+        If affected is None, all reagent items are retrieved.
+        """
+        state_dct = self._db.get_final_state_dct(affected)
+        self.num_final_states = len(state_dct)
+        if affected is None:
+            self._ritemdct = {}
+            affected_iter: typing.Iterable[int] = self._itmdct.keys()
+        else:
+            # also drop the items that are no longer in the database but were not
+            # deleted by these changes. This happens when the stock list was restored
+            # from an out of date snapshot.
+            affected_iter = affected | (self._ritemdct.keys() - self._itmdct.keys())
+        for reag_item_id in affected_iter:
+            reag_item = self._itmdct.get(reag_item_id, None)
+            state_info = state_dct.get(reag_item_id, None)
+            # we eliminate any reagent item that has a state of 'USED_UP'.
+            if reag_item is None or state_info is None or state_info[0]['status'] == 'USED_UP':
+                self._ritemdct.pop(reag_item_id, None)
+            else:
+                nom_state, ismissing, hasexpired = state_info
+                nom_rec = compact_records('ItemState', [nom_state])[0]
+                self._ritemdct[reag_item_id] = (reag_item, (nom_rec, ismissing, hasexpired))
+
+    def _build_reagents(self) -> None:
+        """Create a Dict[reagentid, reagent]"""
+        rl = self._db.get_reagent_list()
+        for reagent in rl:
+            # delete the legacy location field in reagents...
+            reagent.pop('location', None)
+            if reagent.get('id', None) is None:
+                raise RuntimeError("reagent ID is None")
+        rg = {reagent.id: reagent for reagent in compact_records('Reagent', rl)}
+        assert len(rg) == len(rl), "problem with reagent ids!"
+        self._reagentdct = rg
+
 
 class BaseDB:
     """Define some common operations between databases. This includes
     how to interact with QAI via HTTP requests.
     """
+    # the scores used to rank the status records of a reagent item in calc_final_state().
+    # Status records with other status values are ignored.
+    STATUS_SCORE_DCT = dict(MISSING=-1, MADE=0, VALIDATED=1, IN_USE=2,
+                            USED_UP=5, EXPIRED=6, RUO_EXPIRED=7, DISPOSED=8)
+
+    # whether the database maintains a table of the final state of each reagent item,
+    # and records changes to it under ITEM_STATE_TABLE in its table changes.
+    HAS_ITEM_STATE_TABLE = False
 
     def __init__(self,
                  qaisession: typing.Optional[qai_helper.QAISession],
@@ -131,7 +513,29 @@ class BaseDB:
         timelib.set_local_timezone(tz_name)
         self._current_date = timelib.loc_nowtime().date()
         self._db_has_changed = True
-        self._cachedct: typing.Optional[dict] = None
+        self._table_changes: TableChangeDict = {}
+        # the table changes not yet taken into account in the stock list.
+        # None means that the stock list must be built from scratch.
+        self._pending_changes: typing.Optional[TableChangeDict] = None
+        self._load_errors: typing.Dict[str, str] = {}
+        self._builder = StockListBuilder(self)
+        # QAI data downloaded by prefetch_qai_update(): the table time stamps of the
+        # database when the download started, the data, the tables downloaded and the
+        # time.monotonic() at which data was last added.
+        self._staged: typing.Optional[typing.Tuple[qai_helper.QAIChangedct,
+                                                   qai_helper.QAIDataset,
+                                                   qai_helper.QAIUpdatedct,
+                                                   float]] = None
+        # the table time stamps of the database and of the QAI data when the staged data
+        # was last discarded by prefetch_qai_update() for being too old.
+        self._dropped_stamps: typing.Optional[typing.Tuple[qai_helper.QAIChangedct,
+                                                           qai_helper.QAIChangedct]] = None
+        # set while drain_outbox() is reporting location changes to QAI
+        self._draining = False
+        # held by the greenlet using the database session while it waits for QAI, e.g.
+        # when streaming tables into the database, so that other greenlets (the outbox
+        # drainer) do not commit a transaction that is still in progress.
+        self._sess_lock = gevent.lock.RLock()
 
     def has_changed(self) -> bool:
         """Return : the database has changed since the last time
@@ -146,50 +550,212 @@ class BaseDB:
         """
         raise NotImplementedError("not implemented")
 
-    def update_from_qai(self) -> dict:
+    def get_table_changes(self) -> TableChangeDict:
+        """Return the changes made to the database tables by the last
+        call to :meth:`load_qai_data`.
+
+        Returns:
+           The keys are the names of the tables that were updated.
+           The values are :class:`TableDelta` instances for tables loaded in delta sync
+           mode, or None for tables that were reloaded from scratch.
+        """
+        return self._table_changes
+
+    def get_load_errors(self) -> typing.Dict[str, str]:
+        """Return the tables that could not be loaded by the last call to
+        :meth:`load_qai_data` because streaming them from QAI failed.
+
+        Returns:
+           A dict with the table names as keys and error messages as values.
+        """
+        return self._load_errors
+
+    def _record_table_changes(self, tab_changes: TableChangeDict) -> None:
+        """Record the changes made to the database tables by load_qai_data().
+        This must be called by subclasses after loading data.
+        The database is marked as changed if any rows have actually changed.
+        """
+        self._table_changes = tab_changes
+        self._add_pending_changes(tab_changes)
+
+    def _add_pending_changes(self, tab_changes: TableChangeDict) -> None:
+        """Add table changes to those that the stock list has not yet been updated with."""
+        rows_changed = BaseDB._merge_changes(self._pending_changes, tab_changes)
+        self._db_has_changed = self._db_has_changed or rows_changed
+
+    @staticmethod
+    def _merge_changes(pend_dct: typing.Optional[TableChangeDict], tab_changes: TableChangeDict) -> bool:
+        """Merge tab_changes into pend_dct, unless this is None.
+
+        Returns:
+           True iff any rows have actually changed.
+        """
+        rows_changed = False
+        for k, tdelta in tab_changes.items():
+            if tdelta is not None and tdelta.num_changes() == 0:
+                continue
+            rows_changed = True
+            if pend_dct is not None:
+                old_delta = pend_dct.get(k, TableDelta())
+                if old_delta is None or tdelta is None:
+                    pend_dct[k] = None
+                else:
+                    old_delta.merge(tdelta)
+                    pend_dct[k] = old_delta
+        return rows_changed
+
+    def update_from_qai(self, stream: bool = False) -> dict:
         """Update the local ChemStock database using the qaisession.
+           Args:
+              stream: stream the out of date tables from QAI into the database
+                 instead of downloading them into memory first
+                 (see :meth:`qai_helper.QAISession.clever_update_qai_dump`).
            Returns:
               A dict describing what happened (success, error messages)
+           Note:
+              The database session is locked while the tables are loaded: see _sess_lock.
+        """
+        with self._sess_lock:
+            qaisession = self.qaisession
+            if qaisession is None or not qaisession.is_logged_in():
+                return dict(ok=False, msg="User not logged in")
+            # get the locally stored timestamp data from our database
+            cur_tsdata = self.get_ts_data()
+            # start from the data prefetched from QAI, if any. Only the tables that have
+            # changed since then are downloaded.
+            newds, staged_dct = self._take_staged_update(cur_tsdata)
+            # load those parts from QAI that are out of date
+            try:
+                update_dct = qaisession.clever_update_qai_dump(newds, stream=stream)
+            except RuntimeError as err:
+                return dict(ok=False, msg="QAI access error: {}".format(str(err)))
+            for k, was_staged in staged_dct.items():
+                update_dct[k] = update_dct[k] or was_staged
+            retdct = self._load_qai_update(newds, update_dct)
+            # the tables that could be downloaded are loaded even if others failed.
+            err_dct = dict(qaisession.get_fetch_errors())
+            err_dct.update(self.get_load_errors())
+            if err_dct and retdct['ok']:
+                retdct['ok'] = False
+                retdct['msg'] = "QAI access error: failed to update tables {}. {}".format(
+                    ", ".join(sorted(err_dct)), retdct['msg'])
+            return retdct
+
+    def prefetch_qai_update(self, max_age: typing.Optional[float] = None) -> typing.List[str]:
+        """Download the tables that have changed on QAI since the last update
+        (or the last prefetch) and keep them in memory, so that the next call
+        to :meth:`update_from_qai` only has to load them into the database.
+
+        Args:
+           max_age: if provided, data that was staged more than max_age seconds ago,
+              and has not been added to since, is discarded in order to free its memory.
+              The same changes are then not downloaded again by a prefetch, but only
+              when QAI changes again or by update_from_qai().
+        Returns:
+           The names of the tables that were downloaded by this call.
+        Raises:
+           RuntimeError: if QAI cannot be accessed.
         """
         qaisession = self.qaisession
         if qaisession is None or not qaisession.is_logged_in():
-            return dict(ok=False, msg="User not logged in")
-        # get the locally stored timestamp data from our database
+            return []
         cur_tsdata = self.get_ts_data()
-        try:
-            newds = qai_helper.QAIDataset(None, cur_tsdata)
-        except RuntimeError as err:
-            return dict(ok=False, msg="QAI access error: {}".format(str(err)))
-        # load those parts from QAI that are out of date
+        staged = self._staged
+        if staged is not None and staged[0] != cur_tsdata:
+            # the database has been loaded since: the staged data is of no use.
+            self._staged = staged = None
+        if staged is not None and max_age is not None and time.monotonic() - staged[3] > max_age:
+            self._staged = None
+            self._dropped_stamps = (cur_tsdata, dict(staged[1].get_timestamp()))
+            return []
+        if staged is not None:
+            old_ds, old_dct = staged[1], staged[2]
+        else:
+            dropped = self._dropped_stamps
+            if dropped is not None and dropped[0] == cur_tsdata:
+                qai_tsdata = qaisession.get_qai_changedata()
+                if all(qai_tsdata.get(k, None) == v for k, v in dropped[1].items()):
+                    return []
+            old_ds, old_dct = qai_helper.QAIDataset(None, dict(cur_tsdata)), {}
+        # NOTE: download into a copy: update_from_qai() may take the staged data
+        # while we are waiting for QAI.
+        newds = qai_helper.QAIDataset(dict(old_ds.get_data()), dict(old_ds.get_timestamp()))
         update_dct = qaisession.clever_update_qai_dump(newds)
+        changed_lst = [k for k, did_update in update_dct.items() if did_update]
+        if changed_lst and self.get_ts_data() == cur_tsdata:
+            staged_dct = {k: update_dct[k] or old_dct.get(k, False) for k in update_dct}
+            self._staged = (cur_tsdata, newds, staged_dct, time.monotonic())
+            self._dropped_stamps = None
+            return changed_lst
+        return []
+
+    def has_staged_update(self) -> bool:
+        """Return: data prefetched from QAI is waiting to be loaded by :meth:`update_from_qai`."""
+        return self._staged is not None and self._staged[0] == self.get_ts_data()
+
+    def _take_staged_update(self, cur_tsdata: qai_helper.QAIChangedct) -> typing.Tuple[qai_helper.QAIDataset,
+                                                                                       qai_helper.QAIUpdatedct]:
+        """Remove the prefetched QAI data and return it together with the tables that were
+        downloaded. If the data was not prefetched for the current database state,
+        an empty dataset with the time stamps cur_tsdata is returned instead."""
+        staged, self._staged = self._staged, None
+        self._dropped_stamps = None
+        if staged is None or staged[0] != cur_tsdata:
+            return qai_helper.QAIDataset(None, dict(cur_tsdata)), {}
+        return staged[1], staged[2]
+
+    def _load_qai_update(self, newds: qai_helper.QAIDataset,
+                         update_dct: qai_helper.QAIUpdatedct) -> dict:
+        """Load the tables retrieved from QAI by update_from_qai() and
+        return a dict describing what happened."""
         # if any value is True, then we did get something from QAI...
         num_updated = sum(update_dct.values())
         if num_updated > 0:
             try:
-                self._db_has_changed = self.load_qai_data(newds, update_dct)
+                self.load_qai_data(newds, update_dct, delta_sync=True)
             except TypeError as err:
                 return dict(ok=False, msg="database error: {}".format(str(err)))
+            tab_changes = self.get_table_changes()
+            cnt_dct = dict(ninserted=0, nupdated=0, ndeleted=0)
+            for k, tdelta in tab_changes.items():
+                if tdelta is not None and k in qai_helper.QAISession.qai_key_set:
+                    for k, val in tdelta.as_dict().items():
+                        cnt_dct[k] += val
+            return dict(ok=True,
+                        msg="Successfully updated {} tables for QAI ({} rows inserted, "
+                        "{} updated, {} deleted)".format(num_updated, cnt_dct['ninserted'],
+                                                         cnt_dct['nupdated'], cnt_dct['ndeleted']),
+                        changes={k: (None if tdelta is None else tdelta.as_dict())
+                                 for k, tdelta in tab_changes.items()
+                                 if k in qai_helper.QAISession.qai_key_set})
         return dict(ok=True, msg="Successfully updated {} tables for QAI".format(num_updated))
 
     def load_qai_data(self,
                       qai_ds: qai_helper.QAIDataset,
-                      update_dct: typing.Optional[qai_helper.QAIUpdatedct] = None) -> bool:
+                      update_dct: typing.Optional[qai_helper.QAIUpdatedct] = None,
+                      delta_sync: bool = False) -> bool:
         """Replace the complete database contents with the data contained in qai_ds.
         If update_dct is provided, only update those tables for which
         update_dct[idname] is True.
+        The changes made are recorded and can be retrieved with :meth:`get_table_changes`.
 
         Args:
            qai_ds: the dataset provided by from QAI.
            update_dct: indicate those tables that need updating.
+           delta_sync: if True, compare the data with the current table contents
+              by primary key and only apply the inserts, updates and deletes required.
+              Otherwise, empty the tables and reload them from scratch.
         Returns:
            'the update was successful'.
+        Note:
+           Implementations must call :meth:`_record_table_changes` after loading.
         """
         raise NotImplementedError('override this in subclasses')
 
-    def calc_final_state(self, slst: typing.List[dict]) -> typing.Tuple[dict, bool, bool]:
-        """ Calculate the final state from this list of states.
-        We return the nominal state record and two booleans:
-        ismissing, hasexpired.
+    @staticmethod
+    def final_state_records(slst: typing.List[dict]) -> typing.Tuple[dict, dict, bool]:
+        """Determine the nominal state record and the expiry record from this list of states.
+        We return the nominal state record, the expiry record and a boolean ismissing.
 
         Strategy: we assign values to the various possible states and sort according
         to these values.
@@ -206,8 +772,7 @@ class BaseDB:
             # if exp_dict['status'] != 'EXPIRED':
             #    raise RuntimeError('exp_dict is not expired {}'.format(exp_dict))
         else:
-            odct = dict(MISSING=-1, MADE=0, VALIDATED=1, IN_USE=2,
-                        USED_UP=5, EXPIRED=6, RUO_EXPIRED=7, DISPOSED=8)
+            odct = BaseDB.STATUS_SCORE_DCT
             # create tuples of input dicts with scores from odct.
             try:
                 plst = [(d, odct.get(d['status'], None)) for d in slst]
@@ -218,15 +783,33 @@ class BaseDB:
             exp_dict = qlst[-1][0]
             nom_state = qlst[-2][0]
             ismissing = qlst[0][0]['status'] == 'MISSING'
-        # we could have no expired record, but a used up record instead.
+        return nom_state, exp_dict, ismissing
+
+    @staticmethod
+    def expiry_date_string(exp_dict: dict) -> typing.Optional[str]:
+        """Return the expiry date of an expiry record of the form '2011-04-20',
+        or None if the record is not an EXPIRED record (e.g. a USED_UP record).
+        The 'occurred' field of exp_dict must already have been converted to a date.
+        """
         exp_state = exp_dict.get('status', None)
         if exp_state is None:
             raise RuntimeError("status field missing in state record {}".format(exp_dict))
-        elif exp_state == 'EXPIRED':
+        return exp_dict['occurred'] if exp_state == 'EXPIRED' else None
+
+    def calc_final_state(self, slst: typing.List[dict]) -> FinalStateTup:
+        """ Calculate the final state from this list of states.
+        We return the nominal state record and two booleans:
+        ismissing, hasexpired.
+        See :meth:`final_state_records` for how the records are determined.
+        """
+        nom_state, exp_dict, ismissing = BaseDB.final_state_records(slst)
+        # we could have no expired record, but a used up record instead.
+        expiry_str = BaseDB.expiry_date_string(exp_dict)
+        if expiry_str is not None:
             # Cannot use fromisoformat in 3.6...
             # expiry_date = datetime.date.fromisoformat(exp_dict['occurred'])
             # the string is of the form '2011-04-20'
-            expiry_date = datetime.date(*[int(s) for s in exp_dict['occurred'].split('-')])
+            expiry_date = datetime.date(*[int(s) for s in expiry_str.split('-')])
             has_expired = expiry_date < self._current_date
         else:
             has_expired = False
@@ -247,10 +830,63 @@ class BaseDB:
         """Return a list of all reagent item statuses."""
         raise NotImplementedError('not implemented')
 
+    def get_final_state_dct(self, item_ids: typing.Optional[typing.Set[int]]) -> FinalStateDct:
+        """Return the final state of reagent items as determined by :meth:`calc_final_state`.
+
+        Args:
+           item_ids: the ids of the reagent items required. If this is None,
+              the final states of all reagent items are returned.
+        Returns:
+           A dict with reagent item ids as keys. Reagent items without status records are absent.
+           The 'occurred' field of the nominal state records is converted to a simple date, i.e.
+           'occurred': '2011-04-20T00:00:00Z'  -> '2011-04-20'
+
+        Note:
+           This implementation calculates the final states from all status records.
+           Databases with HAS_ITEM_STATE_TABLE set override this to look up the
+           precomputed states.
+        """
+        z_z: typing.Dict[int, typing.List[dict]] = {}
+        for state in self.get_reagent_item_status_list():
+            reag_item_id = state['qcs_reag_item_id']
+            if item_ids is None or reag_item_id in item_ids:
+                state['occurred'] = state['occurred'].split('T')[0]
+                z_z.setdefault(reag_item_id, []).append(state)
+        rdct: FinalStateDct = {}
+        for reag_item_id, state_lst in z_z.items():
+            state_lst.sort(key=lambda a: a['id'])
+            rdct[reag_item_id] = self.calc_final_state(state_lst)
+        return rdct
+
+    def _update_expiry_flags(self) -> typing.Optional[TableDelta]:
+        """Recompute the hasexpired flags of the reagent items after the current date has changed.
+
+        Returns:
+           The reagent items whose hasexpired flag has changed, or None if this is not known.
+        """
+        return None
+
     def get_reagent_list(self) -> DBRecList:
         """Return a list of all reagents."""
         raise NotImplementedError('not implemented')
 
+    def get_reagent_items_at_location(self, locid: int) -> DBRecList:
+        """Return a list of the reagent items at a location."""
+        raise NotImplementedError('not implemented')
+
+    def get_reagent_items_of_reagent(self, reag_id: int) -> DBRecList:
+        """Return a list of the reagent items of a reagent."""
+        raise NotImplementedError('not implemented')
+
+    def get_reagent_items_by_rfid(self, rfids: typing.Iterable[str]) -> DBRecList:
+        """Return a list of the reagent items with the given RFIDs.
+        RFIDs that are not in the database are ignored."""
+        raise NotImplementedError('not implemented')
+
+    def get_reagent_item_status_list_for_items(self, item_ids: typing.Iterable[int]) -> DBRecList:
+        """Return a list of the statuses of the given reagent items."""
+        raise NotImplementedError('not implemented')
+
     def _do_generate_webclient_stocklist(self) -> dict:
         """Generate the stock list in a form required by the web client.
 
@@ -303,113 +939,60 @@ class BaseDB:
             'needs_validation': None,
             'notes': None, 'qcs_document_id': None,
             'storage': '-20 C', 'supplier': None}
+
+        Note:
+           This builds the stock list from scratch. See :class:`StockListBuilder`.
         """
-        # NOTE: as we want dicts and not Location instances, we go directly to
-        # the 'SQL level' (session.execute() and not the 'ORM level' (session.query())
-        # of sqlquery.
-        loclst = self.get_location_list()
-        itmlst = self.get_reagent_item_list()
-        itmstat = self.get_reagent_item_status_list()
-
-        # create a Dict[locationid, List[reagentitem]] and a Dict[RFID, reagentitem]
-        d_d: typing.Dict[typing.Optional[int], typing.List[dict]] = {}
-        # rfid_reagitem_dct = ff = {}
-        f_f: typing.Dict[str, dict] = {}
-        for reag_item in itmlst:
-            loc_id = reag_item.get('qcs_location_id', None)
-            # we will keep a list of items with None locations... should not happen, but does
-            # then we add these to the UNKNOWN list later on
-            d_d.setdefault(loc_id, []).append(reag_item)
-            # if loc_id is not None:
-            # else:
-            #    raise RuntimeError("found None location {}".format(reag_item))
-            #
-            rfidstr = reag_item.get('rfid', None)
-            if rfidstr is not None:
-                if rfidstr != 'REPLACE ME':
-                    f_f.setdefault(rfidstr, reag_item)
-            else:
-                raise RuntimeError("found None location {}".format(reag_item))
-        # unmangling for None...
-        # find loc_id for 'UNKNOWN'...
-        if None in d_d:
-            none_lst = d_d[None]
-            del d_d[None]
-            flst = [loc for loc in loclst if loc['name'] == 'UNKNOWN']
-            assert len(flst) == 1, "cannot determine 'UNKNOWN' location"
-            unknown_lst = d_d.setdefault(flst[0]['id'], [])
-            unknown_lst.extend(none_lst)
-        #
-        # NOW, create a Dict[locationid, Tuple[locrecord, List[reagentitem]]]
-        # which we send to the client
-        r_r: typing.Dict[int, typing.Tuple[dict, typing.List[dict]]] = {}
-        locid_reagitem_dct = r_r
-        for location in loclst:
-            loc_id = location.get('id', None)
-            r_r[loc_id] = (location, d_d.get(loc_id, []))
-        assert len(r_r) == len(loclst), "problem with location ids!"
-        #
-        # collect the state records for each reagent item...
-        z_z: typing.Dict[int, list] = {}
-        for state in itmstat:
-            reag_item_id = state['qcs_reag_item_id']
-            # we want to replace the occurred timedate entry with a simple date
-            # to present to the user, i.e.
-            # 'occurred': '2011-04-20T00:00:00Z'  -> '2011-04-20'
-            dstr = state['occurred']
-            state['occurred'] = dstr.split('T')[0]
-            z_z.setdefault(reag_item_id, []).append(state)
-        # and evaluate the 'final state' for each reagent item
-        ritemdct = {}
-        for reag_item in itmlst:
-            reag_item_id = reag_item['id']
-            state_lst = z_z.get(reag_item_id, None)
-            if state_lst is None:
-                state_info = None
-            else:
-                state_info = self.calc_final_state(state_lst)
-                # print("BLAAA {} {}".format(reag_item_id, state_info))
-                # we eliminate any reagent item that has a state of 'USED_UP'.
-                dct, ismissing, hasexpired = state_info
-                state_info = None if dct['status'] == 'USED_UP' else state_info
-            if state_info is not None:
-                ritemdct[reag_item_id] = (reag_item, state_info)
-            # else:
-            # print("skipping {}".format(reag_item))
-        # create a Dict[reagentid, reagent]
-        rl = self.get_reagent_list()
-        rg = {}
-        for reagent in rl:
-            # delete the legacy location field in reagents...
-            reagent.pop('location', None)
-            reagent_id = reagent.get('id', None)
-            if reagent_id is not None:
-                rg[reagent_id] = reagent
-            else:
-                raise RuntimeError("reagent ID is None")
-        assert len(rg) == len(rl), "problem with reagent ids!"
-        # "itmstatlst": itmstat,
-        # finally, sort the loclst according to a hierarchy
-        loclst = sortloclist(loclst)
-        # , "rfiddct": rfid_reagitem_dct}
-        return {"loclst": loclst, "locdct": locid_reagitem_dct,
-                "ritemdct": ritemdct, "reagentdct": rg}
+        self._builder.build(None)
+        return self._builder.get_stocklist()
 
     def generate_webclient_stocklist(self) -> dict:
         """Generate the chemical stock list in a form suitable for the webclient.
 
+        Only those parts of the stock list that depend on database tables
+        that have changed since the last call are recomputed.
+
         Returns:
            The dict of stock items for the webclient.
 
         Raises:
            RuntimeError: if the update from QAI failed.
         """
-        if self._db_has_changed:
-            self._cachedct = self._do_generate_webclient_stocklist()
-            self._db_has_changed = False
-        if self._cachedct is None:
-            raise RuntimeError('Internal error')
-        return self._cachedct
+        self._update_stocklist()
+        return self._builder.get_stocklist()
+
+    def _update_stocklist(self) -> bool:
+        """Bring the stock list builder up to date with the database.
+
+        Returns:
+           True iff the stock list was rebuilt.
+        """
+        today = timelib.loc_nowtime().date()
+        if today != self._current_date:
+            self._current_date = today
+            self._add_pending_changes({ITEM_STATE_TABLE: self._update_expiry_flags()})
+        if not self._db_has_changed:
+            return False
+        self._builder.build(self._pending_changes)
+        self._pending_changes = {}
+        self._db_has_changed = False
+        return True
+
+    def lookup_rfids(self, rfidlst: typing.List[str]) -> typing.Dict[str, typing.Optional[dict]]:
+        """Determine the reagent items that a list of RFIDs belong to,
+        e.g. those detected during an inventory scan.
+
+        The RFIDs are looked up in an index that is updated together with the
+        webclient stock list whenever the reagent item table changes.
+
+        Args:
+           rfidlst: the RFIDs to look up.
+        Returns:
+           A dict with the RFIDs as keys and the reagent item records as values.
+           The value is None for an RFID that is not in the database.
+        """
+        self._update_stocklist()
+        return self._builder.lookup_rfids(rfidlst)
 
     # location changes ---
     def reset_loc_changes(self) -> None:
@@ -490,12 +1073,35 @@ class BaseDB:
         """
         raise NotImplementedError('not implemented')
 
-    def perform_loc_changes(self, move_dct: dict) -> dict:
+    def perform_loc_changes(self, move_dct: dict,
+                            progress_func: typing.Optional[ProgressFunc] = None) -> dict:
         """
-         * Report the required changes from the list provided to QAI.
-         * Update the local Locmutation table accordingly
-         * Purge successfully recorded locmutations
-         * Replenish our DB from QAI.
+         * Commit the required changes from the list provided to the outbox.
+         * Report the changes in the outbox to QAI.
          * Return a dict in response (success/failure)
         """
         raise NotImplementedError('not implemented')
+
+    def commit_loc_changes(self, move_dct: dict) -> dict:
+        """Move the location changes in move_dct from the location change table
+        to the outbox of changes to be reported to QAI.
+        Return a dict in response (success/failure).
+        """
+        raise NotImplementedError('not implemented')
+
+    def drain_outbox(self, progress_func: typing.Optional[ProgressFunc] = None,
+                     now: typing.Optional[float] = None) -> dict:
+        """Report the location changes in the outbox that are due to QAI.
+        Return a dict in response (success/failure).
+        """
+        raise NotImplementedError('not implemented')
+
+    def get_outbox_status(self, now: typing.Optional[float] = None) -> dict:
+        """Return a dict describing the location changes waiting to be reported to QAI."""
+        raise NotImplementedError('not implemented')
+
+    def resolve_rejected(self, reag_item_id: int, do_retry: bool) -> int:
+        """Report the location changes of a reagent item that QAI has refused again,
+        or discard them. Return the number of changes resolved.
+        """
+        raise NotImplementedError('not implemented')
@@ -7,7 +7,14 @@
 """
 
 import typing
+import array
+import collections
+import socket
+import time
 import serial
+import gevent.event
+import gevent.lock
+import gevent.socket
 
 import serverlib.qai_helper as qai_helper
 from webclient.commonmsg import CommonMSG
@@ -46,6 +53,13 @@ BYTE_LF = b'\n'
 
 BYTE_CRLF = b"\r\n"
 
+# a response block is terminated by an empty line
+BYTE_BLOCK_END = BYTE_CRLF + BYTE_CRLF
+
+# the RFID reader sometimes sends these bytes, which are not part of the protocol.
+# They are removed from the data read.
+SKIP_BYTES = b'\x00\xff'
+
 OK_RESP_TUPLE = (OK_RESP, '')
 
 OK_RESP_LIST = [('OK', '')]
@@ -58,8 +72,7 @@ TLSRetCode = int
 # (a negative value, bigger is closer. E.g. -40 is nearer than -75)
 RSSI = int
 
-_HEXTAB = dict([(chr(ord('0') + i), i) for i in range(0, 10)] +
-               [(chr(ord('A') + i), i+10) for i in range(0, 6)])
+_HEXCHARS = frozenset('0123456789ABCDEF')
 
 
 def hexstr_to_str(instr: str) -> str:
@@ -89,21 +102,18 @@ def hexstr_to_str(instr: str) -> str:
        The modified string upon successful conversion, otherwise
        the original string.
     """
-    if not instr or len(instr) % 2 == 1:
-        return instr
-    # strlst: list of strings of length two representing hex numbers.
-    strlst = [instr[i:i+2] for i in range(0, len(instr), 2)]
-    # numlst: list of integers. if this fails, give up, as we do not have Hex numbers
-    try:
-        numlst = [_HEXTAB[hexstr[0]] * 16 + _HEXTAB[hexstr[1]] for hexstr in strlst]
-    except KeyError:
+    # if the string does not consist of upper case hex digits only, give up.
+    # NOTE: bytes.fromhex() would also accept lower case digits and spaces.
+    if not instr or len(instr) % 2 == 1 or not _HEXCHARS.issuperset(instr):
         return instr
+    numbytes = bytes.fromhex(instr)
     # NOTE: also return the original string if the leading char is not a 'reasonable' ASCII
     # char.
-    testchar = chr(numlst[0])
+    testchar = chr(numbytes[0])
     charpass = 'A' <= testchar <= 'Z' or 'a' <= testchar <= 'z' or '1' <= testchar <= '9'
     # NOTE: the string can have multiple trailing zeros...
-    return ''.join([chr(num) for num in numlst if num != 0]) if charpass else instr
+    # latin-1 maps every byte value to the character with the same code.
+    return str(numbytes.replace(b'\x00', b''), 'latin-1') if charpass else instr
 
 
 class CLResponse:
@@ -114,31 +124,37 @@ class CLResponse:
        rl: a list containing the response from the RFID reader.
           if rl is None, this means that communication with the RFID reader timed out.
           if rl is am empty list, this means there was a protocol error during communication.
+
+    The EPC values are decoded and the response codes are indexed in a single pass over rl.
+    The comment dict is only extracted from the CS field when it is asked for.
     """
     def __init__(self, rl: typing.Optional[ResponseList]) -> None:
+        self._mydct: typing.Dict[str, StringList] = {}
+        self._cs_string: typing.Optional[str] = None
+        self._cdict: typing.Optional[dict] = None
+        self._cdict_done = False
         if rl is None:
             self.rl = None
-            self._mydct: typing.Dict[str, StringList] = {}
-            self._cdict = None
         else:
-            self.rl = CLResponse._hexify(rl)
-            dd: typing.Dict[str, StringList] = {}
-            self._mydct = dd
-            for resp_code, msg in self.rl:
-                dd.setdefault(resp_code, []).append(msg)
-            # now, from the CS field, extract the comment dict
-            cdict = None
+            dd = self._mydct
+            newrl: ResponseList = []
+            for tt in rl:
+                resp_code, msg = tt
+                if resp_code == EP_VAL:
+                    msg = hexstr_to_str(msg)
+                    tt = (resp_code, msg)
+                newrl.append(tt)
+                msglst = dd.get(resp_code, None)
+                if msglst is None:
+                    dd[resp_code] = [msg]
+                else:
+                    msglst.append(msg)
+            self.rl = newrl
             cslst = dd.get(CS_VAL, None)
             if cslst is not None:
                 if len(cslst) != 1:
                     raise RuntimeError("CS field must be present exactly once")
-                cs_string = cslst[0]
-                cdict = BaseCommLink.extract_comment_dict(cs_string)
-            self._cdict = cdict
-
-    @staticmethod
-    def _hexify(rl: ResponseList) -> ResponseList:
-        return [(EP_VAL, hexstr_to_str(tt[1])) if tt[0] == EP_VAL else tt for tt in rl]
+                self._cs_string = cslst[0]
 
     def __getitem__(self, respcode: str) -> typing.Optional[StringList]:
         """Return a list with only those response codes equal to respcode.
@@ -195,10 +211,28 @@ class CLResponse:
         return rlst[0]
 
     def get_comment_dct(self) -> typing.Optional[dict]:
+        """Return the comment dict sent with the command that this is the response to.
+        Return None if there is none."""
+        if not self._cdict_done:
+            cs_string = self._cs_string
+            self._cdict = None if cs_string is None else BaseCommLink.extract_comment_dict(cs_string)
+            self._cdict_done = True
         return self._cdict
 
+    def get_ri_values(self) -> typing.Optional[array.array]:
+        """Return the RSSI values (the RI fields) of an inventory response
+        as an array of ints, in the same order as the EPCs.
+
+        Returns:
+           The array of values, or None if the response has no RI fields.
+        Raises:
+           ValueError: if an RI field is not an integer.
+        """
+        rilst = self._mydct.get(RI_VAL, None)
+        return None if rilst is None else array.array('i', map(int, rilst))
+
     def __str__(self):
-        return "CLResponse: '{}' comment: {}".format(self.rl, self._cdict)
+        return "CLResponse: '{}' comment: {}".format(self.rl, self.get_comment_dct())
 
 
 class BaseCommLink:
@@ -218,6 +252,13 @@ class BaseCommLink:
     COMMENT_ID = 'CMT'
     MSGNUM_ID = 'MSG'
 
+    # while another greenlet is reading from the device, a greenlet waiting for
+    # the response to a pipelined command checks this often whether it should take over.
+    PIPELINE_POLL_SECS = 0.1
+
+    # the default for RFID_PROBE_SECS in the server configuration: see _is_responsive().
+    DEFAULT_PROBE_SECS = 30
+
     def __init__(self, cfgdct: dict) -> None:
         """Maintain a communication channel to an RFID device.
 
@@ -229,11 +270,29 @@ class BaseCommLink:
         """
         self.cfgdct = cfgdct
         self.logger = cfgdct['logger']
+        self.probe_secs = cfgdct.get('RFID_PROBE_SECS', BaseCommLink.DEFAULT_PROBE_SECS)
+        # the time.monotonic() at which the reader last sent us a response,
+        # or None if we have not heard from it since the last I/O error.
+        self._t_lastheard: typing.Optional[float] = None
+        # the number of times we have sent a command to check that the reader is responding.
+        self.num_probes = 0
         # we keep track of command numbers.
         self._cmdnum = 0
+        # the commands in flight whose responses are awaited, keyed by their MSG number
+        self._pending: typing.Dict[str, gevent.event.AsyncResult] = {}
+        # responses read while waiting for a pipelined command that no one was waiting for
+        self._unsolicited: typing.Deque[CLResponse] = collections.deque()
+        # only one greenlet at a time may read responses from the device
+        self._rdlock = gevent.lock.Semaphore()
         self.mydev: typing.Optional[typing.Any] = self.open_device()
         self._idstr: typing.Optional[str] = None
         self.rfid_info_dct: typing.Optional[dict] = None
+        # the bytes read from the device that have not yet been returned as a line
+        # start at _rdpos in _rdbuf.
+        self._rdbuf = bytearray()
+        self._rdpos = 0
+        # the number of times bytes have been added to _rdbuf
+        self._nfills = 0
 
     def open_device(self) -> typing.Optional[typing.Any]:
         # NOTE: we do not raise an notimplemented exception here, because otherwise
@@ -265,22 +324,26 @@ class BaseCommLink:
             be made later.
         """
         if is_online:
-            self.mydev: typing.Optional[typing.Any] = self.open_device()
+            self.mydev = self.open_device()
             self._idstr = None
         else:
             self._close_device()
             self.mydev = None
+        self._rdbuf.clear()
+        self._rdpos = 0
+        self._unsolicited.clear()
+        self._t_lastheard = None
+        # the commands in flight will never be answered
+        self._resolve_pending(CLResponse(None))
 
     @staticmethod
-    def _line_2_resptup(l: str) -> typing.Optional[ResponseTuple]:
-        if len(l) < 3:
+    def _line_2_resptup(line: str) -> typing.Optional[ResponseTuple]:
+        if len(line) < 3 or line[2] != ':':
             return None
-        ret_code = l[:2]
-        colon = l[2]
-        rest = l[3:].strip()
-        if ret_code not in RESP_CODE_SET or colon != ':':
+        ret_code = line[:2]
+        if ret_code not in RESP_CODE_SET:
             return None
-        return (ret_code, rest)
+        return (ret_code, line[3:].strip())
 
     @staticmethod
     def encode_comment_dict(d: dict) -> str:
@@ -324,83 +387,302 @@ class BaseCommLink:
             raise RuntimeError("unknown error code {}".format(ret_code))
         return ret_str
 
-    def send_cmd(self, cmdstr: str, comment: str = None) -> None:
+    def send_cmd(self, cmdstr: str, comment: typing.Optional[str] = None) -> str:
         """Send a string to the device as a command.
         The call returns as soon as the cmdstr data has been written.
 
         Args:
            cmdstr: the command string to write
            comment: an optional comment string that will be sent with command.
+        Returns:
+           The MSG number sent in the comment dict of the command.
         See also:
            :py:meth:`raw_send_cmd`
         """
-        commdct = {BaseCommLink.MSGNUM_ID: str(self._cmdnum), BaseCommLink.COMMENT_ID: comment}
+        msgnum = str(self._cmdnum)
+        commdct = {BaseCommLink.MSGNUM_ID: msgnum, BaseCommLink.COMMENT_ID: comment}
         cmdstr += BaseCommLink.encode_comment_dict(commdct)
-        self.raw_send_cmd(cmdstr)
+        try:
+            self.raw_send_cmd(cmdstr)
+        except RuntimeError:
+            self._t_lastheard = None
+            raise
         self._cmdnum += 1
+        return msgnum
+
+    def submit_cmd(self, cmdstr: str, comment: typing.Optional[str] = None) -> gevent.event.AsyncResult:
+        """Send a command to the device without waiting for its response.
+
+        Several commands can be in flight at once. The response to each is recognised
+        by the MSG number in the comment dict that the RFID reader echoes back in the CS field,
+        and handed to the future returned here.
+
+        Args:
+           cmdstr: the command string to write
+           comment: an optional comment string that will be sent with command.
+        Returns:
+           A future that will hold the CLResponse to this command.
+           Pass it to :py:meth:`wait_cmd` to wait for the response.
+        Raises:
+           RuntimeError: if writing the command fails.
+        """
+        fut = gevent.event.AsyncResult()
+        msgnum = str(self._cmdnum)
+        self._pending[msgnum] = fut
+        try:
+            self.send_cmd(cmdstr, comment)
+        except RuntimeError:
+            del self._pending[msgnum]
+            raise
+        return fut
+
+    def _resolve_pending(self, clresp: CLResponse) -> None:
+        """Hand clresp to all commands in flight."""
+        pending, self._pending = self._pending, {}
+        for fut in pending.values():
+            fut.set(clresp)
+
+    def _dispatch_response(self, clresp: CLResponse) -> bool:
+        """Hand a response read from the device to the command in flight that it answers.
+
+        A time out means that none of the commands in flight will be answered,
+        so all of them receive the time out response.
+        A response that could not be deciphered (a protocol error) cannot be matched
+        by its MSG number. As the reader answers commands in order, it is handed to the
+        oldest command in flight.
+
+        Any response other than a time out shows that the reader is responding.
+
+        Returns:
+           True iff clresp was handed to a command in flight.
+        """
+        if clresp.rl is None:
+            self._t_lastheard = None
+            self._resolve_pending(clresp)
+            return False
+        self._t_lastheard = time.monotonic()
+        if clresp.rl:
+            cdct = clresp.get_comment_dct()
+            msgnum = cdct.get(BaseCommLink.MSGNUM_ID, None) if cdct is not None else None
+        else:
+            msgnum = next(iter(self._pending), None)
+        fut = self._pending.pop(msgnum, None) if msgnum is not None else None
+        if fut is None:
+            return False
+        fut.set(clresp)
+        return True
+
+    def wait_cmd(self, fut: gevent.event.AsyncResult,
+                 timeout: typing.Optional[float] = None) -> CLResponse:
+        """Wait for the response to a command previously sent with :py:meth:`submit_cmd`.
+
+        If no other greenlet is reading from the device, we read from it ourselves,
+        handing responses to the commands they answer, until our response arrives.
+        Responses that no command is waiting for are kept for :py:meth:`read_response`,
+        with the exception of time outs.
+
+        The timeout is only checked between whole responses: a response that has
+        started to arrive is always read to its end, so that the read buffer never
+        holds half a response.
+        If the timeout expires, the command is no longer awaited: its response, should
+        it arrive later, is treated like any other response no command is waiting for.
+
+        Args:
+           fut: the future returned by submit_cmd()
+           timeout: the maximum time to wait in seconds, or None to wait indefinitely.
+        Returns:
+           The response to the command, or CLResponse(None) if timeout expires first.
+        """
+        t_end = None if timeout is None else time.monotonic() + timeout
+        while not fut.ready():
+            t_left = None if t_end is None else t_end - time.monotonic()
+            if t_left is not None and t_left <= 0.0:
+                self._abandon_cmd(fut)
+                self.logger.error("wait_cmd: timed out after {} s".format(timeout))
+                return CLResponse(None)
+            if self._rdlock.acquire(blocking=False):
+                try:
+                    if t_left is not None and not self._wait_readable(t_left):
+                        continue
+                    clresp = self.raw_read_response()
+                finally:
+                    self._rdlock.release()
+                # NOTE: a time out has already been handed to all commands in flight,
+                # including ours, and is not kept.
+                if not self._dispatch_response(clresp) and clresp.rl is not None:
+                    self._unsolicited.append(clresp)
+            else:
+                # another greenlet is reading: it will hand our response to fut.
+                poll_secs = BaseCommLink.PIPELINE_POLL_SECS
+                fut.wait(poll_secs if t_left is None else min(t_left, poll_secs))
+        return fut.get()
+
+    def _abandon_cmd(self, fut: gevent.event.AsyncResult) -> None:
+        """Stop waiting for the response to the command whose future is fut."""
+        for msgnum, pfut in list(self._pending.items()):
+            if pfut is fut:
+                del self._pending[msgnum]
+
+    def _wait_readable(self, timeout: float) -> bool:
+        """Wait for at most timeout seconds for the start of a response to arrive.
 
-    def _filterbyte(self) -> typing.Optional[bytes]:
-        """Filter unwanted bytes from the RFID reader.
+        Returns:
+           True if there are bytes to read, or if we cannot tell (in which case
+           the read itself will block). False if the timeout expired first.
+        """
+        if self._rdpos < len(self._rdbuf):
+            return True
+        mydev = self.mydev
+        fileno = getattr(mydev, 'fileno', None)
+        if fileno is not None:
+            try:
+                gevent.socket.wait_read(fileno(), timeout=timeout)
+            except socket.timeout:
+                return False
+            except Exception:
+                # e.g. the device is closed: let the read report the error.
+                pass
+            return True
+        if mydev is None or not hasattr(mydev, 'in_waiting'):
+            return True
+        t_end = time.monotonic() + timeout
+        while mydev.in_waiting == 0:
+            t_left = t_end - time.monotonic()
+            if t_left <= 0.0:
+                return False
+            gevent.sleep(min(t_left, 0.001))
+        return True
+
+    def read_response(self) -> CLResponse:
+        """Read the next response from the device that no pipelined command is waiting for.
+
+        Responses to commands sent with :py:meth:`submit_cmd` are handed to their futures
+        instead of being returned.
+        This is the method to use for receiving unsolicited messages from the RFID reader
+        (e.g. the user pressing the trigger), and responses to commands sent
+        with :py:meth:`send_cmd`.
 
-        Every now and again, the RFID reader sends us strings of bytes of
-        0x00 and 0xff which cannot be translated into ASCII.
+        Returns:
+           The response read.
+        See also:
+           :py:meth:`raw_read_response`
+        """
+        while True:
+            with self._rdlock:
+                if self._unsolicited:
+                    return self._unsolicited.popleft()
+                clresp = self.raw_read_response()
+            if not self._dispatch_response(clresp):
+                return clresp
+
+    def _fill_buffer(self) -> bool:
+        """Append the bytes available from the RFID reader to the read buffer.
+
+        All bytes waiting to be read are read in a single call; if there are none,
+        wait for at least one byte. Every now and again, the RFID reader sends us
+        strings of bytes of 0x00 and 0xff which cannot be translated into ASCII.
         As far as I know, we don't need these, so just filter them out here.
         Furthermore, we sometimes encounter a SerialException, so just catch this
         and treat it the same as a timeout.
 
         Returns:
-           The required byte, or None if a timeout occurred on reading.
+           False if a timeout occurred on reading, otherwise True.
         """
         mydev = self.mydev
         if mydev is None:
             raise RuntimeError('dev is None')
-        doread = True
-        skipset = frozenset([b'\xff', b'\x00'])
-        while doread:
-            try:
-                b = mydev.read(size=1)
-            except serial.serialutil.SerialException as e:
-                self.logger.error("error reading from serial device: {}".format(str(e)))
-                # same as a timeout...
-                b = ""
-            # print(" b: '{}'".format(b))
-            if not b:
-                # time out occurred
-                b = None
-                doread = False
-            else:
-                doread = (b in skipset)
-        return b
+        try:
+            # NOTE: in_waiting is the number of bytes that can be read without blocking.
+            b = mydev.read(size=max(getattr(mydev, 'in_waiting', 0), 1))
+        except serial.serialutil.SerialException as e:
+            self.logger.error("error reading from serial device: {}".format(str(e)))
+            # same as a timeout...
+            b = b''
+        if not b:
+            return False
+        # discard the bytes already returned before appending the new ones.
+        if self._rdpos > 0:
+            del self._rdbuf[:self._rdpos]
+            self._rdpos = 0
+        self._rdbuf += b.translate(None, SKIP_BYTES)
+        self._nfills += 1
+        return True
+
+    def _take_block(self) -> typing.Optional[StringList]:
+        """Remove a complete response block from the read buffer and return its lines.
+
+        A response block is a sequence of (CR, LF)-terminated lines ending in an empty line.
+        Splitting and decoding the whole block at once is much faster than reading it
+        line by line with :py:meth:`_str_readline`.
+
+        Returns:
+           The lines of the block without the terminating empty line, or None if the
+           buffer does not hold a complete block, or if the block contains a CR without
+           a following LF or bytes that cannot be converted into a utf-8 string.
+           In the latter case, the bytes are left for _str_readline() to deal with.
+        """
+        buf, pos = self._rdbuf, self._rdpos
+        if buf.startswith(BYTE_CRLF, pos):
+            end = pos
+        else:
+            end = buf.find(BYTE_BLOCK_END, pos)
+            if end == -1:
+                return None
+            end += len(BYTE_CRLF)
+        blk = bytes(buf[pos:end])
+        if blk.count(BYTE_CR) != blk.count(BYTE_CRLF):
+            return None
+        try:
+            blkstr = str(blk, 'utf-8')
+        except UnicodeDecodeError:
+            return None
+        self._rdpos = end + len(BYTE_CRLF)
+        return blkstr.split('\r\n')[:-1]
 
     def _str_readline(self) -> typing.Optional[str]:
         """Read a CR-LF-terminated string from the serial device.
 
-        Read bytes (not strings) from the serial device until we hit
-        a (CR, LF) then collect the bytes together into a line and return as a string.
+        Read bytes (not strings) from the serial device into a buffer until it contains
+        a (CR, LF), then return the bytes before it as a string.
+        Any bytes after the (CR, LF) are kept for the next call. Rather than deleting
+        each line from the front of the buffer, we advance the read position in it.
 
         Returns:
-           A string or None if a tim out occurred on reading.
+           A string or None if a time out occurred on reading. In the latter case,
+           any partial line read is discarded.
 
         Raises:
             RuntimeError: if a CR character is read without a following LF character, or
                 if conversion into a utf-8 string fails.
         See also:
-           :py:meth:`_filterbyte`
+           :py:meth:`_fill_buffer`
         """
-        retbytes, doread = b'', True
-        while doread:
-            newbyte = self._filterbyte()
-            # print("newbyte: {}".format(newbyte))
-            if newbyte is None:
-                return None
-            if newbyte != BYTE_CR:
-                retbytes += newbyte
-            else:
-                newbyte = self._filterbyte()
-                if newbyte != BYTE_LF:
+        buf = self._rdbuf
+        pos = self._rdpos
+        # the position from which to look for a CR
+        start = pos
+        while True:
+            cr_ndx = buf.find(BYTE_CR, start)
+            if 0 <= cr_ndx < len(buf) - 1:
+                break
+            start = len(buf) if cr_ndx == -1 else cr_ndx
+            if not self._fill_buffer():
+                buf.clear()
+                self._rdpos = 0
+                if cr_ndx != -1:
+                    # a CR followed by a time out
                     self.logger.error("rd: internal error 1")
                     raise RuntimeError('protocol error')
-                doread = False
+                return None
+            # _fill_buffer() has discarded the bytes before pos
+            start -= pos
+            pos = 0
+        retbytes = bytes(buf[pos:cr_ndx])
+        is_crlf = buf[cr_ndx+1] == BYTE_LF[0]
+        self._rdpos = cr_ndx + 2
+        if not is_crlf:
+            self.logger.error("rd: internal error 1")
+            raise RuntimeError('protocol error')
         try:
             retstr = str(retbytes, 'utf-8')
         except UnicodeDecodeError as e:
@@ -446,11 +728,26 @@ class BaseCommLink:
            The response is packed up into a CLResponse instance and returned.
 
         See also:
-           :py:meth:`_str_readline()`
+           :py:meth:`_str_readline`, :py:meth:`_take_block`
         """
         rlst: typing.Optional[typing.List[ResponseTuple]] = []
         done = False
+        # the value of _nfills when we last looked for a complete block in the buffer
+        nfills = -1
         while not done:
+            if nfills != self._nfills:
+                # new bytes have arrived: try to take the rest of the response in one go.
+                nfills = self._nfills
+                linelst = self._take_block()
+                if linelst is not None and rlst is not None:
+                    line_2_resptup = BaseCommLink._line_2_resptup
+                    for blk_line in linelst:
+                        resp_tup = line_2_resptup(blk_line)
+                        if resp_tup is not None:
+                            rlst.append(resp_tup)
+                        else:
+                            self.logger.error("line_2_resptup failed '{}'".format(blk_line))
+                    break
             try:
                 cur_line = self._str_readline()
             except RuntimeError as e:
@@ -461,7 +758,6 @@ class BaseCommLink:
                 rlst = None
                 done = True
             elif cur_line:
-                print("rr '{}' ({})".format(cur_line, len(cur_line)))
                 resp_tup = BaseCommLink._line_2_resptup(cur_line)
                 if resp_tup is not None and rlst is not None:
                     rlst.append(resp_tup)
@@ -477,7 +773,16 @@ class BaseCommLink:
         return self.mydev is not None
 
     def _is_responsive(self) -> bool:
-        """Return := 'the RFID reader is responding to commands'"""
+        """Return := 'the RFID reader is responding to commands'
+
+        Any response received from the reader counts as a heartbeat: only if we have not
+        heard from the reader for probe_secs seconds, or have had an I/O error since, do we
+        send it a command to find out.
+        """
+        t_lastheard = self._t_lastheard
+        if t_lastheard is not None and time.monotonic() - t_lastheard < self.probe_secs:
+            return True
+        self.num_probes += 1
         retcode = self._get_reader_info()
         return retcode != BaseCommLink.RC_TIMEOUT
 
@@ -516,7 +821,7 @@ class BaseCommLink:
         raise NotImplementedError("id_string not defined")
 
     def _blocking_cmd(self, cmdstr: str,
-                      comment: str = None) -> CLResponse:
+                      comment: typing.Optional[str] = None) -> CLResponse:
         """Send a command string to the reader, returning its list of response strings.
         Note: if the RFID reader goes out of range, the write command will time out,
         however, the device will not automatically be closed.
@@ -526,12 +831,15 @@ class BaseCommLink:
 
         If the device is closed, we attempt to open it. This allows a connection to
         be re established when the RFID reader comes into range.
+
+        The command is sent as a pipelined command, so that the response is
+        recognised even if other commands are in flight.
         """
         print("_blocking_cmd 1")
         if not self.is_alive():
             self.handle_state_change(True)
         try:
-            self.send_cmd(cmdstr, comment)
+            fut = self.submit_cmd(cmdstr, comment)
         except RuntimeError:
             # Write failed despite the device being open: a time-out problem occurred,
             # which means the RFID reader is out of range.
@@ -542,7 +850,7 @@ class BaseCommLink:
                 self.handle_state_change(False)
             return CLResponse(None)
         print("_blocking_cmd 2")
-        res = self.raw_read_response()
+        res = self.wait_cmd(fut)
         print("_blocking_cmd 3")
         return res
 
@@ -573,6 +881,11 @@ class SerialCommLink(BaseCommLink):
     """Communicate with the RFID reader via a serial device (i.e. USB or Bluetooth).
     The name of the device to open  (typically something like '/dev/rfcomm0')
     is taken from the server configuration file.
+
+    Note:
+       The server runs in gunicorn's gevent worker, which monkey-patches the standard
+       library. The select() call that serial.Serial uses to wait for the reader then
+       yields to other greenlets instead of blocking the server.
     """
 
     _klst = [('Manufacturer', 'MF'),
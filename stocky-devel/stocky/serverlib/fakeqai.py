@@ -0,0 +1,444 @@
+"""A stand-in for the QAI web server, serving synthetic data.
+
+This allows the QAI synchronisation and location upload code to be tested and
+benchmarked without access to a QAI server. The server implements the endpoints used
+by :class:`serverlib.qai_helper.QAISession` to synchronise the local database and
+report reagent item locations. It can add latency to every request, limit its
+bandwidth, compress its responses and reply to a random fraction of requests with an HTTP error.
+
+The server runs in a background thread. It can also be run from the command line:
+
+   python -m serverlib.fakeqai --port 8000 --num_items 10000 --latency 0.05 --gzip
+"""
+
+import typing
+import argparse
+import gzip
+import http.server
+import json
+import random
+import threading
+import time
+import urllib.parse
+import zlib
+
+import serverlib.timelib as timelib
+import serverlib.qai_helper as qai_helper
+
+
+QAIdct = qai_helper.QAIdct
+
+# the credentials accepted by default on /account/login
+DEFAULT_USER = 'testuser'
+DEFAULT_PASSWORD = 'testpass'
+
+# NOTE: the values of requests.codes are typed as optional, so we spell these out.
+HTTP_OK = 200
+HTTP_CREATED = 201
+HTTP_FORBIDDEN = 403
+HTTP_NOT_FOUND = 404
+HTTP_UNPROCESSABLE = 422
+HTTP_INTERNAL_SERVER_ERROR = 500
+
+# when compression is enabled, response bodies of at least this many bytes are compressed
+# with the first of these encodings accepted by the client.
+COMPRESS_MIN_SIZE = 1024
+_ENCODING_LST = ['gzip', 'deflate']
+
+_SCN_SUFFIX = '//scn'
+
+
+def make_synthetic_qaidct(num_items: int,
+                          num_locs: int = 100,
+                          num_reagents: int = 1000,
+                          seed: int = 42) -> QAIdct:
+    """Generate a QAIdct with synthetic data of a given size for testing and benchmarking.
+
+    Every reagent item has between two and four status records, so that about three times
+    num_items status records are generated.
+    The records have the same keys as those provided by QAI, including some keys that
+    are not stored in the local database.
+    """
+    rnd = random.Random(seed)
+    S = qai_helper.QAISession
+    loclst = [dict(id=10000, name='UNKNOWN')]
+    loclst.extend([dict(id=10001+i, name='SPH\\{}\\shelf {}'.format(600+i//10, i % 10))
+                   for i in range(num_locs-1)])
+    reaglst = [dict(id=6000+i, name='reagent {}'.format(i), basetype='stockchem',
+                    catalog_number='CAT{}'.format(i), category='category {}'.format(i % 20),
+                    date_msds_expires=None, disposed=None, expiry_time=2555, hazards=None,
+                    location=None, msds_filename=None, needs_validation=None, notes=None,
+                    qcs_document_id=None, storage=rnd.choice(['-20 C', '4 C', 'Room Temperature']),
+                    supplier=None, supplier_company_id=None)
+               for i in range(num_reagents)]
+    itmlst = []
+    statlst = []
+    stat_id = 40000
+    for i in range(num_items):
+        reag_item_id = 18000+i
+        itmlst.append(dict(id=reag_item_id, last_seen=None, lot_num='LOT{}'.format(i), notes=None,
+                           qcs_location_id=rnd.choice(loclst)['id'],
+                           qcs_reag_id=rnd.choice(reaglst)['id'],
+                           rfid='CHEM{}'.format(reag_item_id)))
+        state_seq = ['MADE', rnd.choice(['MADE', 'VALIDATED', 'IN_USE', 'USED_UP', 'MISSING'])]
+        if rnd.random() < 0.8:
+            state_seq.append('EXPIRED')
+        if rnd.random() < 0.2:
+            state_seq.append('IN_USE')
+        for status in state_seq:
+            yy = rnd.randrange(2015, 2030) if status == 'EXPIRED' else rnd.randrange(2011, 2019)
+            occurred = '{}-{:02d}-{:02d}T00:00:00Z'.format(yy, rnd.randrange(1, 13), rnd.randrange(1, 29))
+            statlst.append(dict(id=stat_id, occurred=occurred,
+                                qcs_reag_item_id=reag_item_id,
+                                qcs_user_id=10000, status=status, qcs_validation_id=None))
+            stat_id += 1
+    return {S.QAIDCT_LOCATIONS: loclst,
+            S.QAIDCT_USERS: [dict(id=10000, email='test@example.com', initials='TU', login='testuser')],
+            S.QAIDCT_REAITEM_COMPOSITION: [],
+            S.QAIDCT_REAGENTS: reaglst,
+            S.QAIDCT_REAGENT_ITEMS: itmlst,
+            S.QAIDCT_REAITEM_STATUS: statlst}
+
+
+class _FakeQAIHandler(http.server.BaseHTTPRequestHandler):
+    """Handle a single request to a FakeQAIServer."""
+    protocol_version = 'HTTP/1.1'
+    # send the headers and body of a response in one go: writing them separately
+    # causes delayed ACK stalls on keep-alive connections.
+    wbufsize = 64*1024
+    disable_nagle_algorithm = True
+    server: 'FakeQAIServer'
+
+    def setup(self) -> None:
+        super().setup()
+        self.server.count('connections')
+
+    def log_message(self, format: str, *args) -> None:
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _read_body(self) -> bytes:
+        nbytes = int(self.headers.get('Content-Length', 0))
+        return self.rfile.read(nbytes) if nbytes > 0 else b''
+
+    def _reply(self, status: int, body: typing.Union[bytes, str], content_type: str) -> None:
+        srv = self.server
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        encoding = srv.choose_encoding(self.headers.get('Accept-Encoding', ''), len(body))
+        if encoding == 'gzip':
+            body = gzip.compress(body, compresslevel=6)
+        elif encoding == 'deflate':
+            body = zlib.compress(body, 6)
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        if encoding is not None:
+            self.send_header('Content-Encoding', encoding)
+            srv.count('compressed')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if srv.bandwidth > 0.0:
+            time.sleep(len(body)/srv.bandwidth)
+        self.wfile.write(body)
+        srv.count('bytes_sent', len(body))
+
+    def _reply_json(self, status: int, data: typing.Any) -> None:
+        self._reply(status, qai_helper.tojson(data), 'application/json')
+
+    def _handle(self, method: str) -> None:
+        srv = self.server
+        urlparts = urllib.parse.urlsplit(self.path)
+        path = urlparts.path
+        query = {k: v[0] for k, v in urllib.parse.parse_qs(urlparts.query).items()}
+        body = self._read_body()
+        srv.count('requests')
+        if srv.latency > 0.0:
+            time.sleep(srv.latency)
+        if not path.startswith('/account/') and srv.inject_error():
+            srv.count('errors_injected')
+            self._reply_json(HTTP_INTERNAL_SERVER_ERROR, dict(error='injected error'))
+            return
+        status, retval = srv.respond(method, path, body, query,
+                                     self.headers.get(qai_helper.IDEMPOTENCY_HEADER, None))
+        if isinstance(retval, str):
+            self._reply(status, retval, 'text/plain;charset=utf-8')
+        else:
+            self._reply_json(status, retval)
+
+    def do_GET(self) -> None:
+        self._handle('GET')
+
+    def do_POST(self) -> None:
+        self._handle('POST')
+
+    def do_PATCH(self) -> None:
+        self._handle('PATCH')
+
+
+class FakeQAIServer(http.server.ThreadingHTTPServer):
+    """An HTTP server that imitates the parts of the QAI API used by stocky.
+
+    The following endpoints are implemented:
+       * POST /account/login, GET /account/logout
+       * GET /table_dump/<table> and GET /table_dump/<table>//scn (the table's change number)
+       * GET /qcs_reagent/show?id=<reagent id> (a reagent with its items)
+       * PATCH /qcs_reagent/item (set the location of a reagent item)
+       * POST /qcs_reagent/item_status (add a status record to a reagent item)
+
+    Changes made by the latter two endpoints are visible in later table dumps, and
+    increment the change number of the table concerned. A request to them that repeats
+    the idempotency key (qai_helper.IDEMPOTENCY_HEADER) of an earlier successful
+    request is answered with the earlier response and has no further effect.
+    """
+    daemon_threads = True
+
+    def __init__(self, qaidct: QAIdct,
+                 port: int = 0,
+                 host: str = 'localhost',
+                 latency: float = 0.0,
+                 error_rate: float = 0.0,
+                 seed: int = 42,
+                 username: str = DEFAULT_USER,
+                 password: str = DEFAULT_PASSWORD,
+                 verbose: bool = False,
+                 compress: bool = False,
+                 bandwidth: float = 0.0) -> None:
+        """
+        Args:
+           qaidct: the data to serve, e.g. generated by :func:`make_synthetic_qaidct`.
+           port: the port to listen on. A free port is chosen if this is 0.
+           host: the host name to listen on.
+           latency: the delay in seconds added to every request.
+           error_rate: the fraction of requests (except for /account/ requests) that are
+              answered with HTTP 500.
+           seed: the seed of the random numbers used for error injection.
+           username: the user name accepted on login.
+           password: the password accepted on login.
+           verbose: log every request to stderr.
+           compress: compress the response bodies if the client accepts this.
+           bandwidth: if > 0, limit the speed at which a response body is sent
+              to this many bytes per second.
+        """
+        if latency < 0.0:
+            raise ValueError("latency must be >= 0")
+        if not 0.0 <= error_rate <= 1.0:
+            raise ValueError("error_rate must be between 0 and 1")
+        if bandwidth < 0.0:
+            raise ValueError("bandwidth must be >= 0")
+        super().__init__((host, port), _FakeQAIHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.username = username
+        self.password = password
+        self.verbose = verbose
+        self.compress = compress
+        self.bandwidth = bandwidth
+        self._rnd = random.Random(seed)
+        self._lock = threading.Lock()
+        self._counters: typing.Dict[str, int] = {}
+        self._thread: typing.Optional[threading.Thread] = None
+        self._idem_dct: typing.Dict[typing.Tuple[str, str, str], typing.Tuple[int, typing.Any]] = {}
+        self._dump_dct = {url: k for k, url in qai_helper.QAISession.data_url_lst}
+        self.set_data(qaidct)
+
+    @property
+    def url(self) -> str:
+        """The URL to use as the qai_path of a QAISession."""
+        host, port = typing.cast(typing.Tuple[str, int], self.server_address[:2])
+        return "http://{}:{}".format(host, port)
+
+    def set_data(self, qaidct: QAIdct) -> None:
+        """Replace the data served and reset the change numbers."""
+        S = qai_helper.QAISession
+        with self._lock:
+            self._qaidct = {k: list(qaidct.get(k, None) or []) for k in S.qai_key_lst}
+            self._scndct = {k: 1 for k in S.qai_key_lst}
+            self._itemdct = {r['id']: r for r in self._qaidct[S.QAIDCT_REAGENT_ITEMS]}
+            statlst = self._qaidct[S.QAIDCT_REAITEM_STATUS]
+            self._next_stat_id = max([r['id'] for r in statlst], default=0) + 1
+
+    def get_data(self) -> QAIdct:
+        """Return the data currently served."""
+        with self._lock:
+            return {k: list(v) for k, v in self._qaidct.items()}
+
+    def count(self, name: str, n: int = 1) -> None:
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def get_stats(self) -> typing.Dict[str, int]:
+        """Return the request counters of the server.
+
+        Returns:
+           A dict with counters such as 'requests', 'errors_injected', 'bytes_sent' and
+           the number of requests per endpoint.
+        """
+        with self._lock:
+            return dict(self._counters)
+
+    def choose_encoding(self, accept_encoding: str, nbytes: int) -> typing.Optional[str]:
+        """Return the content encoding with which to send a response body of nbytes bytes
+        to a client that sent the Accept-Encoding header accept_encoding, or None
+        if the body is to be sent uncompressed."""
+        if not self.compress or nbytes < COMPRESS_MIN_SIZE:
+            return None
+        accept_set = set(enc.split(';')[0].strip() for enc in accept_encoding.split(','))
+        return next((enc for enc in _ENCODING_LST if enc in accept_set), None)
+
+    def inject_error(self) -> bool:
+        with self._lock:
+            return self.error_rate > 0.0 and self._rnd.random() < self.error_rate
+
+    def respond(self, method: str, path: str, body: bytes,
+                query: typing.Dict[str, str],
+                idem_key: typing.Optional[str] = None) -> typing.Tuple[int, typing.Any]:
+        """Determine the response to a request.
+        idem_key is the idempotency key sent with the request, if any.
+
+        Returns:
+           The HTTP status code and the response body: a string is sent as text,
+           anything else as JSON.
+        """
+        if method == 'POST' and path == '/account/login':
+            self.count('login')
+            formdct = urllib.parse.parse_qs(body.decode('utf-8'))
+            user = formdct.get('user_login', [None])[0]
+            passwd = formdct.get('user_password', [None])[0]
+            if user == self.username and passwd == self.password:
+                return HTTP_OK, dict(ok=True)
+            return HTTP_FORBIDDEN, dict(error='access denied')
+        if method == 'GET' and path == '/account/logout':
+            return HTTP_OK, ''
+        if method == 'GET' and path.startswith('/table_dump/'):
+            want_scn = path.endswith(_SCN_SUFFIX)
+            k = self._dump_dct.get(path[:-len(_SCN_SUFFIX)] if want_scn else path, None)
+            if k is None:
+                return HTTP_NOT_FOUND, dict(error='no such table')
+            self.count('scn' if want_scn else 'table_dump')
+            with self._lock:
+                if want_scn:
+                    return HTTP_OK, str(self._scndct[k])
+                return HTTP_OK, list(self._qaidct[k])
+        if method == 'GET' and path == qai_helper.PATH_REAGENT_SHOW:
+            self.count('reagent_show')
+            return self._show_reagent(query.get('id', ''))
+        try:
+            data = json.loads(body) if body else {}
+        except ValueError:
+            return HTTP_UNPROCESSABLE, dict(error='invalid JSON')
+        if method == 'PATCH' and path == qai_helper.PATH_REAGENT_ITEM:
+            self.count('set_location')
+            return self._idempotent(method, path, idem_key, lambda: self._set_location(data))
+        if method == 'POST' and path == qai_helper.PATH_REAGITEM_STATUS:
+            self.count('add_status')
+            return self._idempotent(method, path, idem_key, lambda: self._add_status(data))
+        return HTTP_NOT_FOUND, dict(error='no such endpoint')
+
+    def _idempotent(self, method: str, path: str, idem_key: typing.Optional[str],
+                    func: typing.Callable[[], typing.Tuple[int, typing.Any]]) -> typing.Tuple[int, typing.Any]:
+        """Return the response func() if idem_key has not been seen with a successful
+        request before, otherwise return the earlier response."""
+        if idem_key is None:
+            return func()
+        k = (method, path, idem_key)
+        with self._lock:
+            retval = self._idem_dct.get(k, None)
+        if retval is not None:
+            self.count('idem_replays')
+            return retval
+        retval = func()
+        if retval[0] < 300:
+            with self._lock:
+                self._idem_dct[k] = retval
+        return retval
+
+    def _show_reagent(self, idstr: str) -> typing.Tuple[int, typing.Any]:
+        S = qai_helper.QAISession
+        with self._lock:
+            fndlst = [r for r in self._qaidct[S.QAIDCT_REAGENTS] if str(r['id']) == idstr]
+            if not fndlst:
+                return HTTP_NOT_FOUND, dict(error='no such reagent')
+            itmlst = [dict(itm) for itm in self._qaidct[S.QAIDCT_REAGENT_ITEMS] if str(itm['qcs_reag_id']) == idstr]
+            return HTTP_OK, dict(fndlst[0], items=itmlst)
+
+    def touch_table(self, k: str) -> None:
+        """Increment the change number of table k, as if its data had changed."""
+        with self._lock:
+            self._scndct[k] += 1
+
+    def _set_location(self, data: dict) -> typing.Tuple[int, typing.Any]:
+        S = qai_helper.QAISession
+        with self._lock:
+            itm = self._itemdct.get(data.get('id', None), None)
+            if itm is None:
+                return HTTP_UNPROCESSABLE, dict(error='no such reagent item')
+            for k in ('qcs_location_id', 'last_seen', 'notes'):
+                if k in data:
+                    itm[k] = data[k]
+            self._scndct[S.QAIDCT_REAGENT_ITEMS] += 1
+            return HTTP_OK, dict(itm)
+
+    def _add_status(self, data: dict) -> typing.Tuple[int, typing.Any]:
+        S = qai_helper.QAISession
+        with self._lock:
+            reag_item_id = data.get('qcs_reag_item_id', None)
+            if reag_item_id not in self._itemdct:
+                return HTTP_UNPROCESSABLE, dict(error='no such reagent item')
+            rec = dict(id=self._next_stat_id,
+                       occurred=timelib.datetime_to_str(timelib.utc_nowtime()),
+                       qcs_reag_item_id=reag_item_id,
+                       qcs_user_id=10000,
+                       status=data.get('status', None),
+                       qcs_validation_id=None)
+            self._next_stat_id += 1
+            self._qaidct[S.QAIDCT_REAITEM_STATUS].append(rec)
+            self._scndct[S.QAIDCT_REAITEM_STATUS] += 1
+            return HTTP_CREATED, dict(rec)
+
+    def start(self) -> None:
+        """Start serving requests in a background thread."""
+        if self._thread is not None:
+            raise RuntimeError("server already started")
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop serving requests and close the server socket."""
+        if self._thread is not None:
+            self.shutdown()
+            self._thread.join()
+            self._thread = None
+        self.server_close()
+
+
+def main():
+    p = argparse.ArgumentParser(description="Run a stand-in QAI server serving synthetic data.")
+    p.add_argument("--host", default='localhost', help="The host name to listen on")
+    p.add_argument("--port", type=int, default=8000, help="The port to listen on")
+    p.add_argument("--num_items", type=int, default=10000, help="The number of reagent items")
+    p.add_argument("--num_locs", type=int, default=100, help="The number of locations")
+    p.add_argument("--num_reagents", type=int, default=1000, help="The number of reagents")
+    p.add_argument("--latency", type=float, default=0.0, help="The delay added to every request in seconds")
+    p.add_argument("--error_rate", type=float, default=0.0, help="The fraction of requests that fail")
+    p.add_argument("--seed", type=int, default=42, help="The random seed")
+    p.add_argument("--gzip", action='store_true', help="Compress responses if the client accepts this")
+    p.add_argument("--bandwidth", type=float, default=0.0,
+                   help="Limit the speed of sending a response to this many bytes per second")
+    p.add_argument("-v", "--verbose", action='store_true', help="Log every request")
+    args = p.parse_args()
+    qaidct = make_synthetic_qaidct(args.num_items, num_locs=args.num_locs,
+                                   num_reagents=args.num_reagents, seed=args.seed)
+    srv = FakeQAIServer(qaidct, port=args.port, host=args.host, latency=args.latency,
+                        error_rate=args.error_rate, seed=args.seed, verbose=args.verbose,
+                        compress=args.gzip, bandwidth=args.bandwidth)
+    print("Serving fake QAI on {} (user '{}', password '{}')".format(srv.url, srv.username, srv.password))
+    try:
+        srv.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        srv.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -3,9 +3,18 @@
 import typing
 import json
 import logging
+import codecs
+import contextlib
+import collections
+import hashlib
+import os
+import pickle
 from random import Random
 import time
 import requests
+import gevent
+import gevent.pool
+import gevent.event
 
 
 import serverlib.timelib as timelib
@@ -17,15 +26,55 @@ StatusCode = int
 
 RequestValue = typing.Tuple[StatusCode, typing.Any]
 
+# NOTE: requests.codes returns None for unknown names, so its values are typed
+# as optional. The names below are all known, so we cast them to a StatusCode.
 # this is 200
-HTTP_OK = requests.codes.ok
+HTTP_OK = typing.cast(StatusCode, requests.codes.ok)
 
 # this is 201
-HTTP_CREATED = requests.codes.created
+HTTP_CREATED = typing.cast(StatusCode, requests.codes.created)
 # this 500
-HTTP_INTERNAL_SERVER_ERROR = requests.codes.internal_server_error
+HTTP_INTERNAL_SERVER_ERROR = typing.cast(StatusCode, requests.codes.internal_server_error)
 # this is 422
-HTTP_UNPROCESSABLE = requests.codes.unprocessable
+HTTP_UNPROCESSABLE = typing.cast(StatusCode, requests.codes.unprocessable)
+# this is 304
+HTTP_NOT_MODIFIED = typing.cast(StatusCode, requests.codes.not_modified)
+# these are 502, 503 and 504: returned by the proxy in front of QAI when QAI is down
+# or overloaded. They count as failures for the circuit breaker.
+HTTP_GATEWAY_ERRORS = frozenset([requests.codes.bad_gateway,
+                                 requests.codes.service_unavailable,
+                                 requests.codes.gateway_timeout])
+
+# the default maximum number of requests to QAI performed concurrently when
+# retrieving the table change numbers and table dumps. A value of 1 means that
+# the requests are performed one after another.
+# NOTE: requests only run concurrently when the socket module has been patched by gevent,
+# as is done by the gevent worker that the stocky server runs in.
+FETCH_POOL_SIZE = 6
+
+# the number of bytes read at a time when streaming a table dump from QAI.
+STREAM_CHUNK_SIZE = 64*1024
+
+# the content encodings accepted in responses from QAI. Table dumps are large,
+# repetitive JSON documents that compress well. requests decompresses the responses.
+ACCEPT_ENCODING = 'gzip, deflate'
+
+# the number of connections to QAI kept open for reuse (HTTP keep-alive) is the
+# fetch pool size plus this number, so that requests made by background tasks during
+# a concurrent fetch do not have to open a new connection.
+HTTP_POOL_SPARE = 2
+
+# the number of most recent requests whose transfer statistics are kept
+# (see Session.get_transfer_stats).
+TRANSFER_LOG_SIZE = 50
+
+_JSON_WHITESPACE = frozenset(' \t\n\r')
+
+
+class QAIStreamError(RuntimeError):
+    """Raised while iterating over a table dump streamed from QAI if the
+    request fails or the response is not a valid JSON array."""
+    pass
 
 
 def tojson(data: typing.Any) -> str:
@@ -66,6 +115,102 @@ def fromjson(data_bytes: bytes) -> typing.Any:
     return json.loads(data_bytes)
 
 
+def iter_json_array(chunk_iter: typing.Iterable[bytes]) -> typing.Iterator[typing.Any]:
+    """Incrementally parse a JSON array provided in chunks of UTF-8 encoded bytes,
+    such as the body of a streamed HTTP response.
+
+    Only the current element and the unparsed remainder of the last chunk are
+    kept in memory, so that arbitrarily long arrays can be processed.
+
+    Args:
+       chunk_iter: the JSON text, split into chunks at arbitrary positions.
+    Returns:
+       An iterator over the elements of the array.
+    Raises:
+       ValueError: if the input is not a valid JSON array.
+    """
+    decoder = json.JSONDecoder()
+    utf8_decoder = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunk_iter)
+    buf, pos, eof = '', 0, False
+
+    def fill() -> bool:
+        """Append the next chunk to buf, dropping what has been parsed.
+        Return False if there is no more input."""
+        nonlocal buf, pos, eof
+        while not eof:
+            chunk = next(chunks, None)
+            if chunk is None:
+                eof = True
+                text = utf8_decoder.decode(b'', final=True)
+            else:
+                text = utf8_decoder.decode(chunk)
+            if text:
+                buf = buf[pos:] + text
+                pos = 0
+                return True
+        return False
+
+    # state is one of: 'start', 'first' (before the first element), 'value', 'next'
+    state = 'start'
+    while True:
+        while pos < len(buf) and buf[pos] in _JSON_WHITESPACE:
+            pos += 1
+        if pos == len(buf):
+            if fill():
+                continue
+            raise ValueError("unexpected end of JSON array")
+        c = buf[pos]
+        if state == 'start':
+            if c != '[':
+                raise ValueError("JSON array expected")
+            pos += 1
+            state = 'first'
+        elif state == 'next' or (state == 'first' and c == ']'):
+            pos += 1
+            if c == ']':
+                return
+            if c != ',':
+                raise ValueError("',' or ']' expected at position {}".format(pos))
+            state = 'value'
+        else:
+            try:
+                val, end = decoder.raw_decode(buf, pos)
+            except json.decoder.JSONDecodeError:
+                # the element may continue in the next chunk
+                if fill():
+                    continue
+                raise
+            # a number at the end of buf may continue in the next chunk
+            if end == len(buf) and fill():
+                continue
+            yield val
+            pos = end
+            state = 'next'
+
+
+class _ChunkMeter:
+    """An iterator over the chunks of a streamed response body that counts the bytes
+    received and the time spent waiting for them."""
+
+    def __init__(self, chunk_iter: typing.Iterable[bytes]) -> None:
+        self._chunks = iter(chunk_iter)
+        self.nbytes = 0
+        self.wait_secs = 0.0
+
+    def __iter__(self) -> '_ChunkMeter':
+        return self
+
+    def __next__(self) -> bytes:
+        t_start = time.perf_counter()
+        try:
+            chunk = next(self._chunks)
+        finally:
+            self.wait_secs += time.perf_counter() - t_start
+        self.nbytes += len(chunk)
+        return chunk
+
+
 def safe_fromjson(data_bytes: bytes) -> typing.Optional[typing.Any]:
     """Convert bytes to a python data structure.
 
@@ -84,19 +229,464 @@ def safe_fromjson(data_bytes: bytes) -> typing.Optional[typing.Any]:
         return None
 
 
+# the default size limit of a ResponseCache in bytes.
+DEFAULT_CACHE_MAX_BYTES = 20*1024*1024
+
+CACHE_FILE_SUFFIX = '.qaicache'
+
+
+class ResponseCache:
+    """An on-disk cache of the responses to GET requests to QAI.
+
+    Only responses to the paths in the ttl_dct provided are cached.
+    Within its time to live (TTL), a cached response is served without
+    contacting QAI. After that, a conditional request is made using the
+    response's validators (ETag and Last-Modified headers), and the cached response
+    is served again if QAI replies with 304 (not modified).
+
+    Every response is stored in a separate file in the cache directory.
+    When the total size of the files exceeds max_bytes, the least recently used
+    responses are removed.
+    """
+
+    def __init__(self, dirname: str,
+                 ttl_dct: typing.Dict[str, float],
+                 max_bytes: int = DEFAULT_CACHE_MAX_BYTES) -> None:
+        """
+        Args:
+           dirname: the directory in which to store the responses.
+              This is created if it does not exist.
+           ttl_dct: the time to live in seconds of responses, keyed by path.
+              A TTL of 0 means that a conditional request is made every time.
+           max_bytes: the maximum total size of the cached responses.
+        """
+        if not isinstance(max_bytes, int) or max_bytes <= 0:
+            raise ValueError("max_bytes must be a positive int")
+        for path, ttl in ttl_dct.items():
+            if not isinstance(ttl, (int, float)) or ttl < 0:
+                raise ValueError("illegal TTL for {}".format(path))
+        os.makedirs(dirname, exist_ok=True)
+        self._dirname = dirname
+        self._ttl_dct = dict(ttl_dct)
+        self._max_bytes = max_bytes
+        self._counters = dict(hits=0, revalidated=0, misses=0, evictions=0)
+        # the size of the file of each key, in the order of least recent use
+        self._lru: typing.OrderedDict[str, int] = collections.OrderedDict()
+        statlst = []
+        for fname in os.listdir(dirname):
+            if fname.endswith(CACHE_FILE_SUFFIX):
+                st = os.stat(os.path.join(dirname, fname))
+                statlst.append((st.st_mtime, fname[:-len(CACHE_FILE_SUFFIX)], st.st_size))
+        for mtime, key, nbytes in sorted(statlst):
+            self._lru[key] = nbytes
+        self._nbytes = sum(self._lru.values())
+        self._evict()
+
+    def is_cached_path(self, path: str) -> bool:
+        """Return: responses to path are cached."""
+        return path in self._ttl_dct
+
+    @staticmethod
+    def make_key(path: str, params: typing.Optional[dict], qai_user: typing.Optional[str] = None) -> str:
+        """Return the cache key of a GET request made by the QAI user qai_user.
+        As QAI may return different data to different users, their responses are cached separately."""
+        return hashlib.sha1(json.dumps([qai_user, path, params],
+                                       sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def _fname(self, key: str) -> str:
+        return os.path.join(self._dirname, key + CACHE_FILE_SUFFIX)
+
+    def lookup(self, key: str) -> typing.Optional[dict]:
+        """Retrieve a cached response.
+
+        Returns:
+           None if the response is not cached. Otherwise a dict with the keys
+           'path', 'status_code', 'body', 'etag', 'last_modified' and 'stored_at'.
+        """
+        if key not in self._lru:
+            return None
+        fname = self._fname(key)
+        try:
+            with open(fname, 'rb') as fi:
+                entry = pickle.load(fi)
+            os.utime(fname)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            logger.warning("removing unreadable cache file {}".format(fname))
+            self._remove(key)
+            return None
+        self._lru.move_to_end(key)
+        return entry
+
+    def is_fresh(self, entry: dict) -> bool:
+        """Return: the cached response is within its time to live."""
+        return time.time() - entry['stored_at'] < self._ttl_dct.get(entry['path'], 0)
+
+    @staticmethod
+    def validators(entry: typing.Optional[dict]) -> typing.Dict[str, str]:
+        """Return the headers that make a GET request conditional on the cached response
+        having changed."""
+        hdct: typing.Dict[str, str] = {}
+        if entry is not None:
+            if entry['etag'] is not None:
+                hdct['If-None-Match'] = entry['etag']
+            if entry['last_modified'] is not None:
+                hdct['If-Modified-Since'] = entry['last_modified']
+        return hdct
+
+    def store(self, key: str, path: str, resp: requests.Response) -> None:
+        """Store a response to a GET request."""
+        self.store_entry(key, dict(path=path, status_code=resp.status_code, body=resp.content,
+                                   etag=resp.headers.get('ETag', None),
+                                   last_modified=resp.headers.get('Last-Modified', None),
+                                   stored_at=time.time()))
+
+    def store_entry(self, key: str, entry: dict) -> None:
+        """Write a cache entry to disk and remove the least recently used entries
+        if the size limit is exceeded."""
+        fname = self._fname(key)
+        tmpname = fname + '.tmp'
+        try:
+            with open(tmpname, 'wb') as fo:
+                pickle.dump(entry, fo, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmpname, fname)
+            nbytes = os.path.getsize(fname)
+        except OSError as e:
+            logger.error("failed to write cache file {}: {}".format(fname, e))
+            return
+        self._nbytes += nbytes - self._lru.pop(key, 0)
+        self._lru[key] = nbytes
+        self._evict()
+
+    def refresh(self, key: str, entry: dict) -> None:
+        """Restart the time to live of a cached response that QAI reported as not modified."""
+        entry['stored_at'] = time.time()
+        self.store_entry(key, entry)
+
+    def _remove(self, key: str) -> None:
+        self._nbytes -= self._lru.pop(key, 0)
+        try:
+            os.remove(self._fname(key))
+        except OSError:
+            pass
+
+    def _evict(self) -> None:
+        """Remove the least recently used responses until the size limit is met."""
+        while self._nbytes > self._max_bytes and self._lru:
+            key = next(iter(self._lru))
+            self._remove(key)
+            self._counters['evictions'] += 1
+
+    def count(self, name: str) -> None:
+        """Increment one of the counters returned by :meth:`get_stats`."""
+        self._counters[name] += 1
+
+    def get_stats(self) -> dict:
+        """Return the cache statistics.
+
+        Returns:
+           A dict with the counters 'hits' (served without contacting QAI),
+           'revalidated' (served after a 304 response), 'misses' and 'evictions',
+           as well as the current number of entries ('nentries') and their size ('nbytes').
+        """
+        rdct = dict(self._counters)
+        rdct.update(nentries=len(self._lru), nbytes=self._nbytes)
+        return rdct
+
+
+class QAIUnavailableError(RuntimeError):
+    """Raised when a request is not made because the circuit breaker of a Session is open."""
+
+
+class QAIRetryCancelled(RuntimeError):
+    """Raised when a request waiting to be retried is cancelled with :meth:`Session.cancel_retries`."""
+
+
+# a request timeout in seconds: either a single number or a (connect, read) tuple.
+Timeout = typing.Union[float, typing.Tuple[float, float]]
+
+# the timeout of requests whose path does not match an entry in the timeout dict
+DEFAULT_TIMEOUT: Timeout = (5.0, 30.0)
+
+# the timeouts of requests whose paths start with these strings.
+# Table dumps can take a long time to produce and download.
+DEFAULT_TIMEOUT_DCT: typing.Dict[str, Timeout] = {'/table_dump/': (5.0, 300.0)}
+
+# the delay before the first retry of a failed request in seconds.
+# This is doubled for every further retry, up to RETRY_MAX_DELAY. Some random jitter
+# is added so that concurrent requests do not all retry at the same time.
+RETRY_BASE_DELAY = 2.0
+RETRY_MAX_DELAY = 60.0
+
+# the circuit breaker opens after this many consecutive failed requests...
+BREAKER_FAIL_THRESHOLD = 5
+# ... and lets a trial request through after this many seconds.
+BREAKER_RESET_SECS = 30.0
+
+# the HTTP header used to send an idempotency key with a modifying request.
+# A server that supports it will perform a request with a key it has already seen
+# only once, so that a request can safely be repeated if its response was lost.
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+
+
+class CircuitBreaker:
+    """Keep track of consecutive request failures in order to fail fast while
+    the QAI server is down.
+
+    The breaker starts 'closed' (requests are allowed). After fail_threshold
+    consecutive failures, it is 'open' and requests are rejected without contacting QAI.
+    After reset_secs, it is 'half_open': a single trial request is allowed.
+    If this succeeds, the breaker is closed again, otherwise it is reopened.
+    """
+    STATE_CLOSED = 'closed'
+    STATE_OPEN = 'open'
+    STATE_HALF_OPEN = 'half_open'
+
+    def __init__(self, fail_threshold: int = BREAKER_FAIL_THRESHOLD,
+                 reset_secs: float = BREAKER_RESET_SECS,
+                 clock: typing.Callable[[], float] = time.monotonic) -> None:
+        if not isinstance(fail_threshold, int) or fail_threshold < 1:
+            raise ValueError("fail_threshold must be a positive int")
+        if reset_secs < 0:
+            raise ValueError("reset_secs must be >= 0")
+        self.fail_threshold = fail_threshold
+        self.reset_secs = reset_secs
+        self._clock = clock
+        self._state = CircuitBreaker.STATE_CLOSED
+        self._numfails = 0
+        self._opened_at = 0.0
+        self._trial_pending = False
+        self._trial_started = 0.0
+        self.num_opened = 0
+
+    def get_state(self) -> str:
+        """Return the current state of the breaker."""
+        if self._state == CircuitBreaker.STATE_OPEN and self._clock() - self._opened_at >= self.reset_secs:
+            return CircuitBreaker.STATE_HALF_OPEN
+        return self._state
+
+    def allow_request(self) -> bool:
+        """Determine whether a request may be made.
+        When True is returned, the outcome of the request must be reported with
+        :meth:`record_success` or :meth:`record_failure`.
+        """
+        state = self.get_state()
+        if state == CircuitBreaker.STATE_CLOSED:
+            return True
+        # a trial request that has not reported back within reset_secs (e.g. because its
+        # greenlet was killed) is forgotten.
+        now = self._clock()
+        if state == CircuitBreaker.STATE_HALF_OPEN and (not self._trial_pending or
+                                                        now - self._trial_started >= self.reset_secs):
+            self._state = CircuitBreaker.STATE_HALF_OPEN
+            self._trial_pending = True
+            self._trial_started = now
+            return True
+        return False
+
+    def record_success(self) -> None:
+        """Report that a request succeeded."""
+        self._state = CircuitBreaker.STATE_CLOSED
+        self._numfails = 0
+        self._trial_pending = False
+
+    def record_failure(self) -> None:
+        """Report that a request failed."""
+        self._numfails += 1
+        if self._state == CircuitBreaker.STATE_HALF_OPEN or self._numfails >= self.fail_threshold:
+            if self._state != CircuitBreaker.STATE_OPEN:
+                self.num_opened += 1
+                logger.warning("QAI circuit breaker opened after %d failures", self._numfails)
+            self._state = CircuitBreaker.STATE_OPEN
+            self._opened_at = self._clock()
+            self._trial_pending = False
+
+
+class ReagentDetailMemo:
+    """An on-disk memo of the reagent details returned by QAI's reagent show call
+    (see :meth:`QAISession._get_reagent_items`).
+
+    The details are stored together with a key made of the change numbers of the QAI tables
+    they are derived from. The details of a reagent are only returned for the key
+    they were stored with: a change in any of the tables discards all of them.
+    """
+
+    def __init__(self, fname: str) -> None:
+        """
+        Args:
+           fname: the file in which to keep the memo. It is read here if it exists.
+        """
+        self._fname = fname
+        self._scn: typing.Optional[str] = None
+        self._detail_dct: typing.Dict[int, dict] = {}
+        try:
+            with open(fname, 'rb') as fi:
+                scn, detail_dct = pickle.load(fi)
+        except (OSError, EOFError, pickle.UnpicklingError, ValueError, TypeError):
+            return
+        self._scn, self._detail_dct = scn, detail_dct
+
+    def lookup(self, scn: str, idlst: typing.List[int]) -> typing.Tuple[typing.Dict[int, dict], typing.List[int]]:
+        """Look up the details of the reagents in idlst.
+
+        Args:
+           scn: the current key of the details.
+           idlst: the ids of the reagents.
+        Returns:
+           A dict of the details found, keyed by reagent id, and a list of the ids not found.
+        """
+        if scn != self._scn:
+            return {}, list(idlst)
+        detail_dct = self._detail_dct
+        return ({reag_id: detail_dct[reag_id] for reag_id in idlst if reag_id in detail_dct},
+                [reag_id for reag_id in idlst if reag_id not in detail_dct])
+
+    def store(self, scn: str, detail_dct: typing.Dict[int, dict]) -> None:
+        """Add the reagent details in detail_dct, retrieved under the key scn, and write the memo to disk.
+        Any details stored under a different key are discarded."""
+        if scn != self._scn:
+            self._scn = scn
+            self._detail_dct = {}
+        self._detail_dct.update(detail_dct)
+        tmpname = self._fname + '.tmp'
+        try:
+            with open(tmpname, 'wb') as fo:
+                pickle.dump((self._scn, self._detail_dct), fo, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmpname, self._fname)
+        except OSError as e:
+            logger.error("failed to write reagent memo {}: {}".format(self._fname, e))
+
+    def __len__(self) -> int:
+        return len(self._detail_dct)
+
+
 class Session(requests.Session):
     """A specialised Session specific methods for access to QAI"""
     _TEN_SECONDS = 10
 
-    def __init__(self, qai_path: str) -> None:
+    def __init__(self, qai_path: str, fetch_pool_size: int = FETCH_POOL_SIZE,
+                 response_cache: typing.Optional[ResponseCache] = None,
+                 timeout_dct: typing.Optional[typing.Dict[str, Timeout]] = None,
+                 breaker: typing.Optional[CircuitBreaker] = None) -> None:
         """
 
         Args:
            qai_path: the base string to be used to contact the QAI server.
+           fetch_pool_size: the maximum number of requests performed concurrently by
+              :meth:`fetch_concurrently`.
+           response_cache: if provided, the responses to :meth:`get_json` calls
+              are cached here.
+           timeout_dct: the request timeouts of paths starting with the keys of this dict.
+              DEFAULT_TIMEOUT_DCT is used if this is not provided.
+           breaker: the circuit breaker used to fail fast while QAI is down.
+              A CircuitBreaker with the default parameters is used if this is not provided.
         """
         super().__init__()
+        self.response_cache = response_cache
+        if not isinstance(fetch_pool_size, int) or fetch_pool_size < 1:
+            raise ValueError("fetch_pool_size must be a positive int")
         self._islogged_in = False
+        # the name of the user logged in
+        self._qai_user: typing.Optional[str] = None
         self.qai_path = qai_path
+        self.fetch_pool_size = fetch_pool_size
+        self.timeout_dct = DEFAULT_TIMEOUT_DCT if timeout_dct is None else timeout_dct
+        self.breaker = breaker or CircuitBreaker()
+        # this is set (and replaced) in order to cancel the requests waiting for a retry
+        self._cancel_event = gevent.event.Event()
+        self._retry_counters: typing.Counter[str] = collections.Counter()
+        # accept compressed responses and keep the connections to QAI open between requests.
+        self.headers.update({'Accept-Encoding': ACCEPT_ENCODING, 'Connection': 'keep-alive'})
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=fetch_pool_size + HTTP_POOL_SPARE)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+        self._xfer_totals: typing.Counter[str] = collections.Counter()
+        self._decode_secs = 0.0
+        self._xfer_log: typing.Deque[dict] = collections.deque(maxlen=TRANSFER_LOG_SIZE)
+
+    def get_timeout(self, path: str) -> Timeout:
+        """Return the timeout to use for a request to path."""
+        for prefix, timeout in self.timeout_dct.items():
+            if path.startswith(prefix):
+                return timeout
+        return DEFAULT_TIMEOUT
+
+    def cancel_retries(self) -> None:
+        """Cancel all requests currently waiting to be retried.
+        These raise a QAIRetryCancelled exception. Requests made after this call
+        are not affected.
+        """
+        cancel_event, self._cancel_event = self._cancel_event, gevent.event.Event()
+        cancel_event.set()
+
+    def get_retry_stats(self) -> dict:
+        """Return the request counters of this session, e.g. for showing on the webclient.
+
+        Returns:
+           A dict with the counters 'requests' (requests made), 'failures' (requests
+           that raised an exception), 'timeouts', 'retries', 'rejected' (requests not
+           made because the breaker was open) and 'cancelled', as well as the
+           'breaker_state' and the number of times the breaker has opened ('breaker_opened').
+        """
+        klst = ['requests', 'failures', 'timeouts', 'retries', 'rejected', 'cancelled']
+        rdct: typing.Dict[str, typing.Any] = {k: self._retry_counters[k] for k in klst}
+        rdct.update(breaker_state=self.breaker.get_state(), breaker_opened=self.breaker.num_opened)
+        return rdct
+
+    def _record_transfer(self, path: str, resp: requests.Response,
+                         body_bytes: int, decode_secs: float) -> None:
+        """Record the transfer statistics of a response (see :meth:`get_transfer_stats`)."""
+        raw = resp.raw
+        # NOTE: the raw response counts the bytes read from the network, i.e. before decompression.
+        wire_bytes = raw.tell() if hasattr(raw, 'tell') else body_bytes
+        encoding = resp.headers.get('Content-Encoding', 'identity')
+        rec = dict(path=path, status=resp.status_code, encoding=encoding,
+                   wire_bytes=wire_bytes, body_bytes=body_bytes,
+                   elapsed=resp.elapsed.total_seconds(), decode_secs=decode_secs)
+        logger.debug("transfer %s", rec)
+        self._xfer_log.append(rec)
+        totals = self._xfer_totals
+        totals['requests'] += 1
+        totals['compressed'] += encoding != 'identity'
+        totals['wire_bytes'] += wire_bytes
+        totals['body_bytes'] += body_bytes
+        self._decode_secs += decode_secs
+
+    def get_transfer_stats(self) -> dict:
+        """Return the transfer statistics of the responses received by this session,
+        e.g. to measure the effect of compression on a slow network.
+
+        Returns:
+           A dict with the totals 'requests', 'compressed' (the number of responses
+           received compressed), 'wire_bytes' (the bytes of the response bodies as received),
+           'body_bytes' (the bytes after decompression) and 'decode_secs' (the time
+           spent parsing JSON), and 'recent', a list of dicts with these values
+           for the most recent requests, oldest first.
+        """
+        klst = ['requests', 'compressed', 'wire_bytes', 'body_bytes']
+        rdct: typing.Dict[str, typing.Any] = {k: self._xfer_totals[k] for k in klst}
+        rdct['decode_secs'] = self._decode_secs
+        rdct['recent'] = list(self._xfer_log)
+        return rdct
+
+    def fetch_concurrently(self, fetch_func: typing.Callable[..., typing.Any],
+                           arglst: typing.List[tuple]) -> typing.List[typing.Tuple[typing.Any,
+                                                                                   typing.Optional[Exception]]]:
+        """Call fetch_func for each argument tuple in arglst using a pool of
+        at most fetch_pool_size greenlets.
+        An exception raised by one call does not stop the others.
+
+        Returns:
+           A list, in the order of arglst, of (result, None) for calls that succeeded
+           and (None, exception) for calls that raised an exception.
+        """
+        def do_fetch(args: tuple) -> typing.Tuple[typing.Any, typing.Optional[Exception]]:
+            try:
+                return fetch_func(*args), None
+            except Exception as e:
+                return None, e
+        if self.fetch_pool_size == 1 or len(arglst) <= 1:
+            return [do_fetch(args) for args in arglst]
+        return gevent.pool.Pool(self.fetch_pool_size).map(do_fetch, arglst)
 
     def _login_resp(self, qai_user: str, password: str) -> requests.Response:
         """In this routine, we call self.post directly.. therefore we
@@ -122,6 +712,7 @@ class Session(requests.Session):
         if response.status_code == requests.codes.forbidden:  # @UndefinedVariable
             raise RuntimeError("Login failed for QAI user '{}'.".format(qai_user))
         self._islogged_in = True
+        self._qai_user = qai_user
 
     def login_try(self, qai_user: str, password: str) -> dict:
         """Try to login without raising any exceptions.
@@ -160,6 +751,7 @@ class Session(requests.Session):
                                                                                                          qai_user))
         # finally -- things seem to have worked out
         self._islogged_in = True
+        self._qai_user = qai_user
         return dict(ok=True,
                     msg="Access granted for user {}".format(qai_user),
                     username=qai_user)
@@ -172,6 +764,7 @@ class Session(requests.Session):
         if rcode != HTTP_OK:
             raise RuntimeError("call {}  failed with status {}".format(url, rcode))
         self._islogged_in = False
+        self._qai_user = None
 
     def is_logged_in(self) -> bool:
         """
@@ -186,7 +779,9 @@ class Session(requests.Session):
                         data: typing.Any = None,
                         params: dict = None,
                         retries: int = 3,
-                        expect_json: bool = True) -> requests.Response:
+                        expect_json: bool = True,
+                        stream: bool = False,
+                        extra_headers: typing.Optional[typing.Dict[str, str]] = None) -> requests.Response:
         if not self._islogged_in:
             raise RuntimeError("Must log in before using the call API")
         json_data = data and tojson(data)
@@ -199,16 +794,28 @@ class Session(requests.Session):
             headers['Content-Type'] = 'application/json'
         else:
             headers['Content-Type'] = 'text/plain;charset=utf-8'
+        if extra_headers:
+            headers.update(extra_headers)
         # print("RRR expect_json {}, json_data: {}".format(expect_json, json_data))
+        timeout = self.get_timeout(path)
+        cancel_event = self._cancel_event
+        counters = self._retry_counters
+        breaker = self.breaker
         retries_remaining = retries
-        average_delay = 20
+        delay = RETRY_BASE_DELAY
         while True:
+            if not breaker.allow_request():
+                counters['rejected'] += 1
+                raise QAIUnavailableError("QAI is unavailable: not requesting {}".format(path))
+            counters['requests'] += 1
             try:
                 response = method(
                     self.qai_path + path,
                     data=json_data,
                     params=params,
-                    headers=headers)
+                    headers=headers,
+                    stream=stream,
+                    timeout=timeout)
                 # 2018-07-05: QAI will in general return 500 when it is unhappy
                 # with an attempted operation (e.g. when using POST to create
                 # a reagent that already exists). This is not quite comme-il-faut, but
@@ -216,50 +823,79 @@ class Session(requests.Session):
                 # exception here in such a case, but allow the higher ups to handle
                 # the error messages contained in the returned json data.
                 # response.raise_for_status()
+                if response.status_code in HTTP_GATEWAY_ERRORS:
+                    counters['failures'] += 1
+                    breaker.record_failure()
+                else:
+                    breaker.record_success()
                 return response
             # in some cases, we should not retry, but give up right away.
-            except requests.exceptions.InvalidURL:
-                raise
-            except requests.exceptions.HTTPError:
-                raise
-            except requests.exceptions.ConnectionError:
+            except (requests.exceptions.InvalidURL,
+                    requests.exceptions.HTTPError,
+                    requests.exceptions.ConnectionError):
+                counters['failures'] += 1
+                breaker.record_failure()
                 raise
-            except Exception:
-                if retries_remaining <= 0:
+            except Exception as e:
+                counters['failures'] += 1
+                breaker.record_failure()
+                # NOTE: a request that timed out may have been performed by QAI, only
+                # its response was lost. Only GET requests can safely be repeated.
+                is_timeout = isinstance(e, requests.exceptions.Timeout)
+                if is_timeout:
+                    counters['timeouts'] += 1
+                if retries_remaining <= 0 or (is_timeout and method != self.get):
                     logger.error('JSON request failed for %s',
                                  path,
                                  exc_info=True)
                     raise
-
-                # ten minutes with some noise
-                sleep_seconds = average_delay + Random().uniform(-10, 10)
+                sleep_seconds = delay * Random().uniform(0.5, 1.0)
                 logger.warning(
                     'JSON request failed. Sleeping for %ss before retry.',
                     sleep_seconds,
                     exc_info=True)
-                time.sleep(sleep_seconds)
+                # NOTE: waiting on a gevent event yields to other greenlets instead of
+                # blocking the server.
+                if cancel_event.wait(sleep_seconds):
+                    counters['cancelled'] += 1
+                    raise QAIRetryCancelled("request for {} cancelled".format(path))
+                counters['retries'] += 1
                 retries_remaining -= 1
-                average_delay += 600
-
-    def _retry_json(self, method, path, data=None, params=None, retries: int = 3) -> RequestValue:
-        r = self._retry_response(method, path, data=data, params=params, retries=retries)
-        return (r.status_code, r.json())
-
-    def patch_json(self, path: str, data: typing.Any, params=None, retries: int = 3) -> RequestValue:
+                delay = min(2.0*delay, RETRY_MAX_DELAY)
+
+    def _retry_json(self, method, path, data=None, params=None, retries: int = 3,
+                    extra_headers: typing.Optional[typing.Dict[str, str]] = None) -> RequestValue:
+        r = self._retry_response(method, path, data=data, params=params, retries=retries,
+                                 extra_headers=extra_headers)
+        return (r.status_code, self._decode_json(path, r))
+
+    def _decode_json(self, path: str, r: requests.Response) -> typing.Any:
+        """Return the JSON body of a response, recording its transfer statistics."""
+        t_start = time.perf_counter()
+        retval = r.json()
+        self._record_transfer(path, r, len(r.content), time.perf_counter() - t_start)
+        return retval
+
+    def patch_json(self, path: str, data: typing.Any, params=None, retries: int = 3,
+                   extra_headers: typing.Optional[typing.Dict[str, str]] = None) -> RequestValue:
         """Perform a patch operation, expecting a json response."""
-        return self._retry_json(self.patch, path, data=data, params=params, retries=retries)
+        return self._retry_json(self.patch, path, data=data, params=params, retries=retries,
+                                extra_headers=extra_headers)
 
-    def post_json(self, path: str, data: typing.Any, retries: int = 3) -> RequestValue:
+    def post_json(self, path: str, data: typing.Any, retries: int = 3,
+                  extra_headers: typing.Optional[typing.Dict[str, str]] = None) -> RequestValue:
         """ Post a JSON object to the web server, and return a JSON object.
 
         Args:
            path: the relative path to add to the qai_path used in login()
            data: a JSON object that will be converted to a JSON string
            retries: the number of times to retry the request before failing.
+           extra_headers: HTTP headers to send in addition to the default ones.
         Returns:
            The HTML status code with the response body, converted from JSON.
         """
-        return self._retry_json(self.post, path, data=data, retries=retries)
+        return self._retry_json(self.post, path, data=data, retries=retries,
+                                extra_headers=extra_headers)
 
     def generate_receive_url(self,
                              locid: typing.Optional[int],
@@ -297,11 +933,13 @@ class Session(requests.Session):
         """Perform a get call to the server, in which we do NOT expect a json response
         from the server.
         """
-        return self._retry_response(self.get,
-                                    path,
-                                    params=params,
-                                    retries=retries,
-                                    expect_json=False)
+        r = self._retry_response(self.get,
+                                 path,
+                                 params=params,
+                                 retries=retries,
+                                 expect_json=False)
+        self._record_transfer(path, r, len(r.content), 0.0)
+        return r
 
     def get_json(self, path: str, params: dict = None, retries=3) -> RequestValue:
         """Retrieve a JSON object from the web server using a http GET call.
@@ -312,8 +950,30 @@ class Session(requests.Session):
            retries: the number of times to retry the request before failing.
         Returns:
            The HTML response body, parsed as a JSON object.
+        Note:
+           If a response cache is used and path is cached, the response may be served from
+           the cache (see :class:`ResponseCache`).
         """
-        return self._retry_json(self.get, path, params=params, retries=retries)
+        cache = self.response_cache
+        if cache is None or not cache.is_cached_path(path):
+            return self._retry_json(self.get, path, params=params, retries=retries)
+        key = cache.make_key(path, params, self._qai_user)
+        entry = cache.lookup(key)
+        if entry is not None and cache.is_fresh(entry):
+            cache.count('hits')
+            return entry['status_code'], fromjson(entry['body'])
+        r = self._retry_response(self.get, path, params=params, retries=retries,
+                                 extra_headers=cache.validators(entry))
+        if r.status_code == HTTP_NOT_MODIFIED and entry is not None:
+            self._record_transfer(path, r, len(r.content), 0.0)
+            cache.count('revalidated')
+            cache.refresh(key, entry)
+            return entry['status_code'], fromjson(entry['body'])
+        cache.count('misses')
+        retval = self._decode_json(path, r)
+        if r.status_code == HTTP_OK:
+            cache.store(key, path, r)
+        return r.status_code, retval
 
     def delete_json(self, path: str, params: dict = None, retries=3) -> RequestValue:
         """Make a HTTP delete call
@@ -373,6 +1033,13 @@ DUMP_LOCATION = '/table_dump/qcs_location'
 DUMP_USERS = '/table_dump/qcs_users'
 
 
+# the default time to live in seconds of the cached responses of list endpoints.
+# These lists change rarely, and are revalidated with QAI after this time.
+DEFAULT_CACHE_TTL_DCT: typing.Dict[str, float] = {PATH_LOCATION_LIST: 300,
+                                                  PATH_REAGENT_LIST_SUPPLIERS: 3600,
+                                                  PATH_USER_LIST: 3600}
+
+
 QAIdct = typing.Dict[str, typing.Any]
 QAIChangedct = typing.Dict[str, str]
 QAIUpdatedct = typing.Dict[str, bool]
@@ -418,6 +1085,20 @@ class QAISession(Session):
     qai_key_lst = [k for k, u in data_url_lst]
     qai_key_set = frozenset(qai_key_lst)
 
+    def __init__(self, qai_path: str, fetch_pool_size: int = FETCH_POOL_SIZE,
+                 response_cache: typing.Optional[ResponseCache] = None,
+                 timeout_dct: typing.Optional[typing.Dict[str, Timeout]] = None,
+                 breaker: typing.Optional[CircuitBreaker] = None,
+                 reagent_memo: typing.Optional[ReagentDetailMemo] = None) -> None:
+        """See :class:`Session` for the arguments.
+        If reagent_memo is provided, the reagent details retrieved by :meth:`_get_reagent_items`
+        are kept here.
+        """
+        super().__init__(qai_path, fetch_pool_size, response_cache, timeout_dct, breaker)
+        self.reagent_memo = reagent_memo
+        # the tables that could not be downloaded in the last call to clever_update_qai_dump()
+        self._fetch_errors: typing.Dict[str, str] = {}
+
     @classmethod
     def get_empty_qaidct(cls) -> QAIdct:
         """Create a QAIdct representing 'no data'."""
@@ -462,6 +1143,11 @@ class QAISession(Session):
     def _get_reagent_items(self, reagent_lst: typing.List[dict]) -> typing.Dict[int, dict]:
         """Retrieve the reagent items for each reagent dict provided.
 
+        The reagents are requested concurrently (see :meth:`Session.fetch_concurrently`).
+        If a reagent memo is used, only the reagents not in the memo are requested.
+        No reagent is requested if the reagents and reagent items tables have not
+        changed since the memo was stored.
+
         Args:
            reagent_lst: a list of reagent dicts.
         Returns:
@@ -473,14 +1159,46 @@ class QAISession(Session):
         Raises:
            RuntimeError: if the response code from the QAI server is not HTTP_OK.
         """
-        rdct = {}
-        for reagent_dct in reagent_lst:
-            reag_id = reagent_dct['id']
-            rcode, r_show = self.get_json(PATH_REAGENT_SHOW, params=dict(id=reag_id))
-            if rcode != HTTP_OK:
-                raise RuntimeError("call for reagent_show id={}  failed".format(reag_id))
-            rdct[reag_id] = r_show
-        return rdct
+        idlst = [reagent_dct['id'] for reagent_dct in reagent_lst]
+        memo = self.reagent_memo
+        scn = ''
+        found_dct: typing.Dict[int, dict] = {}
+        missing_lst = idlst
+        if memo is not None and idlst:
+            scn = self._get_reagent_scn()
+            found_dct, missing_lst = memo.lookup(scn, idlst)
+        reslst = self.fetch_concurrently(self._get_reagent_show, [(reag_id, ) for reag_id in missing_lst])
+        new_dct = {reag_id: r_show for reag_id, (r_show, err) in zip(missing_lst, reslst) if err is None}
+        if memo is not None and new_dct:
+            memo.store(scn, new_dct)
+        errlst = [str(err) for r_show, err in reslst if err is not None]
+        if errlst:
+            raise RuntimeError("{} reagent show calls failed, e.g. {}".format(len(errlst), errlst[0]))
+        found_dct.update(new_dct)
+        return {reag_id: found_dct[reag_id] for reag_id in idlst}
+
+    def _get_reagent_show(self, reag_id: int) -> dict:
+        """Retrieve the details of a single reagent.
+
+        Raises:
+           RuntimeError: if the response code from the QAI server is not HTTP_OK.
+        """
+        rcode, r_show = self.get_json(PATH_REAGENT_SHOW, params=dict(id=reag_id))
+        if rcode != HTTP_OK:
+            raise RuntimeError("call for reagent_show id={}  failed".format(reag_id))
+        return r_show
+
+    def _get_reagent_scn(self) -> str:
+        """Return the key under which reagent details are stored in the reagent memo.
+        This combines the change numbers of the reagents and reagent items tables, as the
+        details of a reagent include its items.
+        """
+        urllst = [(DUMP_REAGENTS + "//scn", ), (DUMP_REAG_ITEMS + "//scn", )]
+        reslst = self.fetch_concurrently(self._get_changenumber, urllst)
+        for rval, err in reslst:
+            if err is not None:
+                raise err
+        return ":".join(rval for rval, err in reslst)
 
     def get_qai_changedata(self) -> QAIChangedct:
         """Retrieve the current QAI change value (Oracle's system change number)
@@ -492,17 +1210,91 @@ class QAISession(Session):
         Raises:
            RuntimeError: if the response code from the QAI server is not HTTP_OK.
         """
-        rdct: QAIChangedct = {}
-        for k, url in self.timestamp_url_lst:
-            # print("TRYING {} {}".format(k, url))
-            resp = self._rawget(url)
-            rcode = resp.status_code
-            rval = resp.text
-            # print("BLARESP rcode: {}, cont {}".format(rcode, rval))
-            if rcode != HTTP_OK:
-                raise RuntimeError("call {}  failed with status {}".format(url, rcode))
-            rdct[k] = rval
-        return rdct
+        reslst = self.fetch_concurrently(self._get_changenumber, [(url, ) for k, url in self.timestamp_url_lst])
+        errlst = ["{}: {}".format(k, err) for (k, url), (rval, err) in zip(self.timestamp_url_lst, reslst)
+                  if err is not None]
+        if errlst:
+            raise RuntimeError("change data call failed ({})".format(", ".join(errlst)))
+        return {k: rval for (k, url), (rval, err) in zip(self.timestamp_url_lst, reslst)}
+
+    def _get_changenumber(self, url: str) -> str:
+        """Retrieve the change number of a single table from url.
+
+        Raises:
+           RuntimeError: if the response code from the QAI server is not HTTP_OK.
+        """
+        resp = self._rawget(url)
+        rcode = resp.status_code
+        if rcode != HTTP_OK:
+            raise RuntimeError("call {}  failed with status {}".format(url, rcode))
+        return resp.text
+
+    def _get_table_dump(self, k: str, url: str) -> typing.Any:
+        """Retrieve the dump of the table k from url.
+
+        Raises:
+           RuntimeError: if the response code from the QAI server is not HTTP_OK
+           or the response is not valid JSON.
+        """
+        logger.debug('getting {} from QAI {}'.format(k, url))
+        try:
+            rcode, rval = self.get_json(url)
+        except json.decoder.JSONDecodeError:
+            raise RuntimeError("JSON error on {}".format(url))
+        if rcode != HTTP_OK:
+            raise RuntimeError("call for {} ({}) failed".format(k, url))
+        return rval
+
+    def stream_table_dump(self, k: str, url: str) -> typing.Iterator[dict]:
+        """Stream the dump of the table k from url.
+
+        The request is only made when iteration starts. The records are parsed
+        from the response body as it arrives, so that the complete table is never
+        held in memory.
+
+        Returns:
+           An iterator over the records of the table.
+        Raises:
+           QAIStreamError: (during iteration) if the request fails or the response is
+              not a valid JSON array.
+        """
+        logger.debug('streaming {} from QAI {}'.format(k, url))
+        try:
+            resp = self._retry_response(self.get, url, stream=True)
+        except requests.exceptions.RequestException as e:
+            raise QAIStreamError("call for {} ({}) failed: {}".format(k, url, e))
+        with contextlib.closing(resp):
+            if resp.status_code != HTTP_OK:
+                raise QAIStreamError("call for {} ({}) failed".format(k, url))
+            chunk_iter = _ChunkMeter(resp.iter_content(STREAM_CHUNK_SIZE))
+            # NOTE: only the time spent in the parser counts as decoding time,
+            # not the time the caller spends on each record.
+            parse_secs = 0.0
+            try:
+                rec_iter = iter_json_array(chunk_iter)
+                while True:
+                    t_start = time.perf_counter()
+                    try:
+                        rec = next(rec_iter)
+                    except StopIteration:
+                        break
+                    finally:
+                        parse_secs += time.perf_counter() - t_start
+                    yield rec
+            except ValueError as e:
+                raise QAIStreamError("JSON error on {}: {}".format(url, e))
+            except requests.exceptions.RequestException as e:
+                raise QAIStreamError("call for {} ({}) failed: {}".format(k, url, e))
+            self._record_transfer(url, resp, chunk_iter.nbytes, parse_secs - chunk_iter.wait_secs)
+
+    def get_fetch_errors(self) -> typing.Dict[str, str]:
+        """Return the tables that could not be downloaded in the last call to
+        :meth:`clever_update_qai_dump`.
+
+        Returns:
+           A dict with the table names as keys and error messages as values.
+        """
+        return self._fetch_errors
 
     def get_qai_dump(self) -> QAIDataset:
         """Retrieve the complete reagent database as a QAIDataset.
@@ -515,18 +1307,14 @@ class QAISession(Session):
         Raises:
            RuntimeError: if the response code from the QAI server is not HTTP_OK.
         """
-        rdct: QAIdct = {}
-        for k, url in self.data_url_lst:
-            try:
-                rcode, rval = self.get_json(url)
-            except json.decoder.JSONDecodeError:
-                raise RuntimeError("JSON error on {}".format(url))
-            if rcode != HTTP_OK:
-                raise RuntimeError("call for {} ({}) failed".format(k, url))
-            rdct[k] = rval
+        reslst = self.fetch_concurrently(self._get_table_dump, self.data_url_lst)
+        errlst = [str(err) for rval, err in reslst if err is not None]
+        if errlst:
+            raise RuntimeError("; ".join(errlst))
+        rdct: QAIdct = {k: rval for (k, url), (rval, err) in zip(self.data_url_lst, reslst)}
         return QAIDataset(rdct, self.get_qai_changedata())
 
-    def clever_update_qai_dump(self, qai_ds: QAIDataset) -> QAIUpdatedct:
+    def clever_update_qai_dump(self, qai_ds: QAIDataset, stream: bool = False) -> QAIUpdatedct:
         """Update only those parts of the QAI dataset that are out of date.
 
         For every QAI database table stored locally, we store in addition
@@ -535,9 +1323,14 @@ class QAISession(Session):
         by comparison, only update those entries in qaiDS from the server
         that are out of date.
         The timestamps stored in qaiDS are also updated as necessary.
+        The out of date tables are downloaded concurrently. A table that cannot be
+        downloaded is left unchanged, and the error is recorded (see :meth:`get_fetch_errors`).
 
         Args:
            qai_ds: the qai dataset to be updated if necessary.
+           stream: if True, the out of date tables are not downloaded here. Instead, they are
+              set to iterators returned by :meth:`stream_table_dump`, which download them
+              while they are being consumed (e.g. by ChemStockDB.load_qai_data()).
 
         Returns:
            Return a dictionary with identical keys to qaiDS (i.e. the names of
@@ -546,51 +1339,73 @@ class QAISession(Session):
            a boolean := "an update from the server occurred"
 
         Raises:
-           RuntimeError: if the response code from the QAI server is not HTTP_OK.
+           RuntimeError: if the dataset has the wrong keys or the change data
+              could not be retrieved.
         """
         tsdct = qai_ds.get_timestamp()
         qaidct = qai_ds.get_data()
         for dctname, tdct in [("tsdct", tsdct), ("qaidct", qaidct)]:
             if set(tdct.keys()) != self.qai_key_set:
                 raise RuntimeError("dct {} has wonky keys {}".format(dctname, tdct.keys()))
+        self._fetch_errors = {}
         newtsdct = self.get_qai_changedata()
-        retdct: QAIUpdatedct = {}
+        retdct: QAIUpdatedct = {k: False for k in self.qai_key_lst}
+        stale_lst = []
         for k, dataurl in self.data_url_lst:
-            new_timestamp = newtsdct[k]
-            do_update = retdct[k] = new_timestamp != tsdct[k]
-            if do_update:
-                # we need to update from the server
-                logger.debug('getting {} from QAI {}'.format(k, dataurl))
-                rcode, rval = self.get_json(dataurl)
-                if rcode != HTTP_OK:
-                    raise RuntimeError("call for {} ({}) failed".format(k, dataurl))
-                qaidct[k] = rval
-                tsdct[k] = new_timestamp
+            if newtsdct[k] != tsdct[k]:
+                stale_lst.append((k, dataurl))
             else:
                 logger.debug('skipping QAi {} url {}'.format(k, dataurl))
+        if stream:
+            for k, dataurl in stale_lst:
+                qaidct[k] = self.stream_table_dump(k, dataurl)
+                tsdct[k] = newtsdct[k]
+                retdct[k] = True
+            return retdct
+        reslst = self.fetch_concurrently(self._get_table_dump, stale_lst)
+        for (k, dataurl), (rval, err) in zip(stale_lst, reslst):
+            if err is None:
+                qaidct[k] = rval
+                tsdct[k] = newtsdct[k]
+                retdct[k] = True
+            else:
+                logger.error('failed to get {} from QAI: {}'.format(k, err))
+                self._fetch_errors[k] = str(err)
         return retdct
 
-    def _post_reagitem_status(self, reag_item_id: int, new_state: str) -> RequestValue:
+    @staticmethod
+    def _idem_headers(idem_key: typing.Optional[str]) -> typing.Optional[typing.Dict[str, str]]:
+        return None if idem_key is None else {IDEMPOTENCY_HEADER: idem_key}
+
+    def _post_reagitem_status(self, reag_item_id: int, new_state: str,
+                              idem_key: typing.Optional[str] = None) -> RequestValue:
         upd_dct = {'qcs_reag_item_id': reag_item_id,
                    'status': new_state}
-        return self.post_json(PATH_REAGITEM_STATUS, data=upd_dct)
+        return self.post_json(PATH_REAGITEM_STATUS, data=upd_dct,
+                              extra_headers=self._idem_headers(idem_key))
 
-    def _set_reagitem_location(self, reag_item_id: int, locid: int) -> RequestValue:
+    def _set_reagitem_location(self, reag_item_id: int, locid: int,
+                               idem_key: typing.Optional[str] = None) -> RequestValue:
         time_string = timelib.loc_nowtime_as_string()
         print("GOOLY TIMESTRING '{}'".format(time_string))
         upd_dct = {'id': reag_item_id,
                    'qcs_location_id': locid,
                    'last_seen': time_string,
                    'notes': 'set by scotty'}
-        return self.patch_json(PATH_REAGENT_ITEM, data=upd_dct)
+        return self.patch_json(PATH_REAGENT_ITEM, data=upd_dct,
+                               extra_headers=self._idem_headers(idem_key))
 
-    def report_item_location(self, reag_item_id: int, locid: int, opstring: str) -> dict:
+    def report_item_location(self, reag_item_id: int, locid: int, opstring: str,
+                             idem_key: typing.Optional[str] = None) -> dict:
         """Report the location status of a reagent item to QAI.
 
         opstring
         'missing': the item is missing from the expected locid.
         'found'  : the item was found at the expected locid.
         'moved'  : the item was moved to the current locid (from somewhere else)
+
+        If idem_key is provided, it is sent as the IDEMPOTENCY_HEADER of the request,
+        so that reporting the same location change twice has no further effect.
         """
         if not isinstance(opstring, str):
             raise ValueError("opstring must be a string")
@@ -600,13 +1415,14 @@ class QAISession(Session):
             raise ValueError("locid must be an int")
         if opstring == 'missing':
             # report as missing
-            rcode, postres = self._post_reagitem_status(reag_item_id, 'MISSING')
+            rcode, postres = self._post_reagitem_status(reag_item_id, 'MISSING', idem_key)
             if rcode != HTTP_CREATED:
                 return dict(ok=False, rcode=rcode, res=postres)
         elif opstring in ('found', 'moved'):
             # confirm position, or set to current position.
-            rcode, postres = self._set_reagitem_location(reag_item_id, locid)
-
+            rcode, postres = self._set_reagitem_location(reag_item_id, locid, idem_key)
+            if rcode != HTTP_OK:
+                return dict(ok=False, rcode=rcode, res=postres)
         else:
             raise RuntimeError("illegal opstring='{}'".format(opstring))
         return dict(ok=True)
@@ -25,8 +25,17 @@ known_set = frozenset(['VERSION', 'RFID_REGION_CODE', 'TIME_ZONE',
                        'RFCOMM_PROGRAM', 'RFID_READER_BT_ADDRESS',
                        'RFID_SERVER_IP'])
 
+# these are keys that may be on file, with the values used when they are not.
+# QAI_PREFETCH_SECS: the interval in seconds at which the server checks QAI for changes
+#   while a user is logged in, and downloads them in the background. 0 means never.
+# QAI_OUTBOX_SECS: the interval in seconds at which the server tries to report committed
+#   location changes to QAI while a user is logged in. 0 means never.
+# RFID_PROBE_SECS: the time in seconds after the last response from the RFID reader
+#   after which the server checks that the reader is still responding. 0 means on every poll.
+optional_dct = {'QAI_PREFETCH_SECS': 300, 'QAI_OUTBOX_SECS': 10, 'RFID_PROBE_SECS': 30}
+
 # these are the keys on file PLUS the ones added after reading the yaml file
-valid_keys = known_set | frozenset(['TZINFO'])
+valid_keys = known_set | frozenset(optional_dct.keys()) | frozenset(['TZINFO'])
 
 
 def read_logging_config(yamlfilename: str) -> dict:
@@ -59,7 +68,7 @@ def read_server_config(yamlfilename: str) -> dict:
     if not isinstance(cfg_dct, dict):
         raise RuntimeError("config must be a single dict class , but found a {}".format(type(cfg_dct)))
     have_set = set(cfg_dct.keys())
-    unknown_set = have_set - known_set
+    unknown_set = have_set - known_set - set(optional_dct.keys())
     if unknown_set:
         raise RuntimeError("Unknown settings '{}'; known settings are '{}'".format(unknown_set,
                                                                                    ", ".join([n for n in known_set])))
@@ -67,6 +76,9 @@ def read_server_config(yamlfilename: str) -> dict:
     if missing_set:
         raise RuntimeError("Missing settings '{}'".format(", ".join([n for n in missing_set])))
 
+    for k, val in optional_dct.items():
+        cfg_dct.setdefault(k, val)
+
     # check the version string
     ver_flt = cfg_dct['VERSION']
     if math.fabs(ver_flt - VERSION_FLT) > 0.001:
@@ -93,4 +105,9 @@ def read_server_config(yamlfilename: str) -> dict:
         print("*** To get a list of all possible time zone names, set the time zone variable to '?' ***")
         raise RuntimeError('Unknown timezone')
     cfg_dct['TZINFO'] = tzinfo
+
+    for k in optional_dct:
+        secs = cfg_dct[k]
+        if not isinstance(secs, (int, float)) or secs < 0:
+            raise RuntimeError("{} must be a number >= 0, but got '{}'".format(k, secs))
     return cfg_dct
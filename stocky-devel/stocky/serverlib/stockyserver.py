@@ -16,10 +16,16 @@ import serverlib.ChemStock as ChemStock
 import serverlib.Taskmeister as Taskmeister
 import serverlib.serverconfig as serverconfig
 import serverlib.commlink as commlink
+import serverlib.yamlutil as yamlutil
 
 from webclient.commonmsg import CommonMSG
 
 
+# the directory in the state directory in which responses from QAI are cached.
+QAI_CACHE_DIR = 'qai-http-cache'
+# the file in the state directory in which reagent details from QAI are kept.
+QAI_REAGENT_MEMO_FILE = 'qai-reagent-details.memo'
+
 # NOTE: initial ideas for this program were taken from
 # random number thread -- BUT that was for flask socketIO, NOT flask sockets
 # https://github.com/shanealynn/async_flask/blob/master/application.py
@@ -122,8 +128,15 @@ class CommonStockyServer(BaseServer):
     web client makes websocket connection.
     """
 
+    # the maximum time in seconds that bt_init_reader() waits for the reader to
+    # answer the initialisation commands. The message loop is blocked meanwhile.
+    RFID_INIT_TIMEOUT_SECS = 10.0
+
     # the set of messages we simply pass on to the web client.
     MSG_FOR_WC_SET = frozenset([CommonMSG.MSG_SV_RAND_NUM,
+                                CommonMSG.MSG_SV_QAI_CHANGE_NOTICE,
+                                CommonMSG.MSG_SV_LOCMUT_PROGRESS,
+                                CommonMSG.MSG_SV_OUTBOX_STATUS,
                                 # CommonMSG.MSG_RF_STOCK_DATA,
                                 CommonMSG.MSG_RF_RADAR_DATA,
                                 CommonMSG.MSG_RF_CMD_RESP,
@@ -146,7 +159,9 @@ class CommonStockyServer(BaseServer):
                                 CommonMSG.MSG_WC_ADD_STOCK_REQ,
                                 CommonMSG.MSG_SV_TIMER_TICK,
                                 CommonMSG.MSG_WC_LOCATION_INFO,
-                                CommonMSG.MSG_WC_DO_LOCMUT_REQ])
+                                CommonMSG.MSG_WC_DO_LOCMUT_REQ,
+                                CommonMSG.MSG_WC_RESOLVE_REJECTED_REQ,
+                                CommonMSG.MSG_WC_RFID_LOOKUP_REQ])
 
     def __init__(self, logger: logging.Logger, cfgname: str) -> None:
         """
@@ -197,11 +212,28 @@ class CommonStockyServer(BaseServer):
         qai_url = self.cfg_dct['QAI_URL']
         qai_file = self.cfg_dct['LOCAL_STOCK_DB_FILE']
         self.logger.info("QAI info URL: '{}', file: '{}'".format(qai_url, qai_file))
-        self.qaisession = qai_helper.QAISession(qai_url)
+        cache_dir = yamlutil.get_filename(QAI_CACHE_DIR, serverconfig.STATE_DIR_ENV_NAME)
+        memo_file = yamlutil.get_filename(QAI_REAGENT_MEMO_FILE, serverconfig.STATE_DIR_ENV_NAME)
+        self.qaisession = qai_helper.QAISession(qai_url,
+                                                response_cache=qai_helper.ResponseCache(
+                                                    cache_dir, qai_helper.DEFAULT_CACHE_TTL_DCT),
+                                                reagent_memo=qai_helper.ReagentDetailMemo(memo_file))
         self.logger.info("Instantiating ChemStock")
         self.stockdb = ChemStock.ChemStockDB(qai_file,
                                              self.qaisession,
                                              self.cfg_dct['TIME_ZONE'])
+        # download changes from QAI in the background while a user is logged in
+        prefetch_secs = self.cfg_dct['QAI_PREFETCH_SECS']
+        if prefetch_secs > 0:
+            self.logger.info("Instantiating QAIPrefetcher")
+            self.prefetch_tm = Taskmeister.QAIPrefetcher(self.msgQ, self.logger,
+                                                         prefetch_secs, self.stockdb)
+        # report committed location changes to QAI in the background
+        outbox_secs = self.cfg_dct['QAI_OUTBOX_SECS']
+        if outbox_secs > 0:
+            self.logger.info("Instantiating OutboxDrainer")
+            self.outbox_tm = Taskmeister.OutboxDrainer(self.msgQ, self.logger,
+                                                       outbox_secs, self.stockdb)
         # now: get our current stock list from QAI
         self.logger.info("End of _init_db_server")
 
@@ -267,17 +299,29 @@ class CommonStockyServer(BaseServer):
     def bt_init_reader(self):
         """Initialise the RFID reader.
         This method should only be called when/if the RFID reader comes online.
-        Raise an exception if this fails."""
-        # set RFID region
-        reg_code = self.cfg_dct['RFID_REGION_CODE']
-        self.logger.debug("setting RFID region '{}'".format(reg_code))
-        self.tls.set_region(reg_code)
-        # set date and time to local time.
-        loc_t = timelib.loc_nowtime()
-        self.logger.debug("setting RFID date/time to '{}'".format(loc_t))
-        self.tls.set_date_time(loc_t.year, loc_t.month, loc_t.day,
-                               loc_t.hour, loc_t.minute, loc_t.second)
-        self.tls.bt_set_stock_check_mode()
+        Raise an exception if this fails.
+
+        The commands are pipelined: they are all sent before waiting for any response.
+        Commands that the reader rejects or that are not answered within
+        RFID_INIT_TIMEOUT_SECS are logged."""
+        self.tls.begin_pipeline()
+        try:
+            # set RFID region
+            reg_code = self.cfg_dct['RFID_REGION_CODE']
+            self.logger.debug("setting RFID region '{}'".format(reg_code))
+            self.tls.set_region(reg_code)
+            # set date and time to local time.
+            loc_t = timelib.loc_nowtime()
+            self.logger.debug("setting RFID date/time to '{}'".format(loc_t))
+            self.tls.set_date_time(loc_t.year, loc_t.month, loc_t.day,
+                                   loc_t.hour, loc_t.minute, loc_t.second)
+            self.tls.bt_set_stock_check_mode()
+        finally:
+            resplst = self.tls.end_pipeline(timeout=CommonStockyServer.RFID_INIT_TIMEOUT_SECS)
+        for cmdstr, clresp in resplst:
+            ret_code = clresp.return_code()
+            if ret_code != commlink.BaseCommLink.RC_OK:
+                self.logger.warning("RFID init: '{}' failed with return code {}".format(cmdstr.strip(), ret_code))
         self.send_server_config()
 
     def server_handle_msg(self, msg: CommonMSG) -> None:
@@ -318,7 +362,12 @@ class CommonStockyServer(BaseServer):
             # dict(ok=False, msg="User unknown", data=msg.data)))
         elif msg.msg == CommonMSG.MSG_WC_LOGOUT_TRY:
             # log out and send back response.
-            self.qaisession.logout()
+            # requests waiting for a retry would otherwise hold up the logout.
+            self.qaisession.cancel_retries()
+            try:
+                self.qaisession.logout()
+            except RuntimeError as err:
+                self.logger.warning("QAI logout failed: {}".format(err))
             log_state = self.qaisession.is_logged_in()
             self.send_ws_msg(CommonMSG(CommonMSG.MSG_SV_LOGOUT_RES,
                                        dict(logstate=log_state)))
@@ -328,7 +377,7 @@ class CommonStockyServer(BaseServer):
             print("chemstock 1 do_update={}".format(do_update))
             upd_dct: typing.Optional[dict] = None
             if do_update:
-                upd_dct = self.stockdb.update_from_qai()
+                upd_dct = self.stockdb.update_from_qai(stream=True)
                 print("update dct {}".format(upd_dct))
             print("chemstock 2..")
             self.send_qai_status(upd_dct)
@@ -358,12 +407,35 @@ class CommonStockyServer(BaseServer):
             self.send_ws_msg(CommonMSG(CommonMSG.MSG_SV_LOCMUT_RESP,
                                        dict(data=rdct, hash=newhash)))
         elif msg.msg == CommonMSG.MSG_WC_DO_LOCMUT_REQ:
+            # the changes are committed locally right away; the OutboxDrainer
+            # reports them to QAI in the background.
             move_dct = msg.data['locmove']
-            res = self.stockdb.perform_loc_changes(move_dct)
+            res = self.stockdb.commit_loc_changes(move_dct)
             self.send_ws_msg(CommonMSG(CommonMSG.MSG_SV_DO_LOCMUT_RESP,
                                        dict(data=res)))
-            self.en_queue(CommonMSG(CommonMSG.MSG_WC_STOCK_INFO_REQ, dict(do_update=True)))
+            self.send_ws_msg(CommonMSG(CommonMSG.MSG_SV_OUTBOX_STATUS,
+                                       self.stockdb.get_outbox_status()))
             self.en_queue(CommonMSG(CommonMSG.MSG_WC_LOCMUT_REQ, dict(data=None)))
+        elif msg.msg == CommonMSG.MSG_WC_RESOLVE_REJECTED_REQ:
+            # a location change refused by QAI holds back the later changes of its
+            # reagent item until it is either reported again or discarded.
+            itmlst = msg.data.get('reag_item_ids', None)
+            do_retry = msg.data.get('do_retry', None)
+            if not isinstance(itmlst, list) or not all(isinstance(i, int) for i in itmlst) or \
+               not isinstance(do_retry, bool):
+                self.logger.error("illegal resolve rejected data {}".format(msg.data))
+            else:
+                for reag_item_id in itmlst:
+                    self.stockdb.resolve_rejected(reag_item_id, do_retry)
+            self.send_ws_msg(CommonMSG(CommonMSG.MSG_SV_OUTBOX_STATUS,
+                                       self.stockdb.get_outbox_status()))
+        elif msg.msg == CommonMSG.MSG_WC_RFID_LOOKUP_REQ:
+            rfidlst = msg.data.get('rfids', None)
+            if not isinstance(rfidlst, list) or not all(isinstance(rfid, str) for rfid in rfidlst):
+                resdct = dict(ok=False, msg="expected a list of RFID strings")
+            else:
+                resdct = dict(ok=True, data=self.stockdb.lookup_rfids(rfidlst))
+            self.send_ws_msg(CommonMSG(CommonMSG.MSG_SV_RFID_LOOKUP_RESP, resdct))
         else:
             self.logger.error("server not handling message {}".format(msg))
             raise RuntimeError("unhandled message {}".format(msg))
@@ -416,8 +488,14 @@ class CommonStockyServer(BaseServer):
             dbreq_ok = True
             dbreq_msg = "NOTE: No update from QAI database performed."
         wc_stock_dct = self.stockdb.generate_webclient_stocklist()
+        xfer_dct = self.qaisession.get_transfer_stats()
+        qai_stats = dict(self.qaisession.get_retry_stats(),
+                         wire_bytes=xfer_dct['wire_bytes'],
+                         body_bytes=xfer_dct['body_bytes'],
+                         decode_secs=round(xfer_dct['decode_secs'], 3))
         self.send_ws_msg(CommonMSG(CommonMSG.MSG_SV_STOCK_INFO_RESP,
                                    dict(db_stats=self.stockdb.get_db_stats(),
+                                        qai_stats=qai_stats,
                                         upd_time=self.stockdb.get_update_time(),
                                         stock_dct=wc_stock_dct,
                                         did_dbreq=did_dbreq,
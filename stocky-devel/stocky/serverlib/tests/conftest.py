@@ -5,6 +5,8 @@ This can be read by a Sphinx plugin for documentation of test results.
 import pytest
 import yaml
 
+import serverlib.fakeqai as fakeqai
+
 
 def pytest_addoption(parser):
     """Add some extra options to pytest in order to control which tests to run."""
@@ -17,6 +19,8 @@ def pytest_addoption(parser):
 dump of the QAI system. This can be used in tests marked --with_chemstock.""")
     parser.addoption('--with_cs_qai', action='store_true', dest="with_cs_qai",
                      default=False, help="enable tests that update chemstock from QAI")
+    parser.addoption('--with_bench', action='store_true', dest="with_bench",
+                     default=False, help="enable benchmark tests that run on large synthetic data sets")
     # add the option for the scospec plugin
     parser.addoption(
         '--scospec', action='store', dest='scospecfile', type=str,
@@ -24,6 +28,16 @@ dump of the QAI system. This can be used in tests marked --with_chemstock.""")
     )
 
 
+@pytest.fixture
+def fake_qai():
+    """Provide a running FakeQAIServer serving a small synthetic data set.
+    The server's latency and error_rate can be set in the test."""
+    srv = fakeqai.FakeQAIServer(fakeqai.make_synthetic_qaidct(100))
+    srv.start()
+    yield srv
+    srv.stop()
+
+
 def tup_from_item(item):
     node_parts = item.nodeid.split('::')
     plen = len(node_parts)
@@ -1,12 +1,24 @@
 """ Test the ChemStock module
 """
 
+import typing
+import sys
+import gc
 import pytest
 import time
+import datetime
+import py
+import threading
+import tracemalloc
+import json
+import sqlalchemy
+import gevent
 
 import serverlib.timelib as timelib
 import serverlib.yamlutil as yamlutil
 import serverlib.qai_helper as qai_helper
+import serverlib.chemdb as chemdb
+import serverlib.fakeqai as fakeqai
 
 
 import serverlib.ChemStock as ChemStock
@@ -19,10 +31,33 @@ withchemstock = pytest.mark.skipif(not pytest.config.option.with_chemstock,
 withchemstockANDqa1 = pytest.mark.skipif(not pytest.config.option.with_cs_qai,
                                          reason="needs --with_cs_qai option in order to run")
 
+withbench = pytest.mark.skipif("not config.getoption('with_bench')",
+                               reason="needs --with_bench option in order to run")
+
 
 TIME_ZONE = "America/Vancouver"
 
 
+def make_synthetic_qaids(num_items: int, stamp: str = 'synthetic01', **kw) -> qai_helper.QAIDataset:
+    """Generate a QAIDataset using :func:`fakeqai.make_synthetic_qaidct` with the
+    same timestamp string for all tables."""
+    tsdct = {k: stamp for k in qai_helper.QAISession.qai_key_lst}
+    return qai_helper.QAIDataset(fakeqai.make_synthetic_qaidct(num_items, **kw), tsdct)
+
+
+def orm_load_table(csdb: ChemStock.ChemStockDB, classname, reclst: typing.List[dict]) -> None:
+    """Load a database table one ORM object at a time.
+    This is the way ChemStockDB.load_qai_data() used to work, and is used
+    as a reference in benchmarks."""
+    s = csdb._sess
+    s.query(classname).delete()
+    s.commit()
+    kset = set(classname.__table__.columns.keys())
+    for r_dct in reclst:
+        s.add(classname(**{k: v for k, v in r_dct.items() if k in kset}))
+    s.commit()
+
+
 class TestFuncs:
     """Test a number of helper functions in the chemdb module,
     These functions do not depend on having a chemdbDB instance.
@@ -334,6 +369,1335 @@ class Test_Chemstock_EMPTYDB(CommonTests):
         # assert False, "force fail"
 
 
+class Test_Chemstock_synthetic(CommonTests):
+    """Tests in which the database contains a small synthetic data set."""
+    num_items: int
+    csdb: ChemStock.ChemStockDB
+    qaids: qai_helper.QAIDataset
+
+    @classmethod
+    def setup_class(cls) -> None:
+        cls.num_items = 200
+        cls.csdb = ChemStock.ChemStockDB(None, None, TIME_ZONE, batch_size=64)
+        cls.qaids = make_synthetic_qaids(cls.num_items)
+        load_ok = cls.csdb.load_qai_data(cls.qaids)
+        assert load_ok, "data load failed"
+
+    def test_batch_size01(self) -> None:
+        """Instantiating a ChemStockDB with an illegal batch_size must raise a ValueError."""
+        bad_lst: typing.List[typing.Any] = [0, -1, 1.5, None]
+        for bad_size in bad_lst:
+            with pytest.raises(ValueError):
+                ChemStock.ChemStockDB(None, None, TIME_ZONE, batch_size=bad_size)
+
+    def test_load_stats01(self) -> None:
+        """After load_qai_data(), get_load_stats() must report the number of rows loaded
+        for each table, and these must agree with get_db_stats()."""
+        csdb = self.csdb
+        qaidct = self.qaids.get_data()
+        db_stats = csdb.get_db_stats()
+        load_stats = csdb.get_load_stats()
+        print("load stats {}".format(load_stats))
+        exp_keys = qai_helper.QAISession.qai_key_set | {chemdb.ITEM_STATE_TABLE}
+        assert set(load_stats.keys()) == exp_keys, "unexpected keys"
+        for k, sdct in load_stats.items():
+            if k == chemdb.ITEM_STATE_TABLE:
+                assert sdct['nrows'] == self.num_items, "one state per reagent item expected"
+                continue
+            assert sdct['nrows'] == len(qaidct[k]), "unexpected nrows"
+            assert db_stats[k] == len(qaidct[k]), "unexpected number of records"
+            assert sdct['rows_per_sec'] >= 0.0, "positive rate expected"
+
+    def test_reload01(self) -> None:
+        """Reloading a table with an update_dct must replace its contents and leave
+        the other tables alone."""
+        csdb = self.csdb
+        S = qai_helper.QAISession
+        newds = make_synthetic_qaids(self.num_items//2, stamp='synthetic02', seed=99)
+        upd_dct = {k: k == S.QAIDCT_REAITEM_STATUS for k in S.qai_key_lst}
+        csdb.load_qai_data(newds, upd_dct)
+        db_stats = csdb.get_db_stats()
+        assert db_stats[S.QAIDCT_REAITEM_STATUS] == len(newds.get_data()[S.QAIDCT_REAITEM_STATUS])
+        assert db_stats[S.QAIDCT_REAGENT_ITEMS] == self.num_items
+        assert set(csdb.get_load_stats().keys()) == {S.QAIDCT_REAITEM_STATUS, chemdb.ITEM_STATE_TABLE}
+        tsdct = csdb.get_ts_data()
+        assert tsdct[S.QAIDCT_REAITEM_STATUS] == 'synthetic02', "stamp not updated"
+        assert tsdct[S.QAIDCT_REAGENT_ITEMS] == 'synthetic01', "stamp should not have changed"
+        # restore the original state
+        csdb.load_qai_data(self.qaids)
+
+
+class SyntheticQAISession(qai_helper.QAISession):
+    """A QAISession that is always logged in and serves a synthetic QAIDataset
+    instead of accessing a QAI server."""
+
+    def __init__(self, qaids: qai_helper.QAIDataset) -> None:
+        super().__init__('http://nonexistent.example.com')
+        self._islogged_in = True
+        self.qaids = qaids
+
+    def get_qai_changedata(self) -> qai_helper.QAIChangedct:
+        return dict(self.qaids.get_timestamp())
+
+    def clever_update_qai_dump(self, qai_ds: qai_helper.QAIDataset, stream: bool = False) -> qai_helper.QAIUpdatedct:
+        tsdct = qai_ds.get_timestamp()
+        qaidct = qai_ds.get_data()
+        retdct: qai_helper.QAIUpdatedct = {}
+        for k, new_stamp in self.get_qai_changedata().items():
+            do_update = retdct[k] = new_stamp != tsdct[k]
+            if do_update:
+                qaidct[k] = [dict(r_dct) for r_dct in self.qaids.get_data()[k]]
+                tsdct[k] = new_stamp
+        return retdct
+
+
+class Test_Chemstock_deltasync:
+    """Test loading data in delta sync mode."""
+
+    def setup_method(self) -> None:
+        self.qaids = make_synthetic_qaids(100)
+        self.csdb = ChemStock.ChemStockDB(None, None, TIME_ZONE)
+        self.csdb.load_qai_data(self.qaids)
+
+    def test_delta_nochange01(self) -> None:
+        """Loading the same data in delta sync mode must not change any rows."""
+        csdb = self.csdb
+        csdb.load_qai_data(self.qaids, delta_sync=True)
+        tab_changes = csdb.get_table_changes()
+        exp_keys = qai_helper.QAISession.qai_key_set | {chemdb.ITEM_STATE_TABLE}
+        assert set(tab_changes.keys()) == exp_keys, "unexpected keys"
+        for k, tdelta in tab_changes.items():
+            assert isinstance(tdelta, chemdb.TableDelta), "TableDelta expected"
+            assert tdelta.num_changes() == 0, "no changes expected in {}".format(k)
+
+    def test_delta_change01(self) -> None:
+        """A delta sync must apply exactly the inserts, updates and deletes required,
+        and result in the same table contents as a full reload."""
+        csdb = self.csdb
+        S = qai_helper.QAISession
+        qaidct = self.qaids.get_data()
+        statlst = [dict(r_dct) for r_dct in qaidct[S.QAIDCT_REAITEM_STATUS]]
+        upd_rec = statlst[3]
+        upd_rec['status'] = 'DISPOSED'
+        del_rec = statlst.pop(5)
+        new_rec = dict(statlst[0])
+        new_rec['id'] = 99999
+        statlst.append(new_rec)
+        qaidct[S.QAIDCT_REAITEM_STATUS] = statlst
+        upd_dct = {k: k == S.QAIDCT_REAITEM_STATUS for k in S.qai_key_lst}
+        csdb.load_qai_data(self.qaids, upd_dct, delta_sync=True)
+        tab_changes = csdb.get_table_changes()
+        assert set(tab_changes.keys()) == {S.QAIDCT_REAITEM_STATUS, chemdb.ITEM_STATE_TABLE}, "unexpected keys"
+        tdelta = tab_changes[S.QAIDCT_REAITEM_STATUS]
+        assert tdelta is not None, "a table delta expected"
+        assert tdelta.inserted == {99999}, "unexpected inserts"
+        assert tdelta.updated == {upd_rec['id']}, "unexpected updates"
+        assert tdelta.deleted == {del_rec['id']}, "unexpected deletes"
+        stat_dct = csdb.get_load_stats()[S.QAIDCT_REAITEM_STATUS]
+        assert stat_dct['ninserted'] == stat_dct['nupdated'] == stat_dct['ndeleted'] == 1
+        # compare with a full reload
+        got_lst = csdb.get_reagent_item_status_list()
+        refdb = ChemStock.ChemStockDB(None, None, TIME_ZONE)
+        refdb.load_qai_data(self.qaids)
+        assert refdb.get_table_changes()[S.QAIDCT_REAITEM_STATUS] is None, "None expected"
+        exp_lst = refdb.get_reagent_item_status_list()
+        assert sorted(got_lst, key=lambda a: a['id']) == sorted(exp_lst, key=lambda a: a['id'])
+
+    def test_update_from_qai01(self) -> None:
+        """update_from_qai() must perform a delta sync and report the number of changed rows.
+        The database must only be marked as changed if rows were actually changed."""
+        csdb = self.csdb
+        S = qai_helper.QAISession
+        csdb.generate_webclient_stocklist()
+        assert not csdb.has_changed(), "has_changed False expected"
+        # new timestamps, but the same data
+        newds = make_synthetic_qaids(100, stamp='synthetic02')
+        csdb.qaisession = SyntheticQAISession(newds)
+        retdct = csdb.update_from_qai()
+        print("retdct {}".format(retdct))
+        assert retdct['ok'], "ok expected"
+        assert all(cnt_dct == dict(ninserted=0, nupdated=0, ndeleted=0)
+                   for cnt_dct in retdct['changes'].values()), "no changes expected"
+        assert not csdb.has_changed(), "has_changed False expected"
+        # now change a single reagent item
+        itmlst = newds.get_data()[S.QAIDCT_REAGENT_ITEMS]
+        itmlst[0]['notes'] = 'moved by the delta sync test'
+        newds.get_timestamp()[S.QAIDCT_REAGENT_ITEMS] = 'synthetic03'
+        retdct = csdb.update_from_qai()
+        print("retdct {}".format(retdct))
+        assert retdct['ok'], "ok expected"
+        assert retdct['changes'] == {S.QAIDCT_REAGENT_ITEMS: dict(ninserted=0, nupdated=1, ndeleted=0)}
+        assert csdb.has_changed(), "has_changed True expected"
+
+    def test_stream_load01(self) -> None:
+        """Loading tables from iterators must give the same result as loading them from lists,
+        both in full and in delta sync mode."""
+        S = qai_helper.QAISession
+        qaidct = self.qaids.get_data()
+        statlst = [dict(r_dct) for r_dct in qaidct[S.QAIDCT_REAITEM_STATUS]]
+        statlst[3]['status'] = 'DISPOSED'
+        del statlst[5]
+        for delta_sync in (False, True):
+            csdb = ChemStock.ChemStockDB(None, None, TIME_ZONE, batch_size=7)
+            csdb.load_qai_data(self.qaids)
+            stream_dct = {k: iter(statlst if k == S.QAIDCT_REAITEM_STATUS else qaidct[k]) for k in S.qai_key_lst}
+            csdb.load_qai_data(qai_helper.QAIDataset(stream_dct, self.qaids.get_timestamp()), delta_sync=delta_sync)
+            assert csdb.get_load_stats()[S.QAIDCT_REAITEM_STATUS]['nrows'] == len(statlst)
+            refdb = ChemStock.ChemStockDB(None, None, TIME_ZONE)
+            ref_dct = dict(qaidct)
+            ref_dct[S.QAIDCT_REAITEM_STATUS] = statlst
+            refdb.load_qai_data(qai_helper.QAIDataset(ref_dct, self.qaids.get_timestamp()))
+            assert sorted(csdb.get_reagent_item_status_list(), key=lambda a: a['id']) == \
+                sorted(refdb.get_reagent_item_status_list(), key=lambda a: a['id'])
+            assert csdb.get_final_state_dct(None) == refdb.get_final_state_dct(None)
+            assert csdb.get_load_errors() == {}
+
+    def test_stream_error01(self) -> None:
+        """A table whose stream fails must be left unchanged, together with its time stamp."""
+        S = qai_helper.QAISession
+        csdb = self.csdb
+        qaidct = self.qaids.get_data()
+        old_lst = csdb.get_reagent_item_status_list()
+
+        def failing_stream() -> typing.Iterator[dict]:
+            yield from qaidct[S.QAIDCT_REAITEM_STATUS][:10]
+            raise qai_helper.QAIStreamError("connection lost")
+        for delta_sync in (False, True):
+            stream_dct = dict(qaidct)
+            stream_dct[S.QAIDCT_REAITEM_STATUS] = failing_stream()
+            tsdct = {k: 'synthetic02' for k in S.qai_key_lst}
+            csdb.load_qai_data(qai_helper.QAIDataset(stream_dct, tsdct), delta_sync=delta_sync)
+            assert set(csdb.get_load_errors().keys()) == {S.QAIDCT_REAITEM_STATUS}
+            assert csdb.get_reagent_item_status_list() == old_lst, "status table should be unchanged"
+            new_tsdct = csdb.get_ts_data()
+            assert new_tsdct[S.QAIDCT_REAITEM_STATUS] == 'synthetic01', "stamp should be unchanged"
+            assert new_tsdct[S.QAIDCT_REAGENTS] == 'synthetic02', "stamp should be updated"
+
+    def test_update_from_qai02(self, monkeypatch) -> None:
+        """A table that could not be downloaded must be reported, while the others are loaded."""
+        csdb = self.csdb
+        S = qai_helper.QAISession
+        newds = make_synthetic_qaids(100, stamp='synthetic02')
+        qaisession = SyntheticQAISession(newds)
+        csdb.qaisession = qaisession
+        org_clever_update = qaisession.clever_update_qai_dump
+
+        def failing_update(qai_ds: qai_helper.QAIDataset, stream: bool = False) -> qai_helper.QAIUpdatedct:
+            retdct = org_clever_update(qai_ds, stream)
+            retdct[S.QAIDCT_USERS] = False
+            qaisession._fetch_errors = {S.QAIDCT_USERS: 'call failed'}
+            return retdct
+        monkeypatch.setattr(qaisession, 'clever_update_qai_dump', failing_update)
+        retdct = csdb.update_from_qai()
+        print("retdct {}".format(retdct))
+        assert not retdct['ok'], "not ok expected"
+        assert S.QAIDCT_USERS in retdct['msg']
+        assert S.QAIDCT_USERS not in retdct['changes']
+        assert csdb.get_ts_data()[S.QAIDCT_REAGENTS] == 'synthetic02', "reagents stamp should be updated"
+
+
+class Test_Chemstock_incremental:
+    """Test the incremental regeneration of the webclient stock list."""
+
+    def setup_method(self) -> None:
+        self.qaids = make_synthetic_qaids(100)
+        self.csdb = ChemStock.ChemStockDB(None, None, TIME_ZONE)
+        self.csdb.load_qai_data(self.qaids)
+
+    def full_stocklist(self) -> dict:
+        """Generate the stock list from scratch from the current data set."""
+        refdb = ChemStock.ChemStockDB(None, None, TIME_ZONE)
+        refdb.load_qai_data(self.qaids)
+        return refdb.generate_webclient_stocklist()
+
+    def test_initial_build01(self) -> None:
+        """The first stock list must be built from scratch."""
+        csdb = self.csdb
+        csdb.generate_webclient_stocklist()
+        assert csdb._builder.last_rebuilt == set(chemdb.StockListBuilder.DEPENDS_DCT.keys())
+        assert csdb._builder.num_final_states == 100
+
+    def test_status_change01(self) -> None:
+        """A change in the status table must only recompute the final states of
+        the reagent items affected, and the result must be identical to a full rebuild."""
+        csdb = self.csdb
+        S = qai_helper.QAISession
+        csdb.generate_webclient_stocklist()
+        qaidct = self.qaids.get_data()
+        statlst = [dict(r_dct) for r_dct in qaidct[S.QAIDCT_REAITEM_STATUS]]
+        # one updated record, one deleted record and an item that becomes used up.
+        statlst[3]['status'] = 'EXPIRED'
+        del_rec = statlst.pop(10)
+        new_rec = dict(statlst[20])
+        new_rec['id'] = 99999
+        new_rec['status'] = 'USED_UP'
+        new_rec['occurred'] = '2030-01-01T00:00:00Z'
+        statlst.append(new_rec)
+        qaidct[S.QAIDCT_REAITEM_STATUS] = statlst
+        upd_dct = {k: k == S.QAIDCT_REAITEM_STATUS for k in S.qai_key_lst}
+        csdb.load_qai_data(self.qaids, upd_dct, delta_sync=True)
+        assert csdb.has_changed(), "has_changed True expected"
+        got_dct = csdb.generate_webclient_stocklist()
+        builder = csdb._builder
+        assert builder.last_rebuilt == {'ritemdct'}, "only ritemdct should be rebuilt"
+        affected = {statlst[3]['qcs_reag_item_id'], del_rec['qcs_reag_item_id'],
+                    new_rec['qcs_reag_item_id']}
+        # only the items whose state has actually changed are looked up
+        assert 0 < builder.num_final_states <= len(affected)
+        assert new_rec['qcs_reag_item_id'] not in got_dct['ritemdct'], "used up item expected to be removed"
+        assert got_dct == self.full_stocklist(), "incremental and full stock lists differ"
+
+    def test_item_change01(self) -> None:
+        """A change of location of a reagent item must rebuild the location structures."""
+        csdb = self.csdb
+        S = qai_helper.QAISession
+        csdb.generate_webclient_stocklist()
+        qaidct = self.qaids.get_data()
+        itmlst = [dict(r_dct) for r_dct in qaidct[S.QAIDCT_REAGENT_ITEMS]]
+        itmlst[0]['qcs_location_id'] = itmlst[1]['qcs_location_id'] + 1
+        qaidct[S.QAIDCT_REAGENT_ITEMS] = itmlst
+        csdb.load_qai_data(self.qaids, delta_sync=True)
+        got_dct = csdb.generate_webclient_stocklist()
+        assert csdb._builder.last_rebuilt == {'locdct', 'ritemdct'}
+        assert csdb._builder.num_final_states == 1
+        assert got_dct == self.full_stocklist(), "incremental and full stock lists differ"
+
+    def test_no_change01(self) -> None:
+        """The stock list must not be rebuilt if no rows have changed."""
+        csdb = self.csdb
+        stock_dct = csdb.generate_webclient_stocklist()
+        csdb.load_qai_data(self.qaids, delta_sync=True)
+        assert not csdb.has_changed(), "has_changed False expected"
+        csdb._builder.last_rebuilt = set()
+        assert csdb.generate_webclient_stocklist() == stock_dct, "same stock list expected"
+        assert csdb._builder.last_rebuilt == set(), "nothing should have been rebuilt"
+
+    def test_compact01(self) -> None:
+        """The stock list builder must keep its records in compact form with
+        interned strings, and the stock list must consist of dicts."""
+        csdb = self.csdb
+        stock_dct = csdb.generate_webclient_stocklist()
+        builder = csdb._builder
+        reag_item, (nom_state, ismissing, hasexpired) = next(iter(builder._ritemdct.values()))
+        assert issubclass(type(reag_item), tuple), "a compact record expected"
+        assert nom_state.status is sys.intern(str(nom_state.status)), "interned status expected"
+        d_item, (d_state, d_ismissing, d_hasexpired) = stock_dct['ritemdct'][reag_item.id]
+        assert d_item == chemdb.record_dict(reag_item)
+        assert d_state == chemdb.record_dict(nom_state)
+        reagent = next(iter(builder._reagentdct.values()))
+        assert 'location' not in reagent._fields, "location field should be removed"
+        assert isinstance(stock_dct['reagentdct'][reagent.id], dict)
+        # the same item dict is shared between locdct and ritemdct
+        for loc_id, (location, itmlst) in stock_dct['locdct'].items():
+            for d_item in itmlst:
+                if d_item['id'] in stock_dct['ritemdct']:
+                    assert d_item is stock_dct['ritemdct'][d_item['id']][0]
+
+
+class Test_Chemstock_itemstate:
+    """Test the reagent item state table."""
+
+    def setup_method(self) -> None:
+        self.qaids = make_synthetic_qaids(200)
+        self.csdb = ChemStock.ChemStockDB(None, None, TIME_ZONE)
+        self.csdb.load_qai_data(self.qaids)
+
+    def check_states(self, csdb: ChemStock.ChemStockDB) -> None:
+        """The state table must agree with the final states calculated from the status records."""
+        got_dct = csdb.get_final_state_dct(None)
+        exp_dct = chemdb.BaseDB.get_final_state_dct(csdb, None)
+        assert len(got_dct) == 200, "one state per reagent item expected"
+        assert got_dct == exp_dct, "state table differs from calc_final_state"
+
+    def test_state_parity01(self) -> None:
+        """After a full load, the state table must agree with calc_final_state()."""
+        csdb = self.csdb
+        self.check_states(csdb)
+        item_ids = {18003, 18010, 123456}
+        got_dct = csdb.get_final_state_dct(item_ids)
+        assert set(got_dct.keys()) == {18003, 18010}, "unexpected reagent items"
+
+    def test_state_delta01(self) -> None:
+        """A delta sync of the status table must only change the states of the
+        reagent items affected."""
+        csdb = self.csdb
+        S = qai_helper.QAISession
+        qaidct = self.qaids.get_data()
+        statlst = [dict(r_dct) for r_dct in qaidct[S.QAIDCT_REAITEM_STATUS]]
+        item_id = statlst[0]['qcs_reag_item_id']
+        new_rec = dict(statlst[0])
+        new_rec['id'] = 99999
+        new_rec['status'] = 'MISSING'
+        statlst.append(new_rec)
+        qaidct[S.QAIDCT_REAITEM_STATUS] = statlst
+        upd_dct = {k: k == S.QAIDCT_REAITEM_STATUS for k in S.qai_key_lst}
+        csdb.load_qai_data(self.qaids, upd_dct, delta_sync=True)
+        tdelta = csdb.get_table_changes()[chemdb.ITEM_STATE_TABLE]
+        assert tdelta is not None, "a table delta expected"
+        assert tdelta.updated == {item_id}, "only one state change expected"
+        assert csdb.get_final_state_dct({item_id})[item_id][1], "ismissing expected"
+        self.check_states(csdb)
+
+    def test_expiry_rollover01(self) -> None:
+        """A change of date must only update the hasexpired flags that have changed,
+        and the stock list must be updated accordingly."""
+        csdb = self.csdb
+        stock_dct = csdb.generate_webclient_stocklist()
+        num_expired = sum(hasexpired for nom_state, ismissing, hasexpired in
+                          csdb.get_final_state_dct(None).values())
+        assert num_expired > 0, "test data should contain expired reagent items"
+        # pretend it is 2000: nothing has expired
+        csdb._current_date = datetime.date(2000, 1, 1)
+        tdelta = csdb._update_expiry_flags()
+        assert tdelta is not None and len(tdelta.updated) == num_expired
+        self.check_states(csdb)
+        tdelta = csdb._update_expiry_flags()
+        assert tdelta is not None and tdelta.num_changes() == 0, "no changes expected"
+        # generating the stock list must detect the new day
+        new_dct = csdb.generate_webclient_stocklist()
+        assert csdb._builder.last_rebuilt == {'ritemdct'}, "only ritemdct should be rebuilt"
+        assert csdb._builder.num_final_states == num_expired
+        self.check_states(csdb)
+        assert new_dct == stock_dct, "stock list should be the same as before"
+
+    def test_legacy_db01(self, tmpdir: py.path.local) -> None:
+        """A database file without a state table must have one built when it is opened."""
+        fname = str(tmpdir.join('chemstock.sqlite'))
+        csdb = ChemStock.ChemStockDB(fname, None, TIME_ZONE)
+        csdb.load_qai_data(self.qaids)
+        csdb._sess.execute(ChemStock.Reagent_Item_State.__table__.delete())
+        csdb._sess.commit()
+        csdb._sess.close()
+        newdb = ChemStock.ChemStockDB(fname, None, TIME_ZONE)
+        self.check_states(newdb)
+
+
+class Test_Chemstock_queries:
+    """Test the targeted queries on the local database."""
+
+    def setup_method(self) -> None:
+        self.qaids = make_synthetic_qaids(1200, num_locs=20)
+        self.csdb = ChemStock.ChemStockDB(None, None, TIME_ZONE)
+        self.csdb.load_qai_data(self.qaids)
+        self.itmlst = self.csdb.get_reagent_item_list()
+
+    def test_indexes01(self) -> None:
+        """The secondary indexes must exist."""
+        inspector = sqlalchemy.inspect(self.csdb._engine)
+        for tabname, colname in [('reagent_item', 'qcs_location_id'),
+                                 ('reagent_item', 'qcs_reag_id'),
+                                 ('reagent_item', 'rfid'),
+                                 ('reag_item_status', 'qcs_reag_item_id')]:
+            idx_cols = [idx['column_names'] for idx in inspector.get_indexes(tabname)]
+            assert [colname] in idx_cols, "missing index on {}.{}".format(tabname, colname)
+
+    def test_items_at_location01(self) -> None:
+        """get_reagent_items_at_location() must return exactly the items at a location."""
+        locid = self.itmlst[7]['qcs_location_id']
+        got_lst = self.csdb.get_reagent_items_at_location(locid)
+        exp_lst = [itm for itm in self.itmlst if itm['qcs_location_id'] == locid]
+        assert len(exp_lst) > 1, "test data should have several items per location"
+        assert sorted(got_lst, key=lambda a: a['id']) == sorted(exp_lst, key=lambda a: a['id'])
+        assert self.csdb.get_reagent_items_at_location(-1) == []
+
+    def test_items_of_reagent01(self) -> None:
+        """get_reagent_items_of_reagent() must return exactly the items of a reagent."""
+        reag_id = self.itmlst[3]['qcs_reag_id']
+        got_lst = self.csdb.get_reagent_items_of_reagent(reag_id)
+        exp_lst = [itm for itm in self.itmlst if itm['qcs_reag_id'] == reag_id]
+        assert sorted(got_lst, key=lambda a: a['id']) == sorted(exp_lst, key=lambda a: a['id'])
+
+    def test_items_by_rfid01(self) -> None:
+        """get_reagent_items_by_rfid() must return the items with the RFIDs provided,
+        including lists longer than the maximum size of an IN clause."""
+        exp_lst = self.itmlst[:ChemStock.IN_CLAUSE_SIZE + 100]
+        rfidlst = [itm['rfid'] for itm in exp_lst] + ['NOT_AN_RFID']
+        got_lst = self.csdb.get_reagent_items_by_rfid(rfidlst)
+        assert sorted(got_lst, key=lambda a: a['id']) == sorted(exp_lst, key=lambda a: a['id'])
+        assert self.csdb.get_reagent_items_by_rfid([]) == []
+
+    def test_statuses_for_items01(self) -> None:
+        """get_reagent_item_status_list_for_items() must return exactly the statuses
+        of the items provided."""
+        item_ids = set([itm['id'] for itm in self.itmlst[:ChemStock.IN_CLAUSE_SIZE + 10]])
+        got_lst = self.csdb.get_reagent_item_status_list_for_items(item_ids)
+        exp_lst = [stat for stat in self.csdb.get_reagent_item_status_list()
+                   if stat['qcs_reag_item_id'] in item_ids]
+        assert sorted(got_lst, key=lambda a: a['id']) == sorted(exp_lst, key=lambda a: a['id'])
+
+    def test_lookup_rfids01(self) -> None:
+        """lookup_rfids() must resolve a scan of known and unknown RFIDs."""
+        scanlst = [itm['rfid'] for itm in self.itmlst[:200]] + ['UNKNOWN01', 'UNKNOWN02']
+        rdct = self.csdb.lookup_rfids(scanlst)
+        assert set(rdct.keys()) == set(scanlst), "unexpected keys"
+        for itm in self.itmlst[:200]:
+            assert rdct[itm['rfid']] == itm, "wrong reagent item"
+        assert rdct['UNKNOWN01'] is None and rdct['UNKNOWN02'] is None, "None expected"
+
+    def test_lookup_rfids02(self) -> None:
+        """The RFID index must follow changes to the reagent item table."""
+        csdb = self.csdb
+        S = qai_helper.QAISession
+        qaidct = self.qaids.get_data()
+        itmlst = [dict(r_dct) for r_dct in qaidct[S.QAIDCT_REAGENT_ITEMS]]
+        old_rfid = itmlst[0]['rfid']
+        itmlst[0]['rfid'] = 'RELABELLED01'
+        qaidct[S.QAIDCT_REAGENT_ITEMS] = itmlst
+        assert csdb.lookup_rfids([old_rfid])[old_rfid] is not None
+        csdb.load_qai_data(self.qaids, delta_sync=True)
+        rdct = csdb.lookup_rfids([old_rfid, 'RELABELLED01'])
+        assert rdct[old_rfid] is None, "old RFID should be gone"
+        new_item = rdct['RELABELLED01']
+        assert new_item is not None and new_item['id'] == itmlst[0]['id'], "new RFID expected"
+
+    def test_missing_indexes01(self, tmpdir: py.path.local) -> None:
+        """Indexes missing in an existing database file must be created when it is opened."""
+        fname = str(tmpdir.join('chemstock.sqlite'))
+        csdb = ChemStock.ChemStockDB(fname, None, TIME_ZONE)
+        csdb._sess.execute("DROP INDEX ix_reagent_item_rfid")
+        csdb._sess.commit()
+        csdb._sess.close()
+        newdb = ChemStock.ChemStockDB(fname, None, TIME_ZONE)
+        inspector = sqlalchemy.inspect(newdb._engine)
+        assert 'ix_reagent_item_rfid' in [idx['name'] for idx in inspector.get_indexes('reagent_item')]
+
+
+class Test_Chemstock_finalstate_engines:
+    """The SQL and python final state engines must produce the same results."""
+
+    # status sequences of reagent items that exercise the corner cases of calc_final_state()
+    CORNER_CASES = [[('EXPIRED', '2012-01-01')],
+                    [('IN_USE', '2012-01-01')],
+                    [('MADE', '2012-01-01'), ('IN_USE', '2012-02-01'), ('IN_USE', '2012-03-01')],
+                    [('MADE', '2012-01-01'), ('EXPIRED', '2013-01-01'), ('EXPIRED', '2099-01-01')],
+                    [('MADE', '2012-01-01'), ('MISSING', '2012-02-01'), ('EXPIRED', '2099-01-01')],
+                    [('MISSING', '2012-01-01'), ('MISSING', '2012-02-01')],
+                    [('MADE', '2012-01-01'), ('RUO', '2012-02-01'), ('USED_UP', '2012-03-01')],
+                    [('MADE', '2012-01-01'), ('DISPOSED', '2012-02-01'), ('EXPIRED', '2010-01-01')]]
+
+    def setup_method(self) -> None:
+        S = qai_helper.QAISession
+        qaidct = fakeqai.make_synthetic_qaidct(1000)
+        itmlst, statlst = qaidct[S.QAIDCT_REAGENT_ITEMS], qaidct[S.QAIDCT_REAITEM_STATUS]
+        stat_id = 90000
+        for ndx, state_seq in enumerate(Test_Chemstock_finalstate_engines.CORNER_CASES):
+            reag_item_id = 30000 + ndx
+            itm = dict(itmlst[0])
+            itm['id'] = reag_item_id
+            itm['rfid'] = 'CORNER{}'.format(ndx)
+            itmlst.append(itm)
+            for status, day in state_seq:
+                statlst.append(dict(id=stat_id, occurred=day + 'T00:00:00Z', qcs_reag_item_id=reag_item_id,
+                                    qcs_user_id=10000, status=status, qcs_validation_id=None))
+                stat_id += 1
+        self.qaids = qai_helper.QAIDataset(qaidct, {k: 'corner01' for k in S.qai_key_lst})
+
+    def test_engine_parity01(self) -> None:
+        """Both engines must agree with calc_final_state() for all reagent items."""
+        states_dct = {}
+        for engine in sorted(ChemStock.FINAL_STATE_ENGINES):
+            csdb = ChemStock.ChemStockDB(None, None, TIME_ZONE, final_state_engine=engine)
+            csdb.load_qai_data(self.qaids)
+            got_dct = csdb.get_final_state_dct(None)
+            exp_dct = chemdb.BaseDB.get_final_state_dct(csdb, None)
+            assert got_dct == exp_dct, "engine {} differs from calc_final_state".format(engine)
+            states_dct[engine] = sorted(csdb._calc_item_states(None), key=lambda a: a['qcs_reag_item_id'])
+            # the state table rebuilt in place must agree as well
+            csdb._rebuild_item_states()
+            assert csdb.get_final_state_dct(None) == exp_dct, "engine {}: rebuild differs".format(engine)
+        assert states_dct['python'] == states_dct['sql'], "engines differ"
+
+    def test_engine_parity02(self) -> None:
+        """Both engines must agree when calculating the states of a subset of reagent items."""
+        csdb = ChemStock.ChemStockDB(None, None, TIME_ZONE)
+        csdb.load_qai_data(self.qaids)
+        item_ids = set(range(18000, 18000 + ChemStock.IN_CLAUSE_SIZE + 50)) | set(range(30000, 30010))
+        sql_lst = sorted(csdb._calc_item_states_sql(item_ids), key=lambda a: a['qcs_reag_item_id'])
+        py_lst = sorted(csdb._calc_item_states_python(item_ids), key=lambda a: a['qcs_reag_item_id'])
+        assert len(sql_lst) == ChemStock.IN_CLAUSE_SIZE + 50 + 8
+        assert sql_lst == py_lst, "engines differ"
+
+    def test_bad_engine01(self) -> None:
+        """An unknown engine must raise a ValueError."""
+        with pytest.raises(ValueError):
+            ChemStock.ChemStockDB(None, None, TIME_ZONE, final_state_engine='fortran')
+
+
+class Test_Chemstock_storage:
+    """Test the storage profile and read-only connections of a database file."""
+
+    def test_storage_profile01(self, tmpdir: py.path.local) -> None:
+        """A database file must use the default storage profile and a read pool."""
+        csdb = ChemStock.ChemStockDB(str(tmpdir.join('chemstock.sqlite')), None, TIME_ZONE)
+        info_dct = csdb.get_storage_info()
+        print("storage info {}".format(info_dct))
+        assert info_dct['journal_mode'] == 'wal'
+        # NORMAL == 1
+        assert info_dct['synchronous'] == 1
+        assert info_dct['cache_size'] == ChemStock.DEFAULT_STORAGE_PROFILE['cache_size']
+        assert info_dct['read_pool'], "read pool expected"
+
+    def test_storage_profile02(self, tmpdir: py.path.local) -> None:
+        """Settings provided must override those of the default profile."""
+        csdb = ChemStock.ChemStockDB(str(tmpdir.join('chemstock.sqlite')), None, TIME_ZONE,
+                                     storage_profile=dict(journal_mode='DELETE', synchronous='FULL'))
+        info_dct = csdb.get_storage_info()
+        assert info_dct['journal_mode'] == 'delete'
+        # FULL == 2
+        assert info_dct['synchronous'] == 2
+
+    def test_storage_profile03(self) -> None:
+        """Illegal storage settings must raise a ValueError."""
+        bad_lst: typing.List[dict] = [dict(journal_mode='FAST'), dict(synchronous=1),
+                                      dict(cache_size='big'), dict(mmap_size=-1), dict(page_size=4096)]
+        for bad_profile in bad_lst:
+            with pytest.raises(ValueError):
+                ChemStock.ChemStockDB(None, None, TIME_ZONE, storage_profile=bad_profile)
+
+    def test_memory_db01(self) -> None:
+        """A database in memory cannot be shared between connections, so must not
+        use a read pool."""
+        csdb = ChemStock.ChemStockDB(None, None, TIME_ZONE)
+        assert not csdb.get_storage_info()['read_pool'], "no read pool expected"
+
+    def test_read_pool01(self, tmpdir: py.path.local) -> None:
+        """Queries must see committed writes, and the read connections must not be writable."""
+        csdb = ChemStock.ChemStockDB(str(tmpdir.join('chemstock.sqlite')), None, TIME_ZONE)
+        qaids = make_synthetic_qaids(50)
+        assert csdb.get_reagent_item_list() == []
+        csdb.load_qai_data(qaids)
+        assert len(csdb.get_reagent_item_list()) == 50
+        assert len(csdb.generate_webclient_stocklist()['ritemdct']) > 0
+        with pytest.raises(sqlalchemy.exc.OperationalError):
+            with csdb._reader() as conn:
+                conn.execute(ChemStock.Location.__table__.delete())
+
+
+class Test_Chemstock_snapshot:
+    """Test the stock list snapshot of a database file."""
+
+    def setup_method(self) -> None:
+        self.qaids = make_synthetic_qaids(100)
+
+    def make_db(self, tmpdir: py.path.local) -> ChemStock.ChemStockDB:
+        """Open the database file in tmpdir."""
+        return ChemStock.ChemStockDB(str(tmpdir.join('chemstock.sqlite')), None, TIME_ZONE)
+
+    def full_stocklist(self) -> dict:
+        """Generate the stock list from scratch from the current data set."""
+        refdb = ChemStock.ChemStockDB(None, None, TIME_ZONE)
+        refdb.load_qai_data(self.qaids)
+        return refdb.generate_webclient_stocklist()
+
+    def test_snapshot_load01(self, tmpdir: py.path.local) -> None:
+        """A snapshot whose key matches the database must be used without recomputation."""
+        csdb = self.make_db(tmpdir)
+        csdb.load_qai_data(self.qaids)
+        exp_dct = csdb.generate_webclient_stocklist()
+        assert tmpdir.join('chemstock.sqlite' + ChemStock.SNAPSHOT_SUFFIX).check(), "snapshot expected"
+        newdb = self.make_db(tmpdir)
+        assert newdb.snapshot_status == 'loaded'
+        assert newdb._builder.last_rebuilt == set(), "nothing should have been rebuilt"
+        assert newdb.generate_webclient_stocklist() == exp_dct
+        assert newdb._builder.last_rebuilt == set(), "nothing should have been rebuilt"
+        rfid = self.qaids.get_data()[qai_helper.QAISession.QAIDCT_REAGENT_ITEMS][0]['rfid']
+        assert newdb.lookup_rfids([rfid])[rfid] is not None
+
+    def test_snapshot_stale01(self, tmpdir: py.path.local) -> None:
+        """A snapshot with different table stamps must be rebuilt in the background.
+        The old snapshot is served until this has finished."""
+        S = qai_helper.QAISession
+        csdb = self.make_db(tmpdir)
+        csdb.load_qai_data(self.qaids)
+        old_dct = csdb.generate_webclient_stocklist()
+        # change the database without updating the snapshot
+        qaidct = self.qaids.get_data()
+        qaidct[S.QAIDCT_REAGENT_ITEMS] = qaidct[S.QAIDCT_REAGENT_ITEMS][:50]
+        self.qaids.get_timestamp()[S.QAIDCT_REAGENT_ITEMS] = 'synthetic02'
+        csdb.load_qai_data(self.qaids, delta_sync=True)
+        newdb = self.make_db(tmpdir)
+        assert newdb.snapshot_status == 'rebuilding'
+        got_dct = newdb.generate_webclient_stocklist()
+        if newdb.snapshot_status == 'rebuilding':
+            assert got_dct == old_dct, "old snapshot expected"
+        bg_result = newdb._bg_result
+        assert bg_result is not None, "a background rebuild expected"
+        bg_result.wait()
+        exp_dct = self.full_stocklist()
+        assert newdb.generate_webclient_stocklist() == exp_dct
+        assert newdb.snapshot_status == 'rebuilt'
+        # the rebuilt stock list must have been written to the snapshot
+        assert self.make_db(tmpdir).snapshot_status == 'loaded'
+
+    def test_snapshot_stale02(self, tmpdir: py.path.local, monkeypatch) -> None:
+        """Changes loaded while the stock list is rebuilt in the background must be
+        applied to the rebuilt stock list, even if they were already applied
+        to the old one."""
+        S = qai_helper.QAISession
+        csdb = self.make_db(tmpdir)
+        csdb.load_qai_data(self.qaids)
+        csdb.generate_webclient_stocklist()
+        qaidct = self.qaids.get_data()
+        qaidct[S.QAIDCT_REAGENT_ITEMS] = qaidct[S.QAIDCT_REAGENT_ITEMS][:50]
+        self.qaids.get_timestamp()[S.QAIDCT_REAGENT_ITEMS] = 'synthetic02'
+        csdb.load_qai_data(self.qaids, delta_sync=True)
+        # the background build finishes reading the tables, then waits for us.
+        release = threading.Event()
+        orig_build = chemdb.StockListBuilder.build
+
+        def blocked_build(builder: chemdb.StockListBuilder, tab_changes) -> typing.Set[str]:
+            retval = orig_build(builder, tab_changes)
+            if threading.current_thread() is not threading.main_thread():
+                release.wait()
+            return retval
+        monkeypatch.setattr(chemdb.StockListBuilder, 'build', blocked_build)
+        newdb = self.make_db(tmpdir)
+        assert newdb.snapshot_status == 'rebuilding'
+        qaidct[S.QAIDCT_REAGENT_ITEMS] = qaidct[S.QAIDCT_REAGENT_ITEMS][:30]
+        self.qaids.get_timestamp()[S.QAIDCT_REAGENT_ITEMS] = 'synthetic03'
+        newdb.load_qai_data(self.qaids, delta_sync=True)
+        # the change is applied to the old stock list while it is served
+        old_dct = newdb.generate_webclient_stocklist()
+        assert newdb.snapshot_status == 'rebuilding'
+        release.set()
+        bg_result = newdb._bg_result
+        assert bg_result is not None, "a background rebuild expected"
+        bg_result.wait()
+        exp_dct = self.full_stocklist()
+        assert old_dct == exp_dct
+        assert newdb.generate_webclient_stocklist() == exp_dct
+        assert newdb.snapshot_status == 'rebuilt'
+
+    def test_snapshot_missing01(self, tmpdir: py.path.local) -> None:
+        """Without a usable snapshot, the stock list must be built before it is served."""
+        csdb = self.make_db(tmpdir)
+        csdb.load_qai_data(self.qaids)
+        csdb.generate_webclient_stocklist()
+        snap_path = tmpdir.join('chemstock.sqlite' + ChemStock.SNAPSHOT_SUFFIX)
+        for content in [None, b'not a snapshot']:
+            if content is None:
+                snap_path.remove()
+            else:
+                snap_path.write_binary(content)
+            newdb = self.make_db(tmpdir)
+            assert newdb.snapshot_status == 'rebuilding'
+            assert newdb.generate_webclient_stocklist() == self.full_stocklist()
+            assert chemdb.read_snapshot(str(snap_path)) is not None, "snapshot expected"
+
+    def test_snapshot_version01(self, tmpdir: py.path.local) -> None:
+        """A snapshot of a different format version must be ignored."""
+        fname = str(tmpdir.join('test.stocklist.gz'))
+        chemdb.write_snapshot(fname, dict(a=1), dict(b=2))
+        assert chemdb.read_snapshot(fname) == (dict(a=1), dict(b=2))
+        chemdb.SNAPSHOT_VERSION += 1
+        try:
+            assert chemdb.read_snapshot(fname) is None
+        finally:
+            chemdb.SNAPSHOT_VERSION -= 1
+
+    def test_no_snapshot01(self, tmpdir: py.path.local) -> None:
+        """No snapshot must be written if use_snapshot is False."""
+        csdb = ChemStock.ChemStockDB(str(tmpdir.join('chemstock.sqlite')), None, TIME_ZONE,
+                                     use_snapshot=False)
+        csdb.load_qai_data(self.qaids)
+        csdb.generate_webclient_stocklist()
+        assert not tmpdir.join('chemstock.sqlite' + ChemStock.SNAPSHOT_SUFFIX).check()
+        assert csdb.snapshot_status == 'none'
+
+
+class ReportQAISession(SyntheticQAISession):
+    """A SyntheticQAISession that records location reports after a delay.
+    Reports of reagent items in fail_set fail, those in raise_set raise an exception."""
+    DELAY_SECS = 0.1
+
+    def __init__(self, qaids: qai_helper.QAIDataset) -> None:
+        super().__init__(qaids)
+        self.fail_set: typing.Set[int] = set()
+        self.raise_set: typing.Set[int] = set()
+        self.reject_set: typing.Set[int] = set()
+        # reports of the reagent items in rcode_dct fail with the given HTTP status
+        self.rcode_dct: typing.Dict[int, int] = {}
+        self.reported: typing.List[typing.Tuple[int, int, str]] = []
+        self.keylst: typing.List[typing.Optional[str]] = []
+
+    def report_item_location(self, reag_item_id: int, locid: int, opstring: str,
+                             idem_key: typing.Optional[str] = None) -> dict:
+        gevent.sleep(self.DELAY_SECS)
+        self.keylst.append(idem_key)
+        if reag_item_id in self.raise_set:
+            raise RuntimeError("connection lost")
+        if reag_item_id in self.fail_set:
+            return dict(ok=False, rcode=500, res=None)
+        if reag_item_id in self.reject_set:
+            return dict(ok=False, rcode=422, res=None)
+        if reag_item_id in self.rcode_dct:
+            return dict(ok=False, rcode=self.rcode_dct[reag_item_id], res=None)
+        self.reported.append((reag_item_id, locid, opstring))
+        return dict(ok=True)
+
+
+# a time by which all retry delays in a test have expired
+OUTBOX_LATER_SECS = 2*ChemStock.OUTBOX_MAX_DELAY
+
+
+class Test_Chemstock_locreport:
+    """Test reporting location changes to QAI."""
+
+    def setup_method(self) -> None:
+        self.csdb = ChemStock.ChemStockDB(None, None, TIME_ZONE)
+        self.qaisession = self.csdb.qaisession = ReportQAISession(make_synthetic_qaids(10))
+        self.locid = 10001
+        self.idlst = list(range(18000, 18010))
+        self.csdb.add_loc_changes(self.locid, [(i, 'found') for i in self.idlst])
+
+    def get_move_dct(self) -> dict:
+        """Return the location changes as sent by the webclient."""
+        hashcode, move_dct = self.csdb.get_loc_changes()
+        assert move_dct is not None, "location changes expected"
+        return {str(locid): mvlst for locid, mvlst in move_dct.items()}
+
+    def test_report01(self) -> None:
+        """All location changes must be reported concurrently and then purged."""
+        progress_lst = []
+        t_start = time.time()
+        res = self.csdb.perform_loc_changes(self.get_move_dct(),
+                                            lambda *args: progress_lst.append(args))
+        t_elapsed = time.time() - t_start
+        assert res['ok'], "ok expected"
+        assert res['nsent'] == len(self.idlst) and res['nfailed'] == 0
+        assert set(res['items'].keys()) == set(self.idlst)
+        assert sorted(self.qaisession.reported) == [(i, self.locid, 'found') for i in self.idlst]
+        assert self.csdb.number_of_loc_changes() == 0, "reported changes must be purged"
+        assert len(progress_lst) == len(self.idlst)
+        assert progress_lst[-1] == (len(self.idlst), len(self.idlst), 0)
+        assert t_elapsed < ReportQAISession.DELAY_SECS*len(self.idlst)/2, "reports not concurrent"
+
+    def test_report02(self) -> None:
+        """A failed report must not stop the others, and only the failed
+        location changes must be kept in the outbox."""
+        failid, raiseid = self.idlst[1], self.idlst[2]
+        self.qaisession.fail_set.add(failid)
+        self.qaisession.raise_set.add(raiseid)
+        progress_lst = []
+        res = self.csdb.perform_loc_changes(self.get_move_dct(),
+                                            lambda *args: progress_lst.append(args))
+        assert not res['ok'], "ok == False expected"
+        assert res['nsent'] == len(self.idlst) - 2 and res['nfailed'] == 2
+        itmdct = res['items']
+        assert not itmdct[failid]['ok'] and not itmdct[raiseid]['ok']
+        assert itmdct[raiseid]['msg'] == "connection lost"
+        assert sum(d['ok'] for d in itmdct.values()) == len(self.idlst) - 2
+        assert self.csdb.number_of_loc_changes() == 0, "committed changes must be removed"
+        assert res['npending'] == 2, "failed changes must be kept"
+        stat_dct = self.csdb.get_outbox_status()
+        assert stat_dct['npending'] == stat_dct['nretrying'] == 2
+        assert progress_lst[-1] == (len(self.idlst), len(self.idlst), 2)
+        # the failed changes are retried after a delay
+        self.qaisession.fail_set.clear()
+        self.qaisession.raise_set.clear()
+        assert self.csdb.drain_outbox()['nsent'] == 0, "retried too early"
+        res = self.csdb.drain_outbox(now=time.time() + ChemStock.OUTBOX_BASE_DELAY)
+        assert res['ok'] and res['nsent'] == 2 and res['npending'] == 0
+        assert sorted(i for i, locid, opstring in self.qaisession.reported) == self.idlst
+
+    def test_report03(self) -> None:
+        """Ignored changes must not be reported, unknown items must be reported
+        as failures without a QAI request."""
+        move_dct = self.get_move_dct()
+        mvlst = move_dct[str(self.locid)]
+        ignore_id = mvlst[0][0]
+        mvlst[0] = (ignore_id, mvlst[0][1], True)
+        mvlst.append((99999, 'found', False))
+        res = self.csdb.perform_loc_changes(move_dct)
+        assert not res['ok'], "ok == False expected"
+        itmdct = res['items']
+        assert ignore_id not in itmdct, "ignored item must not be reported"
+        assert not itmdct[99999]['ok'], "unknown item must fail"
+        assert all(i != 99999 and i != ignore_id for i, locid, opstring in self.qaisession.reported)
+        assert res['nsent'] == len(self.idlst) - 1 and res['nfailed'] == 1
+
+    def test_outbox01(self) -> None:
+        """Committing must move the changes to the outbox without contacting QAI, and
+        every change must be reported with its own idempotency key."""
+        res = self.csdb.commit_loc_changes(self.get_move_dct())
+        assert res['ok'] and res['nqueued'] == len(self.idlst)
+        assert self.csdb.number_of_loc_changes() == 0
+        assert self.qaisession.reported == []
+        stat_dct = self.csdb.get_outbox_status()
+        assert stat_dct['npending'] == len(self.idlst) and stat_dct['nretrying'] == 0
+        assert stat_dct['oldest'] is not None
+        res = self.csdb.drain_outbox()
+        assert res['ok'] and res['nsent'] == len(self.idlst) and res['npending'] == 0
+        keylst = self.qaisession.keylst
+        assert None not in keylst and len(set(keylst)) == len(self.idlst)
+
+    def test_outbox02(self) -> None:
+        """The changes of a reagent item must be reported in the order they were committed,
+        and a failed change must hold back the later ones of the same item."""
+        reag_item_id = self.idlst[0]
+        self.csdb.commit_loc_changes(self.get_move_dct())
+        for locid in (10002, 10003):
+            self.csdb.add_loc_changes(locid, [(reag_item_id, 'moved')])
+            self.csdb.commit_loc_changes(self.get_move_dct())
+        self.qaisession.raise_set.add(reag_item_id)
+        res = self.csdb.drain_outbox()
+        assert res['nsent'] == len(self.idlst) - 1 and res['nfailed'] == 1
+        assert res['npending'] == 3
+        self.qaisession.raise_set.clear()
+        res = self.csdb.drain_outbox(now=time.time() + ChemStock.OUTBOX_BASE_DELAY)
+        assert res['nsent'] == 3 and res['npending'] == 0
+        item_lst = [(locid, opstring) for i, locid, opstring in self.qaisession.reported if i == reag_item_id]
+        assert item_lst == [(self.locid, 'found'), (10002, 'moved'), (10003, 'moved')]
+
+    def test_outbox03(self) -> None:
+        """The retry delay must double with every failure, and a change refused by QAI
+        must not be tried again."""
+        failid, rejectid = self.idlst[0], self.idlst[1]
+        self.qaisession.fail_set.add(failid)
+        self.qaisession.reject_set.add(rejectid)
+        self.csdb.commit_loc_changes(self.get_move_dct())
+        t_now = time.time()
+        delay = ChemStock.OUTBOX_BASE_DELAY
+        for n in range(3):
+            res = self.csdb.drain_outbox(now=t_now)
+            assert res['nfailed'] == (2 if n == 0 else 1)
+            assert self.csdb.drain_outbox(now=t_now + delay - 1.0)['nfailed'] == 0
+            t_now += delay
+            delay *= 2.0
+        stat_dct = self.csdb.get_outbox_status()
+        assert stat_dct['npending'] == 1 and stat_dct['nretrying'] == 1
+        assert [d['reag_item_id'] for d in stat_dct['rejected']] == [rejectid]
+        assert self.qaisession.keylst.count(self.qaisession.keylst[-1]) == 3, "idempotency key must not change"
+
+    def test_outbox05(self) -> None:
+        """Transient HTTP errors such as an expired login must be retried, not rejected."""
+        for n, rcode in enumerate([401, 403, 408, 429, 500, 502]):
+            self.qaisession.rcode_dct[self.idlst[n]] = rcode
+        self.csdb.commit_loc_changes(self.get_move_dct())
+        res = self.csdb.drain_outbox()
+        assert res['nfailed'] == 6
+        stat_dct = self.csdb.get_outbox_status()
+        assert stat_dct['rejected'] == [] and stat_dct['nretrying'] == 6
+        self.qaisession.rcode_dct.clear()
+        res = self.csdb.drain_outbox(now=time.time() + ChemStock.OUTBOX_BASE_DELAY)
+        assert res['nsent'] == 6 and res['npending'] == 0
+
+    def test_outbox06(self) -> None:
+        """A rejected change must hold back the later changes of its item until resolved."""
+        reag_item_id = self.idlst[0]
+        self.qaisession.reject_set.add(reag_item_id)
+        self.csdb.commit_loc_changes(self.get_move_dct())
+        self.csdb.drain_outbox()
+        self.qaisession.reject_set.clear()
+        self.csdb.add_loc_changes(10002, [(reag_item_id, 'moved')])
+        self.csdb.commit_loc_changes(self.get_move_dct())
+        t_later = time.time() + OUTBOX_LATER_SECS
+        res = self.csdb.drain_outbox(now=t_later)
+        assert res['nsent'] == 0 and res['npending'] == 1
+        assert self.csdb.resolve_rejected(reag_item_id, do_retry=True) == 1
+        res = self.csdb.drain_outbox(now=t_later)
+        assert res['nsent'] == 2 and res['npending'] == 0
+        item_lst = [(locid, opstring) for i, locid, opstring in self.qaisession.reported if i == reag_item_id]
+        assert item_lst == [(self.locid, 'found'), (10002, 'moved')]
+        # a discarded rejected change releases the later ones
+        self.qaisession.reject_set.add(reag_item_id)
+        self.csdb.add_loc_changes(10003, [(reag_item_id, 'moved')])
+        self.csdb.commit_loc_changes(self.get_move_dct())
+        self.csdb.drain_outbox(now=t_later)
+        self.qaisession.reject_set.clear()
+        self.csdb.add_loc_changes(10004, [(reag_item_id, 'moved')])
+        self.csdb.commit_loc_changes(self.get_move_dct())
+        assert self.csdb.drain_outbox(now=t_later)['nsent'] == 0
+        assert self.csdb.resolve_rejected(reag_item_id, do_retry=False) == 1
+        assert self.csdb.drain_outbox(now=t_later)['nsent'] == 1
+        assert self.qaisession.reported[-1] == (reag_item_id, 10004, 'moved')
+
+    def test_outbox04(self, tmpdir: py.path.local) -> None:
+        """Committed changes must survive closing the database."""
+        fname = str(tmpdir.join('chemstock.sqlite'))
+        csdb = ChemStock.ChemStockDB(fname, None, TIME_ZONE)
+        csdb.add_loc_changes(self.locid, [(i, 'found') for i in self.idlst])
+        hashcode, move_dct = csdb.get_loc_changes()
+        assert move_dct is not None, "location changes expected"
+        assert csdb.commit_loc_changes(move_dct)['nqueued'] == len(self.idlst)
+        assert csdb.drain_outbox()['nsent'] == 0, "reported without a QAI session"
+        del csdb
+        csdb = ChemStock.ChemStockDB(fname, self.qaisession, TIME_ZONE)
+        assert csdb.get_outbox_status()['npending'] == len(self.idlst)
+        res = csdb.drain_outbox()
+        assert res['ok'] and res['nsent'] == len(self.idlst) and res['npending'] == 0
+
+    def test_outbox07(self, monkeypatch) -> None:
+        """The outbox must not be drained while an update from QAI is being streamed
+        into the database, as both use the same database session."""
+        evlst: typing.List[str] = []
+        qaisession = self.qaisession
+        orig_update = qaisession.clever_update_qai_dump
+        orig_report = qaisession.report_item_location
+
+        def slow_update(qai_ds: qai_helper.QAIDataset, stream: bool = False) -> qai_helper.QAIUpdatedct:
+            evlst.append('load')
+            # waiting for the next part of the stream lets other greenlets run
+            gevent.sleep(0.2)
+            evlst.append('loaded')
+            return orig_update(qai_ds, stream)
+
+        def log_report(*args, **kwargs) -> dict:
+            evlst.append('report')
+            return orig_report(*args, **kwargs)
+        monkeypatch.setattr(qaisession, 'clever_update_qai_dump', slow_update)
+        monkeypatch.setattr(qaisession, 'report_item_location', log_report)
+        self.csdb.commit_loc_changes(self.get_move_dct())
+        loader = gevent.spawn(self.csdb.update_from_qai, True)
+        gevent.sleep(0)
+        drainer = gevent.spawn(self.csdb.drain_outbox)
+        gevent.joinall([loader, drainer])
+        assert loader.value['ok'] and drainer.value['nsent'] == len(self.idlst)
+        assert evlst[:2] == ['load', 'loaded'], "the outbox was drained during the load"
+        # conversely, an update waits for the outbox to be drained
+        evlst.clear()
+        self.csdb.add_loc_changes(self.locid, [(self.idlst[0], 'missing')])
+        self.csdb.commit_loc_changes(self.get_move_dct())
+        drainer = gevent.spawn(self.csdb.drain_outbox)
+        gevent.sleep(0)
+        loader = gevent.spawn(self.csdb.update_from_qai, True)
+        gevent.joinall([loader, drainer])
+        assert evlst == ['report', 'load', 'loaded']
+
+
+class Test_Chemstock_fake_qai:
+    """Test synchronising with and reporting to the stand-in QAI server."""
+
+    def test_fake_sync01(self, fake_qai: fakeqai.FakeQAIServer) -> None:
+        """The local database must be loaded from the server, and location
+        changes reported to it must come back in the next update."""
+        S = qai_helper.QAISession
+        qaisession = qai_helper.QAISession(fake_qai.url)
+        qaisession.login(fakeqai.DEFAULT_USER, fakeqai.DEFAULT_PASSWORD)
+        csdb = ChemStock.ChemStockDB(None, qaisession, TIME_ZONE)
+        res = csdb.update_from_qai()
+        assert res['ok'], "update failed: {}".format(res)
+        itmlst = fake_qai.get_data()[S.QAIDCT_REAGENT_ITEMS]
+        assert csdb.get_db_stats()[S.QAIDCT_REAGENT_ITEMS] == len(itmlst)
+        reag_item_id = itmlst[0]['id']
+        csdb.add_loc_changes(10007, [(reag_item_id, 'found')])
+        hashcode, move_dct = csdb.get_loc_changes()
+        assert move_dct is not None, "location changes expected"
+        res = csdb.perform_loc_changes(move_dct)
+        assert res['ok'] and res['nsent'] == 1
+        assert csdb.update_from_qai()['ok']
+        rdct = csdb.lookup_rfids(['CHEM{}'.format(reag_item_id)])
+        reag_item = rdct['CHEM{}'.format(reag_item_id)]
+        assert reag_item is not None and reag_item['qcs_location_id'] == 10007
+
+    def test_fake_outbox01(self, fake_qai: fakeqai.FakeQAIServer) -> None:
+        """A found or moved report that QAI refuses must be kept in the outbox as rejected."""
+        S = qai_helper.QAISession
+        csdb = self._get_synced_db(fake_qai)
+        reag_item_id = fake_qai.get_data()[S.QAIDCT_REAGENT_ITEMS][0]['id']
+        csdb.add_loc_changes(10007, [(reag_item_id, 'found')])
+        hashcode, move_dct = csdb.get_loc_changes()
+        assert move_dct is not None, "location changes expected"
+        # QAI no longer knows the item
+        del fake_qai._itemdct[reag_item_id]
+        res = csdb.perform_loc_changes(move_dct)
+        assert not res['ok'] and res['nsent'] == 0 and res['nfailed'] == 1
+        assert res['items'][reag_item_id]['rcode'] == qai_helper.HTTP_UNPROCESSABLE
+        assert res['npending'] == 0
+        assert [r['reag_item_id'] for r in csdb.get_outbox_status()['rejected']] == [reag_item_id]
+
+    def _get_synced_db(self, fake_qai: fakeqai.FakeQAIServer) -> ChemStock.ChemStockDB:
+        qaisession = qai_helper.QAISession(fake_qai.url)
+        qaisession.login(fakeqai.DEFAULT_USER, fakeqai.DEFAULT_PASSWORD)
+        csdb = ChemStock.ChemStockDB(None, qaisession, TIME_ZONE)
+        assert csdb.update_from_qai()['ok'], "update failed"
+        return csdb
+
+    def test_prefetch01(self, fake_qai: fakeqai.FakeQAIServer) -> None:
+        """Tables changed on QAI must be downloaded by prefetch_qai_update(), and
+        a subsequent update_from_qai() must load them without downloading them again."""
+        S = qai_helper.QAISession
+        csdb = self._get_synced_db(fake_qai)
+        assert csdb.prefetch_qai_update() == [], "nothing has changed yet"
+        assert not csdb.has_staged_update()
+        reag_item_id = fake_qai.get_data()[S.QAIDCT_REAGENT_ITEMS][0]['id']
+        qaisession = csdb.qaisession
+        assert qaisession is not None, "a QAI session expected"
+        qaisession.report_item_location(reag_item_id, 10007, 'found')
+        assert csdb.prefetch_qai_update() == [S.QAIDCT_REAGENT_ITEMS]
+        assert csdb.has_staged_update()
+        # a second change is added to the staged data
+        fake_qai.touch_table(S.QAIDCT_USERS)
+        assert csdb.prefetch_qai_update() == [S.QAIDCT_USERS]
+        num_dumps = fake_qai.get_stats()['table_dump']
+        res = csdb.update_from_qai()
+        assert res['ok'], "update failed: {}".format(res)
+        assert fake_qai.get_stats()['table_dump'] == num_dumps, "staged tables were downloaded again"
+        assert not csdb.has_staged_update()
+        rfid = 'CHEM{}'.format(reag_item_id)
+        reag_item = csdb.lookup_rfids([rfid])[rfid]
+        assert reag_item is not None and reag_item['qcs_location_id'] == 10007
+        assert csdb.prefetch_qai_update() == [], "staged tables were not loaded"
+
+    def test_prefetch02(self, fake_qai: fakeqai.FakeQAIServer) -> None:
+        """Tables changed on QAI after a prefetch must still be downloaded by update_from_qai()."""
+        S = qai_helper.QAISession
+        csdb = self._get_synced_db(fake_qai)
+        fake_qai.touch_table(S.QAIDCT_USERS)
+        assert csdb.prefetch_qai_update() == [S.QAIDCT_USERS]
+        fake_qai.touch_table(S.QAIDCT_LOCATIONS)
+        num_dumps = fake_qai.get_stats()['table_dump']
+        assert csdb.update_from_qai()['ok']
+        assert fake_qai.get_stats()['table_dump'] == num_dumps + 1
+        assert csdb.prefetch_qai_update() == []
+
+    def test_prefetch03(self, fake_qai: fakeqai.FakeQAIServer) -> None:
+        """Staged data must be discarded if the database is loaded from elsewhere
+        after the prefetch."""
+        S = qai_helper.QAISession
+        csdb = self._get_synced_db(fake_qai)
+        fake_qai.touch_table(S.QAIDCT_USERS)
+        assert csdb.prefetch_qai_update() == [S.QAIDCT_USERS]
+        fake_qai.touch_table(S.QAIDCT_LOCATIONS)
+        newds = qai_helper.QAIDataset(None, csdb.get_ts_data())
+        qaisession = csdb.qaisession
+        assert qaisession is not None, "a QAI session expected"
+        update_dct = qaisession.clever_update_qai_dump(newds)
+        csdb.load_qai_data(newds, update_dct, delta_sync=True)
+        assert not csdb.has_staged_update(), "staged data for an old database state"
+        assert csdb.update_from_qai()['ok']
+
+    def test_prefetch04(self) -> None:
+        """prefetch_qai_update() must do nothing when no user is logged in."""
+        csdb = ChemStock.ChemStockDB(None, qai_helper.QAISession('http://localhost:1'), TIME_ZONE)
+        assert csdb.prefetch_qai_update() == []
+        assert not csdb.has_staged_update()
+
+    def test_prefetch05(self, fake_qai: fakeqai.FakeQAIServer) -> None:
+        """Staged data older than max_age must be discarded, and the same changes
+        must not be downloaded again by the following prefetches."""
+        S = qai_helper.QAISession
+        csdb = self._get_synced_db(fake_qai)
+        fake_qai.touch_table(S.QAIDCT_REAGENT_ITEMS)
+        assert csdb.prefetch_qai_update(max_age=0.0) == [S.QAIDCT_REAGENT_ITEMS]
+        assert csdb.has_staged_update()
+        num_dumps = fake_qai.get_stats()['table_dump']
+        assert csdb.prefetch_qai_update(max_age=0.0) == []
+        assert not csdb.has_staged_update(), "staged data was not discarded"
+        assert csdb.prefetch_qai_update(max_age=0.0) == []
+        assert fake_qai.get_stats()['table_dump'] == num_dumps, "discarded changes downloaded again"
+        fake_qai.touch_table(S.QAIDCT_USERS)
+        assert set(csdb.prefetch_qai_update(max_age=0.0)) == {S.QAIDCT_REAGENT_ITEMS, S.QAIDCT_USERS}
+        assert fake_qai.get_stats()['table_dump'] == num_dumps + 2
+        assert csdb.update_from_qai()['ok']
+        assert csdb.prefetch_qai_update(max_age=0.0) == []
+
+
+@withbench
+class Test_Bench_ChemStock:
+    """Benchmarks on a large synthetic data set."""
+    qaids: qai_helper.QAIDataset
+
+    @classmethod
+    def setup_class(cls) -> None:
+        cls.qaids = make_synthetic_qaids(40000)
+
+    def test_bulk_load01(self) -> None:
+        """Loading the reagent item status table with the bulk loader must be faster than
+        loading it one ORM object at a time."""
+        S = qai_helper.QAISession
+        statlst = self.qaids.get_data()[S.QAIDCT_REAITEM_STATUS]
+        nrows = len(statlst)
+        assert nrows >= 100000, "need at least 100k status rows"
+        csdb = ChemStock.ChemStockDB(None, None, TIME_ZONE)
+        classname = ChemStock.Reagent_Item_Status
+        t_start = time.perf_counter()
+        orm_load_table(csdb, classname, statlst)
+        orm_secs = time.perf_counter() - t_start
+        bulk_stats = csdb._bulk_load_table(classname, statlst)
+        bulk_secs = bulk_stats['secs']
+        assert csdb._sess.query(classname).count() == nrows, "wrong number of rows"
+        print("\n{} status rows: ORM: {:.2f} s ({:.0f} rows/s), bulk: {:.2f} s ({:.0f} rows/s), speedup {:.1f}x".format(
+            nrows, orm_secs, nrows/orm_secs, bulk_secs, bulk_stats['rows_per_sec'], orm_secs/bulk_secs))
+        assert bulk_secs < orm_secs, "bulk load is not faster"
+
+    def test_final_state_engines01(self) -> None:
+        """Compare the time taken to calculate all final states with the SQL engine,
+        the python engine and the per-item python loop over all status records."""
+        csdb = ChemStock.ChemStockDB(None, None, TIME_ZONE)
+        csdb.load_qai_data(self.qaids)
+        time_dct = {}
+        for name, func in [('per-item loop', lambda: len(chemdb.BaseDB.get_final_state_dct(csdb, None))),
+                           ('python engine', lambda: len(csdb._calc_item_states_python(None))),
+                           ('sql engine', lambda: len(csdb._calc_item_states_sql(None))),
+                           ('python engine rebuild', lambda: csdb._bulk_load_table(
+                               ChemStock.Reagent_Item_State, csdb._calc_item_states_python(None))['nrows']),
+                           ('sql engine rebuild', lambda: csdb._rebuild_item_states()['nrows'])]:
+            t_start = time.perf_counter()
+            num_states = func()
+            time_dct[name] = secs = time.perf_counter() - t_start
+            print("\n{}: {} final states in {:.3f} s".format(name, num_states, secs))
+        assert time_dct['sql engine rebuild'] < time_dct['python engine rebuild'], "SQL rebuild is not faster"
+
+    def measure_write_latency(self, fname: str, storage_profile: dict) -> typing.List[float]:
+        """Measure the time taken by add_loc_changes() while another thread
+        continuously regenerates the stock list from scratch."""
+        csdb = ChemStock.ChemStockDB(fname, None, TIME_ZONE, storage_profile=storage_profile)
+        csdb.load_qai_data(self.qaids)
+        itmlst = csdb.get_reagent_item_list()
+        stop_event = threading.Event()
+        num_builds = [0]
+
+        def build_loop() -> None:
+            while not stop_event.is_set():
+                csdb._do_generate_webclient_stocklist()
+                num_builds[0] += 1
+        builder = threading.Thread(target=build_loop)
+        builder.start()
+        lat_lst = []
+        try:
+            time.sleep(0.2)
+            for itm in itmlst[:100]:
+                t_start = time.perf_counter()
+                csdb.add_loc_changes(itm['qcs_location_id'], [(itm['id'], 'found')])
+                lat_lst.append(time.perf_counter() - t_start)
+                time.sleep(0.01)
+        finally:
+            stop_event.set()
+            builder.join()
+        assert num_builds[0] > 0, "the stock list was not built"
+        return sorted(lat_lst)
+
+    def test_write_latency01(self, tmpdir: py.path.local) -> None:
+        """Measure the write latency of location changes during stock list generation
+        with the default storage profile and with the sqlite defaults."""
+        res_dct = {}
+        for name, profile in [('rollback journal', dict(journal_mode='DELETE', synchronous='FULL')),
+                              ('WAL', {})]:
+            lat_lst = self.measure_write_latency(str(tmpdir.join(name + '.sqlite')), profile)
+            res_dct[name] = lat_lst
+            print("\n{}: add_loc_changes latency median {:.2f} ms, 90% {:.2f} ms, max {:.2f} ms".format(
+                name, 1000.0*lat_lst[len(lat_lst)//2], 1000.0*lat_lst[len(lat_lst)*9//10], 1000.0*lat_lst[-1]))
+        assert res_dct['WAL'][-1] < res_dct['rollback journal'][-1], "WAL should reduce the maximum latency"
+
+
+@withbench
+class Test_Bench_StockList:
+    """Memory benchmark of the stock list on a large synthetic data set."""
+
+    def test_stocklist_memory01(self) -> None:
+        """Measure the memory used by the compact stock list builder records, the
+        additional memory used by the dicts while they are sent to the webclient,
+        and the memory that stays in use after get_stocklist() has been called."""
+        csdb = ChemStock.ChemStockDB(None, None, TIME_ZONE)
+        csdb.load_qai_data(make_synthetic_qaids(100000))
+        tracemalloc.start()
+        try:
+            mem_start = tracemalloc.get_traced_memory()[0]
+            builder = chemdb.StockListBuilder(csdb)
+            builder.build(None)
+            gc.collect()
+            mem_compact = tracemalloc.get_traced_memory()[0] - mem_start
+            stock_dct = builder.get_stocklist()
+            num_items = len(stock_dct['ritemdct'])
+            mem_dicts = tracemalloc.get_traced_memory()[0] - mem_start
+            del stock_dct
+            gc.collect()
+            mem_kept = tracemalloc.get_traced_memory()[0] - mem_start
+        finally:
+            tracemalloc.stop()
+        print("\n{} reagent items: compact: {:.1f} MB, with dicts: {:.1f} MB, kept: {:.1f} MB".format(
+            num_items, mem_compact/1e6, mem_dicts/1e6, mem_kept/1e6))
+        assert mem_kept < mem_compact*1.05, "the builder should not keep the dicts"
+
+
+@withbench
+class Test_Bench_StreamLoad:
+    """Memory benchmark of loading a large table dump from QAI."""
+
+    def test_stream_load_memory01(self) -> None:
+        """Compare the peak memory used by loading the reagent item status table
+        from a parsed JSON list with that used by streaming it."""
+        S = qai_helper.QAISession
+        classname = ChemStock.Reagent_Item_Status
+        statlst = fakeqai.make_synthetic_qaidct(40000)[S.QAIDCT_REAITEM_STATUS]
+        body = json.dumps(statlst).encode('utf-8')
+        del statlst
+        res_dct = {}
+        for name in ('json list', 'stream'):
+            csdb = ChemStock.ChemStockDB(None, None, TIME_ZONE)
+            gc.collect()
+            tracemalloc.start()
+            try:
+                t_start = time.perf_counter()
+                if name == 'stream':
+                    chunk_iter = (body[ndx:ndx+qai_helper.STREAM_CHUNK_SIZE]
+                                  for ndx in range(0, len(body), qai_helper.STREAM_CHUNK_SIZE))
+                    stat_dct = csdb._bulk_load_table(classname, qai_helper.iter_json_array(chunk_iter))
+                else:
+                    stat_dct = csdb._bulk_load_table(classname, json.loads(body))
+                secs = time.perf_counter() - t_start
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+            res_dct[name] = peak
+            print("\n{}: {} rows ({:.1f} MB of JSON) in {:.2f} s, peak memory {:.1f} MB".format(
+                name, stat_dct['nrows'], len(body)/1e6, secs, peak/1e6))
+        assert res_dct['stream'] < res_dct['json list'] / 2, "streaming should use much less memory"
+
+
+@withbench
+class Test_Bench_FakeQAI:
+    """Benchmark synchronising with and reporting to the stand-in QAI server."""
+
+    def test_fake_sync_bench01(self) -> None:
+        """Time a full synchronisation of 20000 items and the upload of 200 location changes,
+        with 20 ms of latency per request."""
+        S = qai_helper.QAISession
+        srv = fakeqai.FakeQAIServer(fakeqai.make_synthetic_qaidct(20000), latency=0.02)
+        srv.start()
+        try:
+            qaisession = qai_helper.QAISession(srv.url)
+            qaisession.login(fakeqai.DEFAULT_USER, fakeqai.DEFAULT_PASSWORD)
+            for stream in (False, True):
+                csdb = ChemStock.ChemStockDB(None, qaisession, TIME_ZONE)
+                t_start = time.perf_counter()
+                assert csdb.update_from_qai(stream=stream)['ok']
+                print("\nsync (stream={}): {:.2f} s".format(stream, time.perf_counter() - t_start))
+            idlst = [itm['id'] for itm in srv.get_data()[S.QAIDCT_REAGENT_ITEMS][:200]]
+            csdb.add_loc_changes(10003, [(reag_item_id, 'found') for reag_item_id in idlst])
+            hashcode, move_dct = csdb.get_loc_changes()
+            assert move_dct is not None, "location changes expected"
+            t_start = time.perf_counter()
+            res = csdb.perform_loc_changes(move_dct)
+            print("upload of {} changes: {:.2f} s".format(res['nsent'], time.perf_counter() - t_start))
+            print("server stats: {}".format(srv.get_stats()))
+            assert res['ok']
+        finally:
+            srv.stop()
+
+    def test_fake_gzip_bench01(self) -> None:
+        """Time a full synchronisation of 20000 items over a 2 MB/s link
+        with and without compressed responses."""
+        srv = fakeqai.FakeQAIServer(fakeqai.make_synthetic_qaidct(20000), latency=0.02,
+                                    bandwidth=2.0*1024*1024)
+        srv.start()
+        try:
+            for compress in (False, True):
+                srv.compress = compress
+                qaisession = qai_helper.QAISession(srv.url)
+                qaisession.login(fakeqai.DEFAULT_USER, fakeqai.DEFAULT_PASSWORD)
+                csdb = ChemStock.ChemStockDB(None, qaisession, TIME_ZONE)
+                t_start = time.perf_counter()
+                assert csdb.update_from_qai()['ok']
+                t_elapsed = time.perf_counter() - t_start
+                stats = qaisession.get_transfer_stats()
+                print("\nsync (compress={}): {:.2f} s, {} bytes received, {} decoded, {:.2f} s decoding".format(
+                    compress, t_elapsed, stats['wire_bytes'], stats['body_bytes'], stats['decode_secs']))
+        finally:
+            srv.stop()
+
+
 @withchemstock
 class Test_Chemstock_NOQAI(CommonTests):
     """Tests in which the database contains data which we load from a YAML file
@@ -2,6 +2,8 @@
 import typing
 import math
 import logging
+import time
+import gevent
 
 import pytest
 from gevent.queue import Queue
@@ -431,3 +433,65 @@ class TestTLSAscii:
             with pytest.raises(exc):
                 self.tls.read_user_bank(self.good_epc, numch)
         self.tls.read_user_bank(self.good_epc, 8)
+
+    def test_pipeline01(self):
+        """The responses to commands sent between begin_pipeline() and end_pipeline()
+        must be returned by end_pipeline(), not converted into messages."""
+        cl = test_commlink.PipelineCommLink({'logger': self.logger, 'RTT': 0.01, 'PROC_SECS': 0.0})
+        tls = TLSAscii.TLSReader(self.msgQ, self.logger, cl, self.radar_ave_num)
+        # the TLSReader sends the stock check mode commands on startup
+        for i in range(2):
+            assert cl.read_response().return_code() == commlink.BaseCommLink.RC_OK
+        tls.begin_pipeline()
+        tls.set_region('eu')
+        tls.bt_set_stock_check_mode()
+        resplst = tls.end_pipeline()
+        assert [cmdstr.split()[0] for cmdstr, clresp in resplst] == ['.sr', '.iv', '.al']
+        assert all(clresp.return_code() == commlink.BaseCommLink.RC_OK for cmdstr, clresp in resplst)
+        # after end_pipeline, commands are no longer awaited
+        tls.send_abort()
+        assert not cl._pending
+        tls.set_active(False)
+
+    def test_pipeline02(self):
+        """Commands sent by another greenlet while a pipeline is open must not be
+        added to it, and end_pipeline() must give up after its timeout."""
+        cl = test_commlink.PipelineCommLink({'logger': self.logger, 'RTT': 0.01, 'PROC_SECS': 0.0})
+        tls = TLSAscii.TLSReader(self.msgQ, self.logger, cl, self.radar_ave_num)
+        for i in range(2):
+            cl.read_response()
+        tls.begin_pipeline()
+        tls.set_region('eu')
+        gevent.spawn(tls.radar_get).join()
+        resplst = tls.end_pipeline()
+        assert [cmdstr.split()[0] for cmdstr, clresp in resplst] == ['.sr']
+        assert cl.read_response().return_code() == commlink.BaseCommLink.RC_OK
+        # the reader stops answering
+        cl.mydev.drop = True
+        tls.begin_pipeline()
+        tls.set_region('eu')
+        tls.bt_set_stock_check_mode()
+        t_start = time.monotonic()
+        resplst = tls.end_pipeline(timeout=0.1)
+        assert time.monotonic() - t_start < 0.5
+        assert [clresp.return_code() for cmdstr, clresp in resplst] == [commlink.BaseCommLink.RC_TIMEOUT]*3
+        assert not cl._pending
+        tls.set_active(False)
+
+    def test_liveness01(self):
+        """generate_msg() must not probe the reader with a .vr command before every read."""
+        cfgdct = {'logger': self.logger, 'RTT': 0.01, 'PROC_SECS': 0.0}
+        cl = test_commlink.PipelineSerialCommLink(cfgdct)
+        tls = TLSAscii.TLSReader(self.msgQ, self.logger, cl, self.radar_ave_num)
+        tls.set_active(False)
+        msg = tls.generate_msg()
+        assert msg.msg == CommonMSG.MSG_SV_RFID_STATREP and msg.data == CommonMSG.RFID_ON
+        # the responses to the stock check mode commands sent on startup
+        for i in range(2):
+            cl.read_response()
+        numread = 10
+        for i in range(numread):
+            cl.mydev.inject(test_commlink.TRIGGER_RESPONSE)
+            msg = tls.generate_msg()
+            assert msg.msg == CommonMSG.MSG_RF_CMD_RESP
+        assert sum(cmdstr.startswith('.vr') for cmdstr in cl.mydev.cmdlst) == 1
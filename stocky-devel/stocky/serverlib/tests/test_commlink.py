@@ -1,10 +1,19 @@
 import typing
 import pytest
 import logging
+import os
+import threading
+import time
+import timeit
 import serial
+import gevent
 
 import webclient.commonmsg as commonmsg
 import serverlib.commlink as commlink
+import serverlib.TLSAscii as TLSAscii
+
+withbench = pytest.mark.skipif("not config.getoption('with_bench')",
+                               reason="needs --with_bench option in order to run")
 
 
 class DummySerialDevice:
@@ -18,14 +27,18 @@ class DummySerialDevice:
         self.doraise = False
         self._isclosed = False
 
+    @property
+    def in_waiting(self) -> int:
+        return len(self.cont) - self.pos
+
     def read(self, size: int = 1) -> bytes:
-        assert size == 1, 'only support size = 1'
+        assert size >= 1, 'size must be positive'
         assert not self._isclosed, "device is closed"
         if self.pos < len(self.cont):
-            retbyte = self.cont[self.pos:self.pos+1]
-            self.pos += 1
-            assert isinstance(retbyte, bytes), 'read returning non-byte'
-            return retbyte
+            retbytes = self.cont[self.pos:self.pos+size]
+            self.pos += len(retbytes)
+            assert isinstance(retbytes, bytes), 'read returning non-byte'
+            return retbytes
         else:
             raise RuntimeError('EOF reached')
 
@@ -53,10 +66,25 @@ class TimeoutDummySerialDevice(DummySerialDevice):
     """A dummy serial device that always times out on reads"""
 
     def read(self, size: int = 1) -> bytes:
-        assert size == 1, 'only support size = 1'
         return b''
 
 
+class ChunkDummySerialDevice(DummySerialDevice):
+    """A dummy serial device that returns one of a list of chunks on every read,
+    then times out."""
+
+    def __init__(self, chunklst: typing.List[bytes]) -> None:
+        super().__init__()
+        self.chunklst = list(chunklst)
+
+    @property
+    def in_waiting(self) -> int:
+        return len(self.chunklst[0]) if self.chunklst else 0
+
+    def read(self, size: int = 1) -> bytes:
+        return self.chunklst.pop(0) if self.chunklst else b''
+
+
 class ExceptionDummySerialDevice(DummySerialDevice):
     """A dummy serial device that raises an exception on reads"""
 
@@ -312,7 +340,10 @@ class Test_commlink:
         for instr, exp_outstr in [('4348454D3130303030000000', "CHEM10000", ),
                                   ('BLA', 'BLA'),
                                   ('BLAA', 'BLAA'),
-                                  ('00FA01', '00FA01')]:
+                                  ('00FA01', '00FA01'),
+                                  ('4a4b', '4a4b'),
+                                  ('4A 4B', '4A 4B'),
+                                  ('4A4B0000', 'JK')]:
             gotstr = commlink.hexstr_to_str(instr)
             if lverb:
                 print(" GOT {} --> {}".format(instr, gotstr))
@@ -348,6 +379,34 @@ class Test_commlink:
         with pytest.raises(RuntimeError):
             dscl._str_readline()
 
+    def test_str_read04(self):
+        """_str_readline must return the lines of a single read one at a time."""
+        cfgdct = {'logger': self.logger}
+        dscl = DummySerialCommLink(cfgdct)
+        dscl.mydev = DummySerialDevice(b'one\r\ntw\x00o\r\n\xff\r\nthree\r\n')
+        for expstr in ['one', 'two', '', 'three']:
+            assert dscl._str_readline() == expstr
+
+    def test_str_read05(self):
+        """_str_readline must join lines split across reads, and return None
+        on a time out."""
+        cfgdct = {'logger': self.logger}
+        dscl = DummySerialCommLink(cfgdct)
+        dscl.mydev = ChunkDummySerialDevice([b'he', b'llo\r', b'\nwor', b'\x00', b'ld\r\nbla'])
+        for expstr in ['hello', 'world', None]:
+            assert dscl._str_readline() == expstr
+        # the partial line is discarded on a time out
+        dscl.mydev = ChunkDummySerialDevice([b'OK:\r\n'])
+        assert dscl._str_readline() == 'OK:'
+
+    def test_str_read06(self):
+        """_str_readline must raise an exception if a CR is followed by a time out."""
+        cfgdct = {'logger': self.logger}
+        dscl = DummySerialCommLink(cfgdct)
+        dscl.mydev = ChunkDummySerialDevice([b'hello\r'])
+        with pytest.raises(RuntimeError):
+            dscl._str_readline()
+
     def test_raw_send_cmd01(self):
         """
         raw_send_cmd() should raise a RuntimeError if the serial device (mydev) is None
@@ -564,3 +623,439 @@ class Test_commlink:
         my_tup = (cmd, arg)
         with pytest.raises(RuntimeError):
             commlink.CLResponse._check_get_int_val(my_tup, commlink.ER_RESP)
+
+
+class PtyCommLink(commlink.BaseCommLink):
+    """A commlink reading from a serial device opened on the slave side of a pseudo terminal."""
+
+    def open_device(self) -> typing.Any:
+        return serial.Serial(self.cfgdct['RFID_READER_DEVNAME'], timeout=self.cfgdct['TIMEOUT'])
+
+    def _close_device(self) -> None:
+        if self.mydev is not None:
+            self.mydev.close()
+
+
+def bytewise_readline(dev: typing.Any) -> typing.Optional[str]:
+    """Read a line from dev one byte at a time, the way that BaseCommLink used to."""
+    retbytes = b''
+    while True:
+        b = dev.read(size=1)
+        if not b:
+            return None
+        if b in frozenset([b'\xff', b'\x00']):
+            continue
+        if b == commlink.BYTE_CR:
+            if dev.read(size=1) != commlink.BYTE_LF:
+                raise RuntimeError('protocol error')
+            return str(retbytes, 'utf-8')
+        retbytes += b
+
+
+class Test_pty_commlink:
+    """Read from a serial device on a pseudo terminal, written to by a thread."""
+
+    def setup_method(self) -> None:
+        self.master_fd, slave_fd = os.openpty()
+        cfgdct = {'logger': logging.Logger("testing"),
+                  'RFID_READER_DEVNAME': os.ttyname(slave_fd),
+                  'TIMEOUT': 0.5}
+        self.cl = PtyCommLink(cfgdct)
+        os.close(slave_fd)
+
+    def teardown_method(self) -> None:
+        self.cl.handle_state_change(False)
+        os.close(self.master_fd)
+
+    def start_writer(self, data: bytes) -> threading.Thread:
+        def write_all() -> None:
+            view = memoryview(data)
+            while view:
+                nbytes = os.write(self.master_fd, view[:4096])
+                view = view[nbytes:]
+        writer = threading.Thread(target=write_all, daemon=True)
+        writer.start()
+        return writer
+
+    @staticmethod
+    def make_inventory(nlines: int) -> typing.Tuple[bytes, typing.List[str]]:
+        """Return the bytes of an inventory response with nlines EPC lines,
+        and the lines expected to be read."""
+        linelst = ['EP: {:024X}'.format(0x3034257BF7194E4000001A85 + i) for i in range(nlines)] + ['OK:', '']
+        data = b''.join(bytes(line, 'utf-8') + (b'\x00\xff' if i % 100 == 0 else b'') + commlink.BYTE_CRLF
+                        for i, line in enumerate(linelst))
+        return data, linelst
+
+    def test_pty_read01(self) -> None:
+        """All lines written must be read, followed by a time out."""
+        data, linelst = self.make_inventory(500)
+        writer = self.start_writer(data)
+        gotlst = [self.cl._str_readline() for line in linelst]
+        writer.join()
+        assert gotlst == linelst
+        assert self.cl._str_readline() is None, "time out expected"
+
+    def test_pty_read02(self) -> None:
+        """raw_read_response() must decode an inventory response."""
+        data, linelst = self.make_inventory(10)
+        self.start_writer(data).join()
+        resp = self.cl.raw_read_response()
+        assert resp.return_code() == commlink.BaseCommLink.RC_OK
+        ep_lst = resp[commlink.EP_VAL]
+        assert ep_lst is not None and len(ep_lst) == 10
+
+    @withbench
+    def test_pty_bench01(self) -> None:
+        """Compare the throughput of reading a large inventory response through
+        the buffer with reading it one byte at a time."""
+        nlines = 20000
+        data, linelst = self.make_inventory(nlines)
+        for name, readline in [('bytewise', lambda: bytewise_readline(self.cl.mydev)),
+                               ('buffered', self.cl._str_readline)]:
+            writer = self.start_writer(data)
+            t_start = time.perf_counter()
+            gotlst = [readline() for line in linelst]
+            t_elapsed = time.perf_counter() - t_start
+            writer.join()
+            assert gotlst == linelst
+            print("\n{}: {} lines, {} bytes in {:.3f} s ({:.0f} lines/s)".format(
+                name, len(linelst), len(data), t_elapsed, len(linelst)/t_elapsed))
+
+
+class PipelineDummyDevice:
+    """A dummy serial device that behaves like an RFID reader connected over a link
+    with a round trip time of rtt seconds.
+    The reader works on one command at a time, taking proc_secs seconds for each, and
+    answers every command with its CS line followed by OK.
+    Commands are dropped (never answered) if drop is True.
+    Reads time out after timeout seconds.
+    """
+
+    def __init__(self, rtt: float, proc_secs: float, drop: bool = False, timeout: float = 0.2) -> None:
+        self.rtt = rtt
+        self.proc_secs = proc_secs
+        self.drop = drop
+        self.timeout = timeout
+        self.t_free = 0.0
+        # the commands written to the device
+        self.cmdlst: typing.List[str] = []
+        # the responses not yet sent: (time of arrival, bytes)
+        self.sched_lst: typing.List[typing.Tuple[float, bytes]] = []
+        self.outbuf = bytearray()
+
+    def inject(self, b: bytes) -> None:
+        """Make bytes available for reading immediately, as if the user had pressed
+        the trigger on the reader."""
+        self.outbuf += b
+
+    def _arrived(self) -> None:
+        t_now = time.monotonic()
+        while self.sched_lst and self.sched_lst[0][0] <= t_now:
+            self.outbuf += self.sched_lst.pop(0)[1]
+
+    @property
+    def in_waiting(self) -> int:
+        self._arrived()
+        return len(self.outbuf)
+
+    def read(self, size: int = 1) -> bytes:
+        t_end = time.monotonic() + self.timeout
+        while self.in_waiting == 0:
+            if time.monotonic() >= t_end:
+                return b''
+            gevent.sleep(0.001)
+        retbytes = bytes(self.outbuf[:size])
+        del self.outbuf[:size]
+        return retbytes
+
+    def write(self, b: bytes) -> None:
+        cmdstr = str(b, 'utf-8').strip()
+        self.cmdlst.append(cmdstr)
+        if self.drop:
+            return
+        self.t_free = max(time.monotonic() + self.rtt/2, self.t_free) + self.proc_secs
+        resp = bytes("CS: {}\r\nOK:\r\n\r\n".format(cmdstr), 'utf-8')
+        self.sched_lst.append((self.t_free + self.rtt/2, resp))
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class PipelineCommLink(commlink.BaseCommLink):
+    """A commlink talking to a PipelineDummyDevice."""
+
+    def open_device(self) -> typing.Any:
+        return PipelineDummyDevice(self.cfgdct['RTT'], self.cfgdct['PROC_SECS'])
+
+
+class PipelineSerialCommLink(commlink.SerialCommLink):
+    """A serial commlink talking to a PipelineDummyDevice.
+    Unlike PipelineCommLink, this class probes the reader with .vr commands."""
+
+    def open_device(self) -> typing.Any:
+        return PipelineDummyDevice(self.cfgdct['RTT'], self.cfgdct['PROC_SECS'])
+
+
+def pipeline_dev(cl: commlink.BaseCommLink) -> PipelineDummyDevice:
+    """Return the device that a commlink is talking to."""
+    dev = cl.mydev
+    assert isinstance(dev, PipelineDummyDevice), "a pipeline device expected"
+    return dev
+
+
+TRIGGER_RESPONSE = b'EP: 000000000000000000001237\r\nOK:\r\n\r\n'
+
+
+class Test_pipeline:
+
+    def setup_method(self) -> None:
+        cfgdct = {'logger': logging.Logger("testing"), 'RTT': 0.05, 'PROC_SECS': 0.002}
+        self.cl = PipelineCommLink(cfgdct)
+
+    @staticmethod
+    def get_comment(clresp: commlink.CLResponse) -> str:
+        cdct = clresp.get_comment_dct()
+        assert cdct is not None, "comment dict expected"
+        return cdct[commlink.BaseCommLink.COMMENT_ID]
+
+    def test_pipeline01(self) -> None:
+        """Responses to several commands in flight must be returned to the right futures,
+        regardless of the order in which we wait for them."""
+        futlst = [(comment, self.cl.submit_cmd(".ec -p", comment)) for comment in ['one', 'two', 'three']]
+        for comment, fut in reversed(futlst):
+            clresp = self.cl.wait_cmd(fut)
+            assert clresp.return_code() == commlink.BaseCommLink.RC_OK
+            assert self.get_comment(clresp) == comment
+        assert not self.cl._pending
+
+    def test_pipeline02(self) -> None:
+        """A response that no command is waiting for must be kept for read_response()."""
+        fut = self.cl.submit_cmd(".ec -p", 'mine')
+        pipeline_dev(self.cl).inject(TRIGGER_RESPONSE)
+        assert self.get_comment(self.cl.wait_cmd(fut)) == 'mine'
+        clresp = self.cl.read_response()
+        assert clresp[commlink.EP_VAL] == ['000000000000000000001237']
+        # responses to commands sent with send_cmd() are not awaited.
+        self.cl.send_cmd(".ec -p", 'notmine')
+        assert self.get_comment(self.cl.read_response()) == 'notmine'
+
+    def test_pipeline03(self) -> None:
+        """If another greenlet is reading responses, it must hand our responses to us
+        and receive only the ones no command is waiting for."""
+        gotlst: typing.List[commlink.CLResponse] = []
+
+        def reader() -> None:
+            while True:
+                gotlst.append(self.cl.read_response())
+        rd_greenlet = gevent.spawn(reader)
+        gevent.sleep(0)
+        pipeline_dev(self.cl).inject(TRIGGER_RESPONSE)
+        futlst = [self.cl.submit_cmd(".ec -p", comment) for comment in ['one', 'two']]
+        assert [self.get_comment(self.cl.wait_cmd(fut)) for fut in futlst] == ['one', 'two']
+        rd_greenlet.kill()
+        assert len(gotlst) == 1
+        assert gotlst[0][commlink.EP_VAL] is not None
+
+    def test_pipeline04(self) -> None:
+        """Commands in flight must receive a time out response if the reader
+        times out or the device is closed."""
+        pipeline_dev(self.cl).drop = True
+        futlst = [self.cl.submit_cmd(".ec -p", comment) for comment in ['one', 'two']]
+        for fut in futlst:
+            assert self.cl.wait_cmd(fut).return_code() == commlink.BaseCommLink.RC_TIMEOUT
+        fut = self.cl.submit_cmd(".ec -p")
+        self.cl.handle_state_change(False)
+        assert fut.get(block=False).return_code() == commlink.BaseCommLink.RC_TIMEOUT
+        assert not self.cl._pending
+
+    def test_pipeline05(self) -> None:
+        """wait_cmd() must return a time out response if its timeout expires."""
+        fut = self.cl.submit_cmd(".ec -p")
+        assert self.cl.wait_cmd(fut, 0.01).return_code() == commlink.BaseCommLink.RC_TIMEOUT
+        assert not self.cl._pending
+        # the response still arrives later and is returned like any other
+        pipeline_dev(self.cl).inject(TRIGGER_RESPONSE)
+        assert self.cl.read_response()[commlink.EP_VAL] is not None
+        assert self.cl.read_response().return_code() == commlink.BaseCommLink.RC_OK
+
+    def test_pipeline05a(self) -> None:
+        """A response that has started to arrive when the timeout of wait_cmd() expires
+        must be read to its end, so that the following responses are read correctly.
+        An undecipherable response arriving after the timeout must not be handed to the
+        abandoned command."""
+        dev = pipeline_dev(self.cl)
+        dev.drop = True
+        fut = self.cl.submit_cmd(".ec -p")
+        nsplit = len(TRIGGER_RESPONSE)//2
+        dev.inject(TRIGGER_RESPONSE[:nsplit])
+        dev.sched_lst.append((time.monotonic() + 0.1, TRIGGER_RESPONSE[nsplit:]))
+        assert self.cl.wait_cmd(fut, 0.02).return_code() == commlink.BaseCommLink.RC_TIMEOUT
+        assert not self.cl._pending
+        assert self.cl.read_response()[commlink.EP_VAL] == ['000000000000000000001237']
+        dev.inject(b'\xc3\r\nOK:\r\n\r\n')
+        assert self.cl.read_response().return_code() == commlink.BaseCommLink.RC_FAULTY
+        assert not fut.ready()
+
+    def test_pipeline06(self) -> None:
+        """Pipelined commands must overlap: sending them all before waiting must take
+        much less time than sending them one at a time."""
+        numcmd = 5
+        t_start = time.perf_counter()
+        for i in range(numcmd):
+            assert self.cl._blocking_cmd(".ec -p").return_code() == commlink.BaseCommLink.RC_OK
+        t_serial = time.perf_counter() - t_start
+        t_start = time.perf_counter()
+        futlst = [self.cl.submit_cmd(".ec -p") for i in range(numcmd)]
+        for fut in futlst:
+            assert self.cl.wait_cmd(fut).return_code() == commlink.BaseCommLink.RC_OK
+        t_pipelined = time.perf_counter() - t_start
+        print("serial: {:.3f} s, pipelined: {:.3f} s".format(t_serial, t_pipelined))
+        assert t_pipelined < 0.5*t_serial
+
+
+class Test_liveness:
+
+    def setup_method(self) -> None:
+        self.cfgdct = {'logger': logging.Logger("testing"), 'RTT': 0.01, 'PROC_SECS': 0.0,
+                       'RFID_PROBE_SECS': 0.2}
+        self.cl = PipelineSerialCommLink(self.cfgdct)
+
+    def num_vr(self) -> int:
+        return sum(cmdstr.startswith('.vr') for cmdstr in pipeline_dev(self.cl).cmdlst)
+
+    def test_liveness01(self) -> None:
+        """The reader must only be probed if we have not heard from it for RFID_PROBE_SECS."""
+        assert self.cl.get_rfid_state() == commonmsg.CommonMSG.RFID_ON
+        assert self.cl.num_probes == 1 and self.num_vr() == 1
+        for i in range(5):
+            pipeline_dev(self.cl).inject(TRIGGER_RESPONSE)
+            self.cl.read_response()
+            assert self.cl.get_rfid_state() == commonmsg.CommonMSG.RFID_ON
+        assert self.cl.num_probes == 1 and self.num_vr() == 1
+        gevent.sleep(0.25)
+        assert self.cl.get_rfid_state() == commonmsg.CommonMSG.RFID_ON
+        assert self.cl.num_probes == 2 and self.num_vr() == 2
+
+    def test_liveness02(self) -> None:
+        """With RFID_PROBE_SECS = 0, the reader is probed every time."""
+        self.cfgdct['RFID_PROBE_SECS'] = 0
+        cl = PipelineSerialCommLink(self.cfgdct)
+        for i in range(3):
+            assert cl.get_rfid_state() == commonmsg.CommonMSG.RFID_ON
+        assert cl.num_probes == 3
+
+    def test_liveness03(self) -> None:
+        """A time out on reading must cause the next state check to probe the reader."""
+        assert self.cl.get_rfid_state() == commonmsg.CommonMSG.RFID_ON
+        pipeline_dev(self.cl).drop = True
+        self.cl.send_cmd('.iv')
+        assert self.cl.read_response().return_code() == commlink.BaseCommLink.RC_TIMEOUT
+        assert self.cl.get_rfid_state() == commonmsg.CommonMSG.RFID_TIMEOUT
+        assert self.cl.num_probes == 2
+        # a response from the reader brings it back to life without a probe
+        pipeline_dev(self.cl).inject(TRIGGER_RESPONSE)
+        self.cl.read_response()
+        assert self.cl.get_rfid_state() == commonmsg.CommonMSG.RFID_ON
+        assert self.cl.num_probes == 2
+
+    def test_liveness04(self) -> None:
+        """Closing the device must forget that the reader was responding."""
+        assert self.cl.get_rfid_state() == commonmsg.CommonMSG.RFID_ON
+        self.cl.handle_state_change(False)
+        assert self.cl.get_rfid_state() == commonmsg.CommonMSG.RFID_OFF
+        self.cl.handle_state_change(True)
+        assert self.cl.get_rfid_state() == commonmsg.CommonMSG.RFID_ON
+        assert self.cl.num_probes == 2
+
+
+def make_inventory_block(ntags: int) -> bytes:
+    """Return the bytes of a response to an inventory command with RSSI values for ntags tags.
+    Half the EPCs encode ASCII strings, the others are plain hex numbers."""
+    linelst = ['CS: .iv -r on A{"MSG":"7","CMT":"RAD"}B']
+    for i in range(ntags):
+        if i % 2 == 0:
+            epc = (b'CHEM%05d' % i).hex().upper() + '000000'
+        else:
+            epc = '{:024X}'.format(0x3034257BF7194E4000001A85 + i)
+        linelst.extend(['EP: {}'.format(epc), 'RI: {}'.format(-40 - i % 30)])
+    linelst.extend(['OK:', ''])
+    return b''.join(bytes(line, 'utf-8') + commlink.BYTE_CRLF for line in linelst)
+
+
+class Test_parse_bench:
+    """Micro-benchmark the parsing of 500-tag inventory responses."""
+
+    NTAGS = 500
+    NREP = 200
+
+    def setup_method(self) -> None:
+        self.cl = DummySerialCommLink({'logger': logging.Logger("testing")})
+        self.block = make_inventory_block(Test_parse_bench.NTAGS)
+
+    def read_block(self) -> commlink.CLResponse:
+        self.cl.mydev = DummySerialDevice(self.block)
+        return self.cl.raw_read_response()
+
+    def test_parse01(self) -> None:
+        """An inventory block must be parsed into EPCs and RSSI values."""
+        clresp = self.read_block()
+        assert clresp.return_code() == commlink.BaseCommLink.RC_OK
+        eplst = clresp[commlink.EP_VAL]
+        assert eplst is not None and len(eplst) == Test_parse_bench.NTAGS
+        assert eplst[0] == 'CHEM00000' and eplst[2] == 'CHEM00002'
+        assert eplst[1] == '3034257BF7194E4000001A86'
+        rilst = clresp[commlink.RI_VAL]
+        assert rilst is not None and len(rilst) == Test_parse_bench.NTAGS
+        assert clresp.get_comment_dct() == {'MSG': '7', 'CMT': 'RAD'}
+
+    def test_parse02(self) -> None:
+        """A block arriving in chunks must be parsed the same as one read at once,
+        with the bytes of the next block kept for the next call."""
+        exp_rl = self.read_block().rl
+        chunklst = [self.block[i:i+1000] for i in range(0, len(self.block), 1000)]
+        chunklst[-1] += TRIGGER_RESPONSE
+        self.cl.mydev = ChunkDummySerialDevice(chunklst)
+        assert self.cl.raw_read_response().rl == exp_rl
+        assert self.cl.raw_read_response()[commlink.EP_VAL] == ['000000000000000000001237']
+
+    def test_parse03(self) -> None:
+        """Blocks with protocol errors must be handled line by line, as before."""
+        for data, exp_rl in [(b'CS: x\r\nEP: AB\rCD\r\nOK:\r\n\r\n', [('CS', 'x')]),
+                             (b'CS: x\r\nME: \xc3\x28\r\nOK:\r\n\r\n', [('CS', 'x')]),
+                             (b'\r\nOK:\r\n\r\n', []),
+                             (b'CS: x\r\nBLA\r\nOK:\r\n\r\n', [('CS', 'x'), ('OK', '')])]:
+            cl = DummySerialCommLink({'logger': self.cl.logger})
+            cl.mydev = DummySerialDevice(data)
+            assert cl.raw_read_response().rl == exp_rl
+
+    def test_ri_values01(self) -> None:
+        """get_ri_values() must return the RSSI values as an array of ints."""
+        clresp = self.read_block()
+        riarr = clresp.get_ri_values()
+        assert riarr is not None and riarr.typecode == 'i'
+        assert list(riarr[:3]) == [-40, -41, -42]
+        assert commlink.CLResponse([('OK', '')]).get_ri_values() is None
+        with pytest.raises(ValueError):
+            commlink.CLResponse([('RI', 'loud'), ('OK', '')]).get_ri_values()
+
+    @withbench
+    def test_parse_bench01(self) -> None:
+        """Time the stages of parsing a 500-tag inventory response."""
+        raw_rl: commlink.ResponseList = []
+        for line in str(self.block, 'utf-8').split('\r\n'):
+            resptup = commlink.BaseCommLink._line_2_resptup(line) if line else None
+            if resptup is not None:
+                raw_rl.append(resptup)
+        raw_epcs = [val for code, val in raw_rl if code == commlink.EP_VAL]
+        nrep = Test_parse_bench.NREP
+        for name, func in [('raw_read_response', self.read_block),
+                           ('CLResponse', lambda: commlink.CLResponse(raw_rl)),
+                           ('hexstr_to_str', lambda: [commlink.hexstr_to_str(epc) for epc in raw_epcs]),
+                           ('radar_data', lambda: TLSAscii.RunningAve._radar_data(self.cl.logger,
+                                                                                  commlink.CLResponse(raw_rl)))]:
+            t_elapsed = timeit.timeit(func, number=nrep)
+            print("\n{:20s}: {:8.3f} ms per {}-tag response".format(name, 1000.0*t_elapsed/nrep,
+                                                                    Test_parse_bench.NTAGS))
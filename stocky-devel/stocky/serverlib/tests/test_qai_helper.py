@@ -5,11 +5,19 @@ import pytest
 import os.path
 import random
 import string
+import time
+import io
+import json
+import hashlib
+import gevent
+import py
 
 
 import requests
 import serverlib.qai_helper as qai_helper
+import serverlib.fakeqai as fakeqai
 import serverlib.yamlutil as yamlutil
+import serverlib.timelib as timelib
 
 # this is 200
 HTTP_OK = qai_helper.HTTP_OK
@@ -97,13 +105,15 @@ class TrackerSession(qai_helper.QAISession):
         super().__init__(qai_path)
         self._callset: typing.Set[typing.Tuple[str, str]] = set()
 
-    def patch_json(self, path: str, data: typing.Any, params=None, retries=3) -> qai_helper.RequestValue:
+    def patch_json(self, path: str, data: typing.Any, params=None, retries=3,
+                   extra_headers: typing.Optional[typing.Dict[str, str]] = None) -> qai_helper.RequestValue:
         _callset.add(('patch', path))
-        return super().patch_json(path, data, params=params, retries=retries)
+        return super().patch_json(path, data, params=params, retries=retries, extra_headers=extra_headers)
 
-    def post_json(self, path: str, data: typing.Any, retries=3) -> qai_helper.RequestValue:
+    def post_json(self, path: str, data: typing.Any, retries=3,
+                  extra_headers: typing.Optional[typing.Dict[str, str]] = None) -> qai_helper.RequestValue:
         _callset.add(('post', path))
-        return super().post_json(path, data, retries=retries)
+        return super().post_json(path, data, retries=retries, extra_headers=extra_headers)
 
     def get_json(self, path: str, params: dict = None, retries: int = 3) -> qai_helper.RequestValue:
         _callset.add(('get', path))
@@ -123,10 +133,12 @@ class FaultySession(qai_helper.QAISession):
     def __init__(self, qai_path: str) -> None:
         super().__init__(qai_path)
 
-    def patch_json(self, path: str, data: typing.Any, params=None, retries=3) -> qai_helper.RequestValue:
+    def patch_json(self, path: str, data: typing.Any, params=None, retries=3,
+                   extra_headers: typing.Optional[typing.Dict[str, str]] = None) -> qai_helper.RequestValue:
         return [HTTP_OK+1, None]
 
-    def post_json(self, path: str, data: typing.Any, retries=3) -> qai_helper.RequestValue:
+    def post_json(self, path: str, data: typing.Any, retries=3,
+                  extra_headers: typing.Optional[typing.Dict[str, str]] = None) -> qai_helper.RequestValue:
         return [HTTP_OK+1, None]
 
     def get_json(self, path: str, params: dict = None, retries: int = 3) -> qai_helper.RequestValue:
@@ -148,6 +160,128 @@ class FaultySession(qai_helper.QAISession):
         return resp
 
 
+class DelaySession(qai_helper.QAISession):
+    """A session that serves the change numbers and table dumps of a QAI server
+    after a delay, without accessing the network.
+    The tables in fail_set return an HTTP error."""
+    DELAY_SECS = 0.1
+
+    def __init__(self, fetch_pool_size: int = qai_helper.FETCH_POOL_SIZE) -> None:
+        super().__init__(TESTqai_url, fetch_pool_size)
+        self._islogged_in = True
+        self.stamp = 'scn02'
+        self.fail_set: typing.Set[str] = set()
+        self.url_dct = {url: k for k, url in self.data_url_lst}
+
+    def get_json(self, path: str, params: typing.Optional[dict] = None,
+                 retries: int = 3) -> qai_helper.RequestValue:
+        gevent.sleep(self.DELAY_SECS)
+        k = self.url_dct[path]
+        if k in self.fail_set:
+            return HTTP_INTERNAL_SERVER_ERROR, None
+        return HTTP_OK, [dict(table=k)]
+
+    def _rawget(self, path: str, params: typing.Optional[dict] = None,
+                retries: int = 3) -> requests.Response:
+        gevent.sleep(self.DELAY_SECS)
+        resp = requests.Response()
+        resp.status_code = HTTP_OK
+        resp._content = self.stamp.encode('utf-8')
+        return resp
+
+
+class StreamSession(qai_helper.QAISession):
+    """A session that serves a fixed response body to streamed requests,
+    without accessing the network."""
+
+    def __init__(self, body: bytes, status_code: int = HTTP_OK) -> None:
+        super().__init__(TESTqai_url)
+        self._islogged_in = True
+        self.body = body
+        self.status_code = status_code
+        self.num_requests = 0
+
+    def _retry_response(self, method, path: str, data: typing.Any = None, params: typing.Optional[dict] = None,
+                        retries: int = 3, expect_json: bool = True, stream: bool = False,
+                        extra_headers: typing.Optional[typing.Dict[str, str]] = None) -> requests.Response:
+        self.num_requests += 1
+        resp = requests.Response()
+        resp.status_code = self.status_code
+        resp.raw = io.BytesIO(self.body)
+        return resp
+
+
+class CacheSession(qai_helper.QAISession):
+    """A session that serves list endpoints with ETag validators, without
+    accessing the network. The content of a path is in content_dct."""
+
+    def __init__(self, cache: qai_helper.ResponseCache) -> None:
+        super().__init__(TESTqai_url, response_cache=cache)
+        self._islogged_in = True
+        self.cache = cache
+        self.content_dct: typing.Dict[str, typing.Any] = {}
+        self.reqlst: typing.List[typing.Tuple[str, dict]] = []
+
+    def get(self, url: typing.Union[str, bytes], *args: typing.Any, **kwargs: typing.Any) -> requests.Response:
+        assert isinstance(url, str), "a str url expected"
+        path = url[len(self.qai_path):]
+        headers = kwargs.get('headers', {})
+        self.reqlst.append((path, headers))
+        body = json.dumps(self.content_dct[path]).encode('utf-8')
+        etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+        resp = requests.Response()
+        resp.headers['ETag'] = etag
+        if headers.get('If-None-Match', None) == etag:
+            resp.status_code = qai_helper.HTTP_NOT_MODIFIED
+            resp._content = b''
+        else:
+            resp.status_code = HTTP_OK
+            resp._content = body
+        return resp
+
+
+class FlakySession(qai_helper.QAISession):
+    """A session whose GET and POST requests raise the exceptions in exc_lst, one per request,
+    and then return status_code, without accessing the network."""
+
+    def __init__(self, exc_lst: typing.List[Exception],
+                 breaker: typing.Optional[qai_helper.CircuitBreaker] = None) -> None:
+        super().__init__(TESTqai_url, breaker=breaker)
+        self._islogged_in = True
+        self.exc_lst = exc_lst
+        self.status_code = HTTP_OK
+        self.reqlst: typing.List[typing.Tuple[str, typing.Any]] = []
+
+    def get(self, url: typing.Union[str, bytes], *args: typing.Any, **kwargs: typing.Any) -> requests.Response:
+        assert isinstance(url, str), "a str url expected"
+        self.reqlst.append((url[len(self.qai_path):], kwargs.get('timeout', None)))
+        if self.exc_lst:
+            raise self.exc_lst.pop(0)
+        resp = requests.Response()
+        resp.status_code = self.status_code
+        resp._content = b'[]'
+        return resp
+
+    def post(self, url: typing.Union[str, bytes], *args: typing.Any, **kwargs: typing.Any) -> requests.Response:
+        return self.get(url, *args, **kwargs)
+
+
+class FakeClock:
+    """A clock for testing time-dependent behaviour."""
+
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def chunked(data: bytes, size: int) -> typing.Iterator[bytes]:
+    """Split data into chunks of the given size."""
+    for ndx in range(0, len(data), size):
+        yield data[ndx:ndx+size]
+
+
 def setup_module(module) -> None:
     print("SEETUP MODULE")
     # assert False, "force fail"
@@ -262,6 +396,443 @@ class Test_qai_helpers:
         # assert False, "force fail"
 
 
+class Test_qai_fetch:
+    """Test the concurrent retrieval of change numbers and table dumps.
+    These tests are independent of access to a QAI server."""
+
+    def test_changedata01(self) -> None:
+        """The change numbers must be retrieved concurrently, with the same result
+        as when retrieved one after another."""
+        res_dct = {}
+        for pool_size in (1, qai_helper.FETCH_POOL_SIZE):
+            s = DelaySession(pool_size)
+            t_start = time.perf_counter()
+            res_dct[pool_size] = s.get_qai_changedata()
+            secs = time.perf_counter() - t_start
+            num_calls = len(s.timestamp_url_lst)
+            if pool_size == 1:
+                assert secs >= num_calls * DelaySession.DELAY_SECS
+            else:
+                assert secs < num_calls * DelaySession.DELAY_SECS / 2, "calls not concurrent"
+        assert res_dct[1] == res_dct[qai_helper.FETCH_POOL_SIZE]
+        assert res_dct[1] == {k: 'scn02' for k in qai_helper.QAISession.qai_key_lst}
+
+    def test_clever_update01(self) -> None:
+        """Only the stale tables must be downloaded, and a table that fails must
+        not stop the others from being updated."""
+        S = qai_helper.QAISession
+        s = DelaySession()
+        s.fail_set = {S.QAIDCT_USERS}
+        tsdct = {k: 'scn02' for k in S.qai_key_lst}
+        for k in (S.QAIDCT_REAGENTS, S.QAIDCT_LOCATIONS, S.QAIDCT_USERS):
+            tsdct[k] = 'scn01'
+        qaids = qai_helper.QAIDataset(None, tsdct)
+        upd_dct = s.clever_update_qai_dump(qaids)
+        assert upd_dct == {k: k in (S.QAIDCT_REAGENTS, S.QAIDCT_LOCATIONS) for k in S.qai_key_lst}
+        qaidct = qaids.get_data()
+        assert qaidct[S.QAIDCT_REAGENTS] == [dict(table=S.QAIDCT_REAGENTS)]
+        assert qaidct[S.QAIDCT_USERS] is None, "failed table should be unchanged"
+        assert tsdct[S.QAIDCT_LOCATIONS] == 'scn02'
+        assert tsdct[S.QAIDCT_USERS] == 'scn01', "failed table stamp should be unchanged"
+        assert set(s.get_fetch_errors().keys()) == {S.QAIDCT_USERS}
+
+    def test_qai_dump01(self) -> None:
+        """A complete dump must raise a RuntimeError if any table fails."""
+        S = qai_helper.QAISession
+        s = DelaySession()
+        ds = s.get_qai_dump()
+        assert ds.get_data() == {k: [dict(table=k)] for k in S.qai_key_lst}
+        s.fail_set = {S.QAIDCT_REAGENTS}
+        with pytest.raises(RuntimeError):
+            s.get_qai_dump()
+
+    def test_bad_pool_size01(self) -> None:
+        """An illegal pool size must raise a ValueError."""
+        bad_lst: typing.List[typing.Any] = [0, 'many']
+        for pool_size in bad_lst:
+            with pytest.raises(ValueError):
+                qai_helper.QAISession(TESTqai_url, pool_size)
+
+
+class Test_qai_stream:
+    """Test the incremental parsing of streamed table dumps.
+    These tests are independent of access to a QAI server."""
+
+    def test_iter_json_array01(self) -> None:
+        """The elements must be parsed correctly regardless of where the input is split."""
+        data = [dict(id=1, name='Ångström \u2603', val=12345.5e3, ok=True, lst=[1, [2, 3]]),
+                -17, "a string with \\ and \" and ] and ,", None, [], {}, 1234567890]
+        body = json.dumps(data, indent=1).encode('utf-8')
+        for size in range(1, 40):
+            got_lst = list(qai_helper.iter_json_array(chunked(body, size)))
+            assert got_lst == data, "wrong result with chunk size {}".format(size)
+
+    def test_iter_json_array02(self) -> None:
+        """Empty arrays must be parsed, and invalid input must raise a ValueError."""
+        for body in [b'[]', b' [ ] ', b'\n[\n]\n']:
+            assert list(qai_helper.iter_json_array(chunked(body, 1))) == []
+        for body in [b'', b'{"a": 1}', b'[1, 2', b'[1 2]', b'[1,]', b'[{"a": 1]', b'bla']:
+            for size in (1, 100):
+                with pytest.raises(ValueError):
+                    list(qai_helper.iter_json_array(chunked(body, size)))
+
+    def test_stream_table_dump01(self) -> None:
+        """A table dump must be streamed only when iterated over, and
+        errors must raise a QAIStreamError."""
+        reclst = [dict(id=i, status='MADE') for i in range(1000)]
+        s = StreamSession(json.dumps(reclst).encode('utf-8'))
+        rec_iter = s.stream_table_dump('reagent_item_status', qai_helper.DUMP_REAG_ITEM_STATUS)
+        assert s.num_requests == 0, "no request expected before iteration"
+        assert list(rec_iter) == reclst
+        assert s.num_requests == 1
+        for bad_session in [StreamSession(b'[1, 2', HTTP_OK),
+                            StreamSession(b'[]', HTTP_INTERNAL_SERVER_ERROR)]:
+            with pytest.raises(qai_helper.QAIStreamError):
+                list(bad_session.stream_table_dump('users', qai_helper.DUMP_USERS))
+
+    def test_clever_update_stream01(self) -> None:
+        """In stream mode, the stale tables must be set to iterators."""
+        S = qai_helper.QAISession
+        s = DelaySession()
+        tsdct = {k: 'scn02' for k in S.qai_key_lst}
+        tsdct[S.QAIDCT_REAITEM_STATUS] = 'scn01'
+        qaids = qai_helper.QAIDataset(None, tsdct)
+        upd_dct = s.clever_update_qai_dump(qaids, stream=True)
+        assert upd_dct == {k: k == S.QAIDCT_REAITEM_STATUS for k in S.qai_key_lst}
+        assert not isinstance(qaids.get_data()[S.QAIDCT_REAITEM_STATUS], list), "iterator expected"
+        assert tsdct[S.QAIDCT_REAITEM_STATUS] == 'scn02'
+
+
+class Test_qai_cache:
+    """Test the response cache.
+    These tests are independent of access to a QAI server."""
+
+    def make_session(self, tmpdir: py.path.local, ttl: float, max_bytes: int = 10000) -> CacheSession:
+        cache = qai_helper.ResponseCache(str(tmpdir.join('cache')),
+                                         {PATH_LOCATION_LIST: ttl, PATH_USER_LIST: ttl},
+                                         max_bytes=max_bytes)
+        s = CacheSession(cache)
+        s.content_dct = {PATH_LOCATION_LIST: [dict(id=1, name='fridge')],
+                         PATH_USER_LIST: [dict(id=2, login='bla')],
+                         PATH_REAGENT_LIST_REAGENTS: [dict(id=3, name='water')]}
+        return s
+
+    def test_cache_ttl01(self, tmpdir: py.path.local) -> None:
+        """Within its TTL, a response must be served without a request."""
+        s = self.make_session(tmpdir, 3600)
+        for i in range(3):
+            assert s.get_json(PATH_LOCATION_LIST) == (HTTP_OK, s.content_dct[PATH_LOCATION_LIST])
+        assert len(s.reqlst) == 1, "one request expected"
+        stats = s.cache.get_stats()
+        assert stats['hits'] == 2 and stats['misses'] == 1 and stats['nentries'] == 1
+        # paths without a TTL are not cached
+        for i in range(2):
+            s.get_json(PATH_REAGENT_LIST_REAGENTS)
+        assert len(s.reqlst) == 3
+        # the cache is kept on disk
+        newsession = self.make_session(tmpdir, 3600)
+        assert newsession.get_json(PATH_LOCATION_LIST) == (HTTP_OK, s.content_dct[PATH_LOCATION_LIST])
+        assert newsession.reqlst == []
+
+    def test_cache_revalidate01(self, tmpdir: py.path.local) -> None:
+        """After its TTL, a response must be revalidated with a conditional request."""
+        s = self.make_session(tmpdir, 0)
+        exp_val = (HTTP_OK, s.content_dct[PATH_LOCATION_LIST])
+        assert s.get_json(PATH_LOCATION_LIST) == exp_val
+        assert 'If-None-Match' not in s.reqlst[0][1]
+        assert s.get_json(PATH_LOCATION_LIST) == exp_val
+        assert 'If-None-Match' in s.reqlst[1][1]
+        assert s.cache.get_stats()['revalidated'] == 1
+        # a changed resource must be downloaded again
+        s.content_dct[PATH_LOCATION_LIST] = [dict(id=1, name='freezer')]
+        assert s.get_json(PATH_LOCATION_LIST) == (HTTP_OK, s.content_dct[PATH_LOCATION_LIST])
+        stats = s.cache.get_stats()
+        assert stats['revalidated'] == 1 and stats['misses'] == 2
+
+    def test_cache_lru01(self, tmpdir: py.path.local) -> None:
+        """The least recently used responses must be evicted when the size limit is exceeded."""
+        s = self.make_session(tmpdir, 3600, max_bytes=1000)
+        s.content_dct[PATH_LOCATION_LIST] = [dict(id=i, name='loc') for i in range(20)]
+        s.content_dct[PATH_USER_LIST] = [dict(id=i, login='usr') for i in range(20)]
+        s.get_json(PATH_LOCATION_LIST)
+        s.get_json(PATH_USER_LIST)
+        stats = s.cache.get_stats()
+        assert stats['evictions'] == 1 and stats['nentries'] == 1
+        assert stats['nbytes'] <= 1000
+        # the location list was evicted, the user list was not
+        s.get_json(PATH_USER_LIST)
+        s.get_json(PATH_LOCATION_LIST)
+        assert [path for path, headers in s.reqlst] == [PATH_LOCATION_LIST, PATH_USER_LIST, PATH_LOCATION_LIST]
+
+    def test_cache_user01(self, tmpdir: py.path.local) -> None:
+        """A response cached for one QAI user must not be served to another."""
+        s = self.make_session(tmpdir, 3600)
+        s._qai_user = 'alice'
+        s.get_json(PATH_LOCATION_LIST)
+        s._qai_user = 'bob'
+        s.content_dct[PATH_LOCATION_LIST] = [dict(id=1, name='freezer')]
+        assert s.get_json(PATH_LOCATION_LIST) == (HTTP_OK, s.content_dct[PATH_LOCATION_LIST])
+        assert len(s.reqlst) == 2, "a request for the second user expected"
+        s._qai_user = 'alice'
+        assert s.get_json(PATH_LOCATION_LIST) == (HTTP_OK, [dict(id=1, name='fridge')])
+        assert len(s.reqlst) == 2
+
+    def test_cache_args01(self, tmpdir: py.path.local) -> None:
+        """Illegal arguments must raise a ValueError."""
+        bad_lst: typing.List[typing.Tuple[typing.Dict[str, float], int]] = [({}, 0), ({PATH_USER_LIST: -1}, 100)]
+        for ttl_dct, max_bytes in bad_lst:
+            with pytest.raises(ValueError):
+                qai_helper.ResponseCache(str(tmpdir), ttl_dct, max_bytes)
+
+
+class Test_qai_retry:
+    """Test the retries, timeouts and circuit breaker of QAI requests.
+    These tests are independent of access to a QAI server."""
+
+    def setup_method(self) -> None:
+        self.base_delay = qai_helper.RETRY_BASE_DELAY
+        qai_helper.RETRY_BASE_DELAY = 0.01
+
+    def teardown_method(self) -> None:
+        qai_helper.RETRY_BASE_DELAY = self.base_delay
+
+    def test_breaker01(self) -> None:
+        """The breaker must open after the threshold, allow a single trial after
+        the reset time and close again after a success."""
+        clock = FakeClock()
+        b = qai_helper.CircuitBreaker(3, 10.0, clock)
+        CB = qai_helper.CircuitBreaker
+        for i in range(3):
+            assert b.allow_request() and b.get_state() == CB.STATE_CLOSED
+            b.record_failure()
+        assert b.get_state() == CB.STATE_OPEN and not b.allow_request()
+        assert b.num_opened == 1
+        clock.now = 10.0
+        assert b.get_state() == CB.STATE_HALF_OPEN
+        assert b.allow_request(), "trial request expected"
+        assert not b.allow_request(), "only one trial request expected"
+        b.record_failure()
+        assert b.get_state() == CB.STATE_OPEN and b.num_opened == 2
+        clock.now = 20.0
+        assert b.allow_request()
+        b.record_success()
+        assert b.get_state() == CB.STATE_CLOSED and b.allow_request()
+        with pytest.raises(ValueError):
+            qai_helper.CircuitBreaker(0)
+
+    def test_retry01(self) -> None:
+        """Timed out requests must be retried, and requests must have per-path timeouts."""
+        s = FlakySession([requests.exceptions.ReadTimeout(), requests.exceptions.ReadTimeout()])
+        assert s.get_json(PATH_LOCATION_LIST) == (HTTP_OK, [])
+        assert s.reqlst == [(PATH_LOCATION_LIST, qai_helper.DEFAULT_TIMEOUT)]*3
+        stats = s.get_retry_stats()
+        assert stats['requests'] == 3 and stats['retries'] == 2 and stats['timeouts'] == 2
+        assert stats['breaker_state'] == qai_helper.CircuitBreaker.STATE_CLOSED
+        s.get_json(qai_helper.DUMP_USERS)
+        assert s.reqlst[-1] == (qai_helper.DUMP_USERS, qai_helper.DEFAULT_TIMEOUT_DCT['/table_dump/'])
+        # too many failures
+        s.exc_lst = [requests.exceptions.ReadTimeout()]*3
+        with pytest.raises(requests.exceptions.ReadTimeout):
+            s.get_json(PATH_LOCATION_LIST, retries=2)
+
+    def test_retry02(self) -> None:
+        """A POST request that timed out must not be repeated, as QAI may have
+        performed it. A gateway error response must count as a failure."""
+        s = FlakySession([requests.exceptions.ReadTimeout()])
+        with pytest.raises(requests.exceptions.ReadTimeout):
+            s.post_json(PATH_LOCATION_LIST, {'a': 1})
+        assert len(s.reqlst) == 1
+        stats = s.get_retry_stats()
+        assert stats['retries'] == 0 and stats['timeouts'] == 1
+        # other errors are still retried
+        s.exc_lst = [requests.exceptions.ChunkedEncodingError()]
+        assert s.post_json(PATH_LOCATION_LIST, {'a': 1}) == (HTTP_OK, [])
+        assert len(s.reqlst) == 3
+        clock = FakeClock()
+        s = FlakySession([], qai_helper.CircuitBreaker(3, 10.0, clock))
+        s.status_code = 503
+        for i in range(3):
+            assert s.get_json(PATH_LOCATION_LIST) == (503, [])
+        assert s.get_retry_stats()['breaker_state'] == qai_helper.CircuitBreaker.STATE_OPEN
+        with pytest.raises(qai_helper.QAIUnavailableError):
+            s.get_json(PATH_LOCATION_LIST)
+
+    def test_fail_fast01(self) -> None:
+        """When the breaker is open, requests must fail without contacting QAI."""
+        clock = FakeClock()
+        s = FlakySession([requests.exceptions.ConnectionError()]*3,
+                         qai_helper.CircuitBreaker(3, 10.0, clock))
+        for i in range(3):
+            with pytest.raises(requests.exceptions.ConnectionError):
+                s.get_json(PATH_LOCATION_LIST)
+        with pytest.raises(qai_helper.QAIUnavailableError):
+            s.get_json(PATH_LOCATION_LIST)
+        assert len(s.reqlst) == 3, "no request expected while the breaker is open"
+        stats = s.get_retry_stats()
+        assert stats['rejected'] == 1 and stats['breaker_opened'] == 1
+        assert stats['breaker_state'] == qai_helper.CircuitBreaker.STATE_OPEN
+        clock.now = 10.0
+        assert s.get_json(PATH_LOCATION_LIST) == (HTTP_OK, [])
+        assert s.get_retry_stats()['breaker_state'] == qai_helper.CircuitBreaker.STATE_CLOSED
+
+    def test_cancel01(self) -> None:
+        """Waiting for a retry must not block other greenlets, and must be cancellable."""
+        qai_helper.RETRY_BASE_DELAY = 30.0
+        s = FlakySession([requests.exceptions.ReadTimeout()])
+        ticks = []
+
+        def ticker() -> None:
+            for i in range(5):
+                ticks.append(i)
+                gevent.sleep(0.01)
+        t_start = time.time()
+        g = gevent.spawn(s.get_json, PATH_LOCATION_LIST)
+        gevent.spawn(ticker).join()
+        assert len(ticks) == 5, "the retry must not block other greenlets"
+        s.cancel_retries()
+        g.join(timeout=5.0)
+        assert isinstance(g.exception, qai_helper.QAIRetryCancelled)
+        assert time.time() - t_start < 5.0
+        assert s.get_retry_stats()['cancelled'] == 1
+        # later requests are not cancelled
+        assert s.get_json(PATH_LOCATION_LIST) == (HTTP_OK, [])
+
+
+class Test_fake_qai:
+    """Test QAISession against the stand-in QAI server."""
+
+    def login(self, srv: fakeqai.FakeQAIServer) -> qai_helper.QAISession:
+        # the time zone is needed for reporting item locations
+        timelib.set_local_timezone("America/Vancouver")
+        s = qai_helper.QAISession(srv.url)
+        s.login(fakeqai.DEFAULT_USER, fakeqai.DEFAULT_PASSWORD)
+        return s
+
+    def test_fake_login01(self, fake_qai: fakeqai.FakeQAIServer) -> None:
+        """Login must only succeed with the correct password."""
+        s = qai_helper.QAISession(fake_qai.url)
+        assert not s.login_try(fakeqai.DEFAULT_USER, 'wrong')['ok']
+        assert s.login_try(fakeqai.DEFAULT_USER, fakeqai.DEFAULT_PASSWORD)['ok']
+        assert s._qai_user == fakeqai.DEFAULT_USER, "responses must be cached for the user"
+        s.logout()
+        assert not s.is_logged_in() and s._qai_user is None
+
+    def test_fake_dump01(self, fake_qai: fakeqai.FakeQAIServer) -> None:
+        """A dump must return the data served, and a reported location change
+        must be visible in the next incremental update."""
+        S = qai_helper.QAISession
+        s = self.login(fake_qai)
+        qaids = s.get_qai_dump()
+        assert qaids.get_data() == fake_qai.get_data()
+        reag_item = qaids.get_data()[S.QAIDCT_REAGENT_ITEMS][0]
+        assert s.report_item_location(reag_item['id'], 10005, 'moved')['ok']
+        assert s.report_item_location(reag_item['id'], 10005, 'missing')['ok']
+        for opstring in ('missing', 'found', 'moved'):
+            resdct = s.report_item_location(1, 10005, opstring)
+            assert not resdct['ok'], "unknown item must fail"
+            assert resdct['rcode'] == qai_helper.HTTP_UNPROCESSABLE
+        upd_dct = s.clever_update_qai_dump(qaids)
+        assert upd_dct == {k: k in (S.QAIDCT_REAGENT_ITEMS, S.QAIDCT_REAITEM_STATUS) for k in S.qai_key_lst}
+        new_item = qaids.get_data()[S.QAIDCT_REAGENT_ITEMS][0]
+        assert new_item['qcs_location_id'] == 10005
+        last_stat = qaids.get_data()[S.QAIDCT_REAITEM_STATUS][-1]
+        assert last_stat['qcs_reag_item_id'] == reag_item['id'] and last_stat['status'] == 'MISSING'
+        stats = fake_qai.get_stats()
+        assert stats['set_location'] == 3 and stats['add_status'] == 2
+
+    def test_fake_gzip01(self, fake_qai: fakeqai.FakeQAIServer) -> None:
+        """Compressed table dumps must be decoded correctly, the bytes received must be
+        recorded, and the requests must reuse a single connection."""
+        S = qai_helper.QAISession
+        s = self.login(fake_qai)
+        url = dict(S.data_url_lst)[S.QAIDCT_REAITEM_STATUS]
+        explst = fake_qai.get_data()[S.QAIDCT_REAITEM_STATUS]
+        for compress in (False, True):
+            fake_qai.compress = compress
+            for stream in (False, True):
+                if stream:
+                    gotlst = list(s.stream_table_dump(S.QAIDCT_REAITEM_STATUS, url))
+                else:
+                    gotlst = s.get_json(url)[1]
+                assert gotlst == explst, "wrong data"
+                rec = s.get_transfer_stats()['recent'][-1]
+                assert rec['path'] == url and rec['decode_secs'] >= 0.0
+                if compress:
+                    assert rec['encoding'] == 'gzip'
+                    assert rec['wire_bytes'] < rec['body_bytes']/2, "poor compression"
+                else:
+                    assert rec['encoding'] == 'identity'
+                    assert rec['wire_bytes'] == rec['body_bytes']
+        stats = s.get_transfer_stats()
+        assert stats['requests'] == 4 and stats['compressed'] == 2
+        assert fake_qai.get_stats()['connections'] == 1, "connection was not kept alive"
+
+    def test_fake_pool01(self) -> None:
+        """The connection pool must be large enough for the concurrent fetches."""
+        s = qai_helper.QAISession('http://localhost:1', fetch_pool_size=4)
+        adapter = s.get_adapter('http://localhost:1')
+        assert isinstance(adapter, requests.adapters.HTTPAdapter), "an HTTP adapter expected"
+        assert adapter._pool_maxsize == 4 + qai_helper.HTTP_POOL_SPARE
+        assert 'gzip' in s.headers['Accept-Encoding']
+
+    def test_fake_idem01(self, fake_qai: fakeqai.FakeQAIServer) -> None:
+        """A location change repeated with the same idempotency key must only be
+        recorded once."""
+        S = qai_helper.QAISession
+        s = self.login(fake_qai)
+        reag_item_id = fake_qai.get_data()[S.QAIDCT_REAGENT_ITEMS][0]['id']
+        nstat = len(fake_qai.get_data()[S.QAIDCT_REAITEM_STATUS])
+        for idem_key in ('key1', 'key1', 'key2'):
+            assert s.report_item_location(reag_item_id, 10005, 'missing', idem_key=idem_key)['ok']
+        assert len(fake_qai.get_data()[S.QAIDCT_REAITEM_STATUS]) == nstat + 2
+        assert fake_qai.get_stats()['idem_replays'] == 1
+
+    def test_reagent_memo01(self, fake_qai: fakeqai.FakeQAIServer, tmpdir: py.path.local) -> None:
+        """Reagent details must only be requested if they are not in the memo
+        or the reagent tables have changed."""
+        S = qai_helper.QAISession
+        fname = str(tmpdir.join('reagents.memo'))
+        s = self.login(fake_qai)
+        s.reagent_memo = qai_helper.ReagentDetailMemo(fname)
+        reaglst = fake_qai.get_data()[S.QAIDCT_REAGENTS][:25]
+        rdct = s._get_reagent_items(reaglst[:20])
+        assert list(rdct.keys()) == [r['id'] for r in reaglst[:20]]
+        itmlst = fake_qai.get_data()[S.QAIDCT_REAGENT_ITEMS]
+        for reag_id, r_show in rdct.items():
+            assert r_show['items'] == [itm for itm in itmlst if itm['qcs_reag_id'] == reag_id]
+        assert fake_qai.get_stats()['reagent_show'] == 20
+        # the memo is read back from disk
+        s.reagent_memo = qai_helper.ReagentDetailMemo(fname)
+        assert s._get_reagent_items(reaglst[:20]) == rdct
+        assert fake_qai.get_stats()['reagent_show'] == 20, "no requests expected"
+        s._get_reagent_items(reaglst)
+        assert fake_qai.get_stats()['reagent_show'] == 25
+        # a change of the reagent items table invalidates the memo
+        fake_qai.touch_table(S.QAIDCT_REAGENT_ITEMS)
+        s._get_reagent_items(reaglst)
+        assert fake_qai.get_stats()['reagent_show'] == 50
+        assert len(s.reagent_memo) == 25
+        fake_qai.touch_table(S.QAIDCT_REAGENTS)
+        fake_qai.error_rate = 1.0
+        with pytest.raises(RuntimeError):
+            s._get_reagent_items(reaglst)
+
+    def test_fake_faults01(self, fake_qai: fakeqai.FakeQAIServer) -> None:
+        """The server must add the latency set and inject errors."""
+        s = self.login(fake_qai)
+        fake_qai.latency = 0.05
+        t_start = time.time()
+        s.get_qai_changedata()
+        assert time.time() - t_start >= 0.05
+        fake_qai.latency = 0.0
+        fake_qai.error_rate = 1.0
+        with pytest.raises(RuntimeError):
+            s.get_qai_dump()
+        assert fake_qai.get_stats()['errors_injected'] >= 1
+        with pytest.raises(ValueError):
+            fakeqai.FakeQAIServer({}, error_rate=2.0)
+
+
 @withqai
 class Test_qai_log_in:
     """These tests are performed before a valid log in has been performed."""
@@ -38,6 +38,12 @@ class Test_serverlib:
         got_set = set(retdct.keys())
         assert got_set == serverconfig.valid_keys, "unexpected keys"
 
+    def test_S_optional_default(self) -> None:
+        "Optional keywords missing from a serverconfig file must be set to their default values."
+        retdct = serverconfig.read_server_config(get_testfilename('test02.OK.yaml'))
+        for k, defval in serverconfig.optional_dct.items():
+            assert retdct[k] == defval, "unexpected value for {}".format(k)
+
     def test_L_missing_file(self) -> None:
         "A missing loggingconfig file should raise an error"
         with pytest.raises(RuntimeError):
@@ -77,7 +83,11 @@ class Test_serverlib:
         for k, brokenval in [('VERSION', serverconfig.VERSION_FLT + 0.1),
                              ('RFID_REGION_CODE', 'blaa'),
                              ('TIME_ZONE', '?'),
-                             ('TIME_ZONE', 'moon')
+                             ('TIME_ZONE', 'moon'),
+                             ('QAI_PREFETCH_SECS', -1),
+                             ('QAI_PREFETCH_SECS', 'often'),
+                             ('QAI_OUTBOX_SECS', -5),
+                             ('RFID_PROBE_SECS', -1)
                              ]:
             # with mock.patch.dict(dnew, values={k: brokenval}):
             with mock.patch.dict(dnew, {k: brokenval}):
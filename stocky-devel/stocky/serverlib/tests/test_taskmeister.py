@@ -9,6 +9,7 @@ import tempfile
 
 import serverlib.Taskmeister as Taskmeister
 import serverlib.qai_helper as qai_helper
+import serverlib.chemdb as chemdb
 import serverlib.ServerWebSocket as ServerWebSocket
 
 from webclient.commonmsg import CommonMSG
@@ -58,6 +59,40 @@ class DummyWebsocket:
         self._sendlst.append(msg)
 
 
+class DummyStockDB(chemdb.BaseDB):
+    """A database that returns a list of responses to prefetch_qai_update() calls.
+    It does not call the BaseDB constructor, so it holds no data."""
+    def __init__(self, retlst: typing.List[typing.Any]) -> None:
+        self.retlst = retlst
+
+    def prefetch_qai_update(self, max_age: typing.Optional[float] = None) -> typing.List[str]:
+        ret = self.retlst.pop(0) if self.retlst else []
+        if isinstance(ret, Exception):
+            raise ret
+        return ret
+
+
+class DummyOutboxDB(chemdb.BaseDB):
+    """A database with an outbox of npending location changes,
+    one of which is reported on every drain_outbox() call.
+    It does not call the BaseDB constructor, so it holds no data."""
+    def __init__(self, npending: int) -> None:
+        self.npending = npending
+
+    def drain_outbox(self, progress_func: typing.Optional[chemdb.ProgressFunc] = None,
+                     now: typing.Optional[float] = None) -> dict:
+        if self.npending == 0:
+            return dict(ok=True, nsent=0, nfailed=0, npending=0, items={})
+        self.npending -= 1
+        if progress_func is not None:
+            progress_func(1, 1, 0)
+        return dict(ok=True, nsent=1, nfailed=0, npending=self.npending, items={})
+
+    def get_outbox_status(self, now: typing.Optional[float] = None) -> dict:
+        return dict(npending=self.npending, nretrying=0, oldest=None, next_try=None,
+                    last_error=None, rejected=[])
+
+
 class ExceptionDummyWebsocket(DummyWebsocket):
 
     def receive(self) -> bytes:
@@ -299,6 +334,35 @@ class Test_Taskmeister:
                                              "testy",
                                              testlist)
 
+    def test_qaiprefetch01(self) -> None:
+        """A QAIPrefetcher must generate a message only when tables were downloaded,
+        and must survive QAI errors."""
+        stockdb = DummyStockDB([[], RuntimeError('QAI is down'), ['users', 'locations']])
+        tt = Taskmeister.QAIPrefetcher(self.msgq, self.logger, self.sec_interval, stockdb)
+        gevent.sleep(self.sec_interval * 3.5)
+        tt.set_active(False)
+        gotlst = self.msgq.msglst
+        assert len(gotlst) == 1, "expected a single message"
+        msg = gotlst[0]
+        assert msg.msg == CommonMSG.MSG_SV_QAI_CHANGE_NOTICE
+        assert msg.data == dict(tables=['users', 'locations'])
+
+    def test_outboxdrainer01(self) -> None:
+        """An OutboxDrainer must report its progress, generate a status message
+        only when the state of the outbox has changed, and request a stock list
+        update whenever changes were reported."""
+        stockdb = DummyOutboxDB(2)
+        tt = Taskmeister.OutboxDrainer(self.msgq, self.logger, self.sec_interval, stockdb)
+        gevent.sleep(self.sec_interval * 4.5)
+        tt.set_active(False)
+        msglst = [(msg.msg, msg.data) for msg in self.msgq.msglst]
+        stat_lst = [dat['npending'] for m, dat in msglst if m == CommonMSG.MSG_SV_OUTBOX_STATUS]
+        assert stat_lst == [1, 0]
+        nprog = sum(m == CommonMSG.MSG_SV_LOCMUT_PROGRESS for m, dat in msglst)
+        assert nprog == 2
+        upd_lst = [dat for m, dat in msglst if m == CommonMSG.MSG_WC_STOCK_INFO_REQ]
+        assert upd_lst == [dict(do_update=True)]*2
+
     def test_wsreader01(self):
         """The WebSocketReader must behave sensibly when it reads
         junk from the websocket, and also produce a message on good data.
@@ -104,6 +104,10 @@ class CommonMSG:
     # info from QAI.
     MSG_WC_STOCK_INFO_REQ = 'WC_CS_INFO_REQ'
 
+    # the server has downloaded changes from QAI in the background. These will be
+    # loaded into the local database on the next MSG_WC_STOCK_INFO_REQ with do_update=True.
+    MSG_SV_QAI_CHANGE_NOTICE = 'SV_QAI_CHANGE_NOTICE'
+
     # The web client is sending the server some stock location change data.
     # This data is produced in the course of the stock taking procedure, i.e.,
     # which RFID tags were detected at a particular location.
@@ -116,10 +120,25 @@ class CommonMSG:
     MSG_SV_LOCMUT_RESP = 'SV_LOCMUT_RESP'
 
     # when the user has selected a number of location changes to accept, these are sent
-    # to the stocky server. The stocky server will respond with a result indicating
-    # success or otherwise.
+    # to the stocky server. The stocky server commits them to its outbox of changes to be
+    # reported to QAI, and will respond with a result indicating success or otherwise.
     MSG_WC_DO_LOCMUT_REQ = 'WC_DO_LOCMUT_REQ'
     MSG_SV_DO_LOCMUT_RESP = 'SV_DO_LOCMUT_RESP'
+    # while uploading the location changes to QAI, the server reports its progress.
+    MSG_SV_LOCMUT_PROGRESS = 'SV_LOCMUT_PROGRESS'
+    # the server tells the webclient how many location changes are still waiting
+    # to be reported to QAI, and which ones QAI has refused.
+    MSG_SV_OUTBOX_STATUS = 'SV_OUTBOX_STATUS'
+    # the user has decided what to do with location changes that QAI has refused:
+    # the server either reports them again or discards them, and responds with
+    # a MSG_SV_OUTBOX_STATUS.
+    MSG_WC_RESOLVE_REJECTED_REQ = 'WC_RESOLVE_REJECTED_REQ'
+
+    # the web client wants to know which reagent items a list of RFID tags belong to,
+    # e.g. those detected in an inventory scan. The server resolves all tags in one
+    # response using its RFID index.
+    MSG_WC_RFID_LOOKUP_REQ = 'WC_RFID_LOOKUP_REQ'
+    MSG_SV_RFID_LOOKUP_RESP = 'SV_RFID_LOOKUP_RESP'
 
     # the RFID reader has produced some radar data
     MSG_RF_RADAR_DATA = 'RF_RADAR_DATA'
@@ -131,7 +150,7 @@ class CommonMSG:
     MSG_SV_SRV_CONFIG_DATA = "SV_CONFIG_DATA"
 
     # total number of messages: just for cross checking.
-    NUM_MSG = 25
+    NUM_MSG = 31
 
     @classmethod
     def _init_class(cls):
@@ -152,13 +171,19 @@ class CommonMSG:
                              cls.MSG_WC_RADAR_MODE,
                              cls.MSG_WC_STOCK_INFO_REQ,
                              cls.MSG_SV_STOCK_INFO_RESP,
+                             cls.MSG_SV_QAI_CHANGE_NOTICE,
                              cls.MSG_WC_LOCATION_INFO,
                              cls.MSG_WC_LOCMUT_REQ, cls.MSG_SV_LOCMUT_RESP,
                              cls.MSG_RF_RADAR_DATA,
                              cls.MSG_RF_CMD_RESP,
                              cls.MSG_SV_SRV_CONFIG_DATA,
                              cls.MSG_WC_DO_LOCMUT_REQ,
-                             cls.MSG_SV_DO_LOCMUT_RESP
+                             cls.MSG_SV_DO_LOCMUT_RESP,
+                             cls.MSG_SV_LOCMUT_PROGRESS,
+                             cls.MSG_SV_OUTBOX_STATUS,
+                             cls.MSG_WC_RESOLVE_REJECTED_REQ,
+                             cls.MSG_WC_RFID_LOOKUP_REQ,
+                             cls.MSG_SV_RFID_LOOKUP_RESP
                              ]
         # cls.MSG_WC_STOCK_CHECK,cls.MSG_SV_NEW_STOCK_LIST
         # , cls.MSG_RF_STOCK_DATA
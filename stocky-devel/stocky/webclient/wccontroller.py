@@ -250,11 +250,19 @@ class stocky_mainprog(WebClientController):
                 self.wcstatus.set_logout_status()
             elif cmd == CommonMSG.MSG_SV_STOCK_INFO_RESP:
                 self.set_qai_update(val)
+            elif cmd == CommonMSG.MSG_SV_QAI_CHANGE_NOTICE and self.wcstatus is not None:
+                self.wcstatus.set_qai_change_notice(val)
             elif cmd == CommonMSG.MSG_SV_ADD_STOCK_RESP:
                 self.addnewstock(val)
             elif cmd == CommonMSG.MSG_SV_LOCMUT_RESP:
                 rdct, newhash = val['data'], val['hash']
                 self.set_locmut_update(rdct, newhash)
+            elif cmd == CommonMSG.MSG_SV_LOCMUT_PROGRESS:
+                self.switch.getView(LOCMUT_UPLOAD_VIEW_NAME).show_report_progress(val)
+            elif cmd == CommonMSG.MSG_SV_DO_LOCMUT_RESP:
+                self.switch.getView(LOCMUT_UPLOAD_VIEW_NAME).stop_report_move(val['data'])
+            elif cmd == CommonMSG.MSG_SV_OUTBOX_STATUS:
+                self.switch.getView(LOCMUT_UPLOAD_VIEW_NAME).show_outbox_status(val)
             elif cmd == CommonMSG.MSG_SV_SRV_CONFIG_DATA and self.wcstatus is not None:
                 self.wcstatus.set_server_cfg_data(val)
             else:
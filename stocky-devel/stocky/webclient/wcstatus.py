@@ -97,6 +97,8 @@ class WCstatus(base.base_obj):
         self.locmut_hash = "bla"
         self.locmut_dct = {}
         self.srv_config_data: typing.Optional[typing.Dict[str, str]] = None
+        # the time of the last QAI download, as shown in qai_upd_text
+        self._qai_upd_str = "unknown"
         #
         self.login_popup = login_popup
         self.statediv = statediv = html.getPyElementById("state-div")
@@ -383,6 +385,7 @@ class WCstatus(base.base_obj):
                                                                              did_dbreq,
                                                                              dbreq_ok,
                                                                              dbreq_msg))
+        self._qai_upd_str = upd_str
         self.qai_upd_text.set_text(upd_str)
         stock_dct = d.get("stock_dct", None)
         if stock_dct is not None:
@@ -507,6 +510,12 @@ class WCstatus(base.base_obj):
             ll.extend([(ri['id'], ri) for ri in list_list])
         return dict(ll)
 
+    def set_qai_change_notice(self, d: dict) -> None:
+        """The stocky server has downloaded changes to the QAI stock list in the background.
+        Show that an update is available.
+        """
+        self.qai_upd_text.set_text("{} (update available)".format(self._qai_upd_str))
+
     def set_server_cfg_data(self, new_cfg: dict) -> None:
         """This method is called in order to set stocky server configuration data
         to wcstatus.
@@ -409,6 +409,7 @@ For this to work, the stocky computer must be plugged in to ethernet and you mus
         SwitcheeView.__init__(self, contr, parent, idstr, attrdct, jsel,
                               title_text, htext)
         self.stat_tab: typing.Optional[simpletable.dict_table] = None
+        self.qai_tab: typing.Optional[simpletable.dict_table] = None
         self.message_bar: typing.Optional[html.alertbox] = None
 
     def Redraw(self):
@@ -449,6 +450,15 @@ For this to work, the stocky computer must be plugged in to ethernet and you mus
                                                    list(db_stat_dct.items()))
         else:
             self.stat_tab.update_table(db_stat_dct)
+        # the request counters of the server's connection to QAI
+        qai_stat_dct = dict(resdct.get('qai_stats', {}))
+        if self.qai_tab is None:
+            tab_attrdct = {'class': 'w3-container'}
+            self.qai_tab = simpletable.dict_table(self, "qai_tab",
+                                                  tab_attrdct,
+                                                  list(qai_stat_dct.items()))
+        else:
+            self.qai_tab.update_table(qai_stat_dct)
         self.wcstatus.set_busy(False)
 
 
@@ -1047,6 +1057,8 @@ class UploadLocMutView(SwitcheeView):
     """
 
     GO_UPLOAD_LOCMUT = 'go_upload_locmut'
+    GO_RETRY_REJECTED = 'go_retry_rejected'
+    GO_DISCARD_REJECTED = 'go_discard_rejected'
 
     def __init__(self,
                  contr: widgets.base_controller,
@@ -1062,6 +1074,11 @@ class UploadLocMutView(SwitcheeView):
                               title_text, htext)
         self.locmut_tab: typing.Optional[LocMutTable] = None
         self.gobutton: typing.Optional[html.textbutton] = None
+        self.retrybutton: typing.Optional[html.textbutton] = None
+        self.discardbutton: typing.Optional[html.textbutton] = None
+        self.message_bar: typing.Optional[html.alertbox] = None
+        # the reagent items with location changes refused by QAI
+        self._rejected_ids: typing.List[int] = []
 
     def rcvMsg(self,
                whofrom: 'base.base_obj',
@@ -1076,6 +1093,10 @@ class UploadLocMutView(SwitcheeView):
                 if self.locmut_tab is not None:
                     print("DO SOMETHING HERE")
                     self._start_report_move()
+            elif self.retrybutton is not None and whofrom == self.retrybutton:
+                self._resolve_rejected(True)
+            elif self.discardbutton is not None and whofrom == self.discardbutton:
+                self._resolve_rejected(False)
             else:
                 super().rcvMsg(whofrom, msgdesc, msgdat)
         else:
@@ -1108,6 +1129,31 @@ class UploadLocMutView(SwitcheeView):
             buttontext = "Upload to QAI"
             self.gobutton = html.textbutton(self, idstr, attrdct, buttontext)
             self.gobutton.addObserver(self, base.MSGD_BUTTON_CLICK)
+        if self.retrybutton is None:
+            idstr = "retryrejected-but"
+            attrdct = {'class': button_classes,
+                       'title': "Upload the location changes refused by QAI again.",
+                       STARATTR_ONCLICK: dict(cmd=UploadLocMutView.GO_RETRY_REJECTED)}
+            buttontext = "Retry refused changes"
+            self.retrybutton = html.textbutton(self, idstr, attrdct, buttontext)
+            self.retrybutton.addObserver(self, base.MSGD_BUTTON_CLICK)
+        if self.discardbutton is None:
+            idstr = "discardrejected-but"
+            attrdct = {'class': button_classes,
+                       'title': "Discard the location changes refused by QAI.",
+                       STARATTR_ONCLICK: dict(cmd=UploadLocMutView.GO_DISCARD_REJECTED)}
+            buttontext = "Discard refused changes"
+            self.discardbutton = html.textbutton(self, idstr, attrdct, buttontext)
+            self.discardbutton.addObserver(self, base.MSGD_BUTTON_CLICK)
+
+    def _resolve_rejected(self, do_retry: bool) -> None:
+        """Tell the server to upload the location changes refused by QAI again,
+        or to discard them."""
+        if len(self._rejected_ids) == 0:
+            self._set_message("No location changes were refused by QAI")
+            return
+        dd = {'reag_item_ids': self._rejected_ids, 'do_retry': do_retry}
+        self._contr.send_WS_msg(CommonMSG(CommonMSG.MSG_WC_RESOLVE_REJECTED_REQ, dd))
 
     # these are for upload TO the server
     def _start_report_move(self) -> None:
@@ -1117,8 +1163,44 @@ class UploadLocMutView(SwitcheeView):
         dd = {'locmove': move_lst}
         self._contr.send_WS_msg(CommonMSG(CommonMSG.MSG_WC_DO_LOCMUT_REQ, dd))
         print("moving {} items".format(len(move_lst)))
-    # def stop_report_move(self) -> None:
-    #    self.wcstatus.set_busy(False)
+
+    def _set_message(self, msg: str) -> None:
+        if self.message_bar is None:
+            self.message_bar = html.alertbox(self, "alert-box", None, None)
+        self.message_bar.set_text(msg)
+
+    def show_report_progress(self, progdct: dict) -> None:
+        """This is called when the server reports its progress in uploading
+        the location changes to QAI."""
+        self._set_message("Uploaded {} of {} location changes ({} failed)".format(
+            progdct['ndone'], progdct['ntotal'], progdct['nfailed']))
+
+    def stop_report_move(self, resdct: dict) -> None:
+        """This is called when the server tells us that the location changes have
+        been committed. The server then uploads them to QAI in the background."""
+        if resdct.get('ok', False):
+            self._set_message("Committed {} location changes for upload to QAI".format(resdct['nqueued']))
+        else:
+            self._set_message("Committed {} location changes for upload to QAI, {} failed".format(
+                resdct.get('nqueued', 0), resdct.get('nfailed', 0)))
+        self.wcstatus.set_busy(False)
+
+    def show_outbox_status(self, statdct: dict) -> None:
+        """This is called when the server tells us about the location changes that are
+        waiting to be uploaded to QAI."""
+        npending = statdct['npending']
+        nrejected = len(statdct['rejected'])
+        self._rejected_ids = [rdct['reag_item_id'] for rdct in statdct['rejected']]
+        if npending == 0:
+            msg = "All location changes have been uploaded to QAI"
+        else:
+            msg = "{} location changes waiting to be uploaded to QAI (since {})".format(
+                npending, statdct['oldest'])
+            if statdct['nretrying'] > 0:
+                msg += ", {} failed: {}".format(statdct['nretrying'], statdct['last_error'])
+        if nrejected > 0:
+            msg += ". {} location changes were refused by QAI".format(nrejected)
+        self._set_message(msg)
 
     # these are for download FROM the server
     def _start_locmut_download(self) -> None: